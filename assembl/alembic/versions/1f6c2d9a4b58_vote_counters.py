@@ -0,0 +1,54 @@
+"""vote counters
+
+Revision ID: 1f6c2d9a4b58
+Revises: 4b1e8f0d2a37
+Create Date: 2026-10-18 17:41:05.218733
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f6c2d9a4b58'
+down_revision = '4b1e8f0d2a37'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'vote_value_count',
+            sa.Column('vote_spec_id', sa.Integer, sa.ForeignKey(
+                'vote_specification.id',
+                ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('idea_id', sa.Integer, sa.ForeignKey(
+                'idea.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('token_category_id', sa.Integer, primary_key=True),
+            sa.Column('vote_value', sa.Float, primary_key=True),
+            sa.Column('num_votes', sa.Integer, nullable=False))
+        op.create_table(
+            'vote_spec_voter',
+            sa.Column('vote_spec_id', sa.Integer, sa.ForeignKey(
+                'vote_specification.id',
+                ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('voter_id', sa.Integer, sa.ForeignKey(
+                'user.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('num_votes', sa.Integer, nullable=False))
+
+    # Count existing votes
+    from assembl import models as m
+    from assembl.models.votes import rebuild_vote_counts
+    db = m.get_session_maker()()
+    with transaction.manager:
+        rebuild_vote_counts(db)
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('vote_spec_voter')
+        op.drop_table('vote_value_count')
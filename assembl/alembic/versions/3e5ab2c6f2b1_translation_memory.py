@@ -0,0 +1,35 @@
+"""translation memory
+
+Revision ID: 3e5ab2c6f2b1
+Revises: 41176a6a6758
+Create Date: 2026-10-18 10:12:41.418276
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e5ab2c6f2b1'
+down_revision = '41176a6a6758'
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'translation_memory',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('service', sa.String(60), nullable=False),
+            sa.Column('source_hash', sa.String(64), nullable=False),
+            sa.Column('source_locale', sa.String(32), nullable=False),
+            sa.Column('target_locale', sa.String(32), nullable=False),
+            sa.Column('detected_locale', sa.String(32)),
+            sa.Column('translation', sa.UnicodeText),
+            sa.Column('creation_date', sa.DateTime),
+            sa.UniqueConstraint(
+                'source_hash', 'source_locale', 'target_locale', 'service'))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('translation_memory')
@@ -0,0 +1,51 @@
+"""analytics rollups
+
+Revision ID: 4b1e8f0d2a37
+Revises: 3e5ab2c6f2b1
+Create Date: 2026-10-18 14:02:17.536120
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b1e8f0d2a37'
+down_revision = '3e5ab2c6f2b1'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'analytics_rollup',
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('metric', sa.String(32), primary_key=True),
+            sa.Column('bucket', sa.DateTime, primary_key=True),
+            sa.Column('value', sa.Integer, nullable=False))
+        op.create_table(
+            'analytics_agent_activity',
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('kind', sa.String(8), primary_key=True),
+            sa.Column('bucket', sa.DateTime, primary_key=True),
+            sa.Column('agent_id', sa.Integer, sa.ForeignKey(
+                'agent_profile.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('value', sa.Integer, nullable=False))
+
+    # Fill the buckets from existing data
+    from assembl import models as m
+    from assembl.models.analytics import rebuild_analytics
+    db = m.get_session_maker()()
+    with transaction.manager:
+        rebuild_analytics(db)
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('analytics_agent_activity')
+        op.drop_table('analytics_rollup')
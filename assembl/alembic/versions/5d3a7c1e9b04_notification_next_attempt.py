@@ -0,0 +1,25 @@
+"""notification next attempt
+
+Revision ID: 5d3a7c1e9b04
+Revises: 1f6c2d9a4b58
+Create Date: 2026-10-18 19:12:37.408215
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d3a7c1e9b04'
+down_revision = '1f6c2d9a4b58'
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.add_column('notification', sa.Column(
+            'next_attempt_date', sa.DateTime, nullable=True))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_column('notification', 'next_attempt_date')
@@ -1,10 +1,18 @@
 """Sundry utility functions having to do with users or permissions"""
 from csv import reader
+from collections import namedtuple
 from datetime import datetime
 from os import urandom
+from uuid import uuid4
 import base64
+import logging
 
+import transaction
+from sqlalchemy import event
+from sqlalchemy.orm.session import Session, object_session
 from sqlalchemy.sql.expression import and_
+from dogpile.cache import make_region
+from dogpile.cache.api import NO_VALUE
 from pyramid.security import (
     authenticated_userid, Everyone, Authenticated)
 from pyramid.httpexceptions import HTTPNotFound
@@ -13,12 +21,16 @@ from pyramid.authentication import SessionAuthenticationPolicy
 
 from assembl.lib.locale import _
 from ..lib.sqla import get_session_maker
+from ..lib.config import get_config
+from ..lib.utils import get_shared_cache_region
 from . import R_SYSADMIN, P_READ, SYSTEM_ROLES
 from ..models.auth import (
     User, Role, UserRole, LocalUserRole, Permission,
     DiscussionPermission, IdentityProvider, AgentProfile,
     EmailAccount)
 
+log = logging.getLogger('assembl')
+
 
 def get_user(request):
     logged_in = authenticated_userid(request)
@@ -26,60 +38,207 @@ def get_user(request):
         return User.get(logged_in)
 
 
+class EffectivePermissions(namedtuple(
+        'EffectivePermissions', ('roles', 'permissions', 'is_sysadmin'))):
+    """The roles and permissions of a user in a discussion (or globally).
+
+    Roles include the global and local roles of the user, but not
+    the pseudo-roles (Everyone, Authenticated); permissions include those
+    granted to pseudo-roles."""
+    __slots__ = ()
+
+    @classmethod
+    def compute(cls, db, user_id, discussion_id):
+        if user_id in (Everyone, Authenticated):
+            roles = frozenset()
+            pseudo_roles = (Everyone, ) if user_id == Everyone \
+                else (Authenticated, Everyone)
+        else:
+            global_roles = [x for (x, ) in db.query(Role.name).join(
+                UserRole).filter(UserRole.user_id == user_id)]
+            roles = set(global_roles)
+            if discussion_id:
+                roles.update((x for (x, ) in db.query(Role.name).join(
+                    LocalUserRole).filter(and_(
+                        LocalUserRole.user_id == user_id,
+                        LocalUserRole.requested == False,
+                        LocalUserRole.discussion_id == discussion_id))))
+            roles = frozenset(roles)
+            if R_SYSADMIN in global_roles:
+                all_permissions = db.query(Permission.name)
+                return cls(roles, frozenset(
+                    (x for (x, ) in all_permissions)), True)
+            pseudo_roles = (Authenticated, Everyone)
+        if not discussion_id:
+            return cls(roles, frozenset(), False)
+        permissions = db.query(Permission.name).join(
+            DiscussionPermission, Role).filter(and_(
+                DiscussionPermission.discussion_id == discussion_id,
+                Role.name.in_(tuple(roles.union(pseudo_roles))))).distinct()
+        return cls(roles, frozenset((x for (x, ) in permissions)), False)
+
+
+class EffectivePermissionsCache(object):
+    """A cache of :py:class:`EffectivePermissions`,
+    by (user_id, discussion_id).
+
+    Entries are memoized in the session until the end of the transaction,
+    and kept in a dogpile cache region along with the generation tokens of
+    the user, the discussion and the global roles and permissions.
+    Changes to role or permission rows renew those generations when the
+    transaction is committed; until then, the session does not use the
+    cache. In ``shared`` mode (the default), the region uses the dogpile
+    configuration, so entries and invalidations are seen by all processes.
+    ``local`` mode uses an in-memory region and should only be used with a
+    single process; ``off`` disables the cache.
+    This is set by the ``permissions_cache`` configuration key."""
+
+    GLOBAL_KEY = "g"
+
+    def __init__(self):
+        self._mode = None
+        self._region = None
+
+    @property
+    def mode(self):
+        if self._mode is None:
+            mode = get_config().get('permissions_cache', 'shared')
+            if mode == 'shared':
+                self._region = get_shared_cache_region('permissions')
+                if self._region is None:
+                    log.error("Could not setup the shared permissions cache. "
+                              "Disabling the permissions cache.")
+                    mode = 'off'
+            elif mode == 'local':
+                self._region = make_region().configure(
+                    'dogpile.cache.memory')
+            self._mode = mode
+        return self._mode
+
+    @staticmethod
+    def user_key(user_id):
+        return "u_%s" % (user_id, )
+
+    @staticmethod
+    def discussion_key(discussion_id):
+        return "d_%d" % (discussion_id, )
+
+    def get(self, db, user_id, discussion_id):
+        """Get the effective permissions of the user in the discussion."""
+        if self.mode == 'off' or db.info.get('permission_changes', None):
+            return EffectivePermissions.compute(db, user_id, discussion_id)
+        memo = self.memo(db)
+        key = (user_id, discussion_id)
+        permissions = memo.get(key, None)
+        if permissions is not None:
+            return permissions
+        keys = [self.GLOBAL_KEY, self.user_key(user_id)]
+        if discussion_id:
+            keys.append(self.discussion_key(discussion_id))
+        entry_key = "p_%s_%s" % key
+        values = [None if v is NO_VALUE else v
+                  for v in self._region.get_multi(keys + [entry_key])]
+        generations = tuple(values[:-1])
+        entry = values[-1]
+        if entry is not None and entry[0] == generations:
+            permissions = entry[1]
+        else:
+            permissions = EffectivePermissions.compute(
+                db, user_id, discussion_id)
+            self._region.set(entry_key, (generations, permissions))
+        memo[key] = permissions
+        return permissions
+
+    @staticmethod
+    def memo(db):
+        """The permissions memoized in the session for the current
+        transaction.
+
+        A read-only transaction may end without committing the session,
+        so the memo is tied to the transaction rather than cleared
+        on commit."""
+        current = transaction.get()
+        memo = db.info.get('effective_permissions', None)
+        if memo is None or memo[0] is not current:
+            memo = db.info['effective_permissions'] = (current, {})
+        return memo[1]
+
+    def invalidate(self, keys):
+        if self.mode == 'off':
+            return
+        self._region.set_multi({key: uuid4().hex for key in keys})
+
+    @staticmethod
+    def mark_changed(db, key):
+        """Note that roles or permissions were changed in this session.
+
+        The relevant generation is renewed when the session is committed."""
+        db.info.setdefault('permission_changes', set()).add(key)
+        db.info.pop('effective_permissions', None)
+
+
+effective_permissions_cache = EffectivePermissionsCache()
+
+
+def permissions_after_commit_listener(session):
+    session.info.pop('effective_permissions', None)
+    pending = session.info.pop('permission_changes', None)
+    if pending:
+        effective_permissions_cache.invalidate(pending)
+
+
+def permissions_rollback_listener(session):
+    session.info.pop('effective_permissions', None)
+    session.info.pop('permission_changes', None)
+
+
+def permissions_transaction_end_listener(session, session_transaction):
+    # Also reached when the session is closed without a commit
+    if session_transaction.parent is None:
+        session.info.pop('effective_permissions', None)
+
+
+def permissions_change_listener(mapper, connection, target):
+    db = object_session(target)
+    if db is None:
+        return
+    cache = EffectivePermissionsCache
+    if isinstance(target, (UserRole, LocalUserRole)):
+        key = cache.user_key(target.user_id)
+    elif isinstance(target, DiscussionPermission):
+        key = cache.discussion_key(target.discussion_id)
+    else:
+        key = cache.GLOBAL_KEY
+    cache.mark_changed(db, key)
+
+
+event.listen(Session, 'after_commit', permissions_after_commit_listener)
+event.listen(Session, 'after_rollback', permissions_rollback_listener)
+event.listen(Session, 'after_transaction_end',
+             permissions_transaction_end_listener)
+for cls in (Role, UserRole, LocalUserRole, Permission, DiscussionPermission):
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(cls, event_name, permissions_change_listener,
+                     propagate=True)
+
+
+def get_effective_permissions(user_id, discussion_id=None):
+    session = get_session_maker()()
+    return effective_permissions_cache.get(
+        session, user_id or Everyone, discussion_id)
+
+
 def get_roles(user_id, discussion_id=None):
     if user_id in SYSTEM_ROLES:
         return [user_id]
-    session = get_session_maker()()
-    roles = session.query(Role.name).join(UserRole).filter(
-        UserRole.user_id == user_id)
-    if discussion_id:
-        roles = roles.union(
-            session.query(Role.name).join(
-                LocalUserRole).filter(and_(
-                    LocalUserRole.user_id == user_id,
-                    LocalUserRole.requested == False,
-                    LocalUserRole.discussion_id == discussion_id)))
-    return [x[0] for x in roles.distinct()]
+    if not user_id:
+        return []
+    return list(get_effective_permissions(user_id, discussion_id).roles)
 
 
 def get_permissions(user_id, discussion_id):
-    user_id = user_id or Everyone
-    session = get_session_maker()()
-    if user_id == Everyone:
-        if not discussion_id:
-            return []
-        permissions = session.query(Permission.name).join(
-            DiscussionPermission, Role).filter(
-                (DiscussionPermission.discussion_id == discussion_id)
-                & (Role.name == user_id))
-    elif user_id == Authenticated:
-        if not discussion_id:
-            return []
-        permissions = session.query(Permission.name).join(
-            DiscussionPermission, Role).filter(
-                (DiscussionPermission.discussion_id == discussion_id)
-                & (Role.name.in_((Authenticated, Everyone))))
-    else:
-        sysadmin = session.query(UserRole).filter_by(
-            user_id=user_id).join(Role).filter_by(name=R_SYSADMIN).first()
-        if sysadmin:
-            return [x[0] for x in session.query(Permission.name).all()]
-        if not discussion_id:
-            return []
-        permissions = session.query(Permission.name).join(
-            DiscussionPermission, Role, UserRole).filter(
-                UserRole.user_id == user_id
-            ).union(session.query(Permission.name).join(
-                DiscussionPermission, Role, LocalUserRole).filter(and_(
-                    LocalUserRole.user_id == user_id,
-                    LocalUserRole.requested == False,
-                    LocalUserRole.discussion_id == discussion_id,
-                    DiscussionPermission.discussion_id == discussion_id))
-            ).union(session.query(Permission.name).join(
-                DiscussionPermission, Role).filter(and_(
-                    DiscussionPermission.discussion_id == discussion_id,
-                    Role.name.in_((Authenticated, Everyone)))))
-    return [x[0] for x in permissions.distinct()]
+    return list(get_effective_permissions(
+        user_id, discussion_id).permissions)
 
 
 def discussion_from_request(request):
@@ -216,51 +375,9 @@ def roles_with_permissions(discussion, *permissions):
 
 
 def user_has_permission(discussion_id, user_id, permission):
-    from ..models import Discussion
     # assume all ids valid
-    user_id = user_id or Everyone
-    db = Discussion.default_db
-    if user_id == Everyone:
-        permission = db.query(DiscussionPermission).join(
-            Permission, Role).filter(
-                DiscussionPermission.discussion_id == discussion_id).filter(
-                    Role.name == user_id).filter(
-                        Permission.name == permission).first()
-        return permission is not None
-    elif user_id == Authenticated:
-        permission = db.query(DiscussionPermission).join(
-            Permission, Role).filter(
-                DiscussionPermission.discussion_id == discussion_id).filter(
-                    Role.name.in_((Authenticated, Everyone))).filter(
-                        Permission.name == permission).first()
-        return permission is not None
-    sysadmin = db.query(UserRole).filter_by(
-        user_id=user_id).join(Role).filter_by(name=R_SYSADMIN).first()
-    if sysadmin:
-        return True
-    permission = db.query(DiscussionPermission).join(
-        Permission, Role, UserRole).filter(
-            DiscussionPermission.discussion_id == discussion_id).filter(
-                UserRole.user_id == user_id).filter(
-                    Permission.name == permission
-                ).union(
-                    db.query(DiscussionPermission
-                        ).join(Permission, Role, LocalUserRole).filter(and_(
-                            # Virtuoso disregards this explicit condition
-                            DiscussionPermission.discussion_id == discussion_id,
-                            # So I have to add this one as well.
-                            LocalUserRole.discussion_id == discussion_id,
-                            LocalUserRole.user_id == user_id,
-                            LocalUserRole.requested == False,
-                            Permission.name == permission))
-                ).union(
-                    db.query(DiscussionPermission).join(
-                            Permission, Role).filter(
-                                DiscussionPermission.discussion_id == discussion_id).filter(
-                                    Role.name.in_((Authenticated, Everyone))).filter(
-                                        Permission.name == permission)
-                ).first()
-    return permission is not None
+    effective = get_effective_permissions(user_id, discussion_id)
+    return effective.is_sysadmin or permission in effective.permissions
 
 
 def users_with_permission(discussion_id, permission, id_only=True):
@@ -0,0 +1,90 @@
+"""Streaming exports.
+
+Rows are encoded as CSV or JSON in chunks while they are produced,
+and sent through a response ``app_iter``, so large exports use constant
+memory and start responding immediately."""
+
+from cStringIO import StringIO
+from csv import writer, DictWriter
+
+import transaction
+from pyramid.response import Response
+
+from .json import DateJSONEncoder
+
+# Approximate size of the chunks sent to the client
+CHUNK_SIZE = 65536
+
+
+def csv_chunks(rows, fieldnames=None, chunk_size=CHUNK_SIZE,
+               dialect='excel', delimiter=';'):
+    """Encode rows as CSV, yielding chunks of about chunk_size bytes.
+
+    Rows are dictionaries if fieldnames are given, with a header row;
+    sequences otherwise. Values must already be encoded."""
+    output = StringIO()
+    if fieldnames is None:
+        csv = writer(output, dialect=dialect, delimiter=delimiter)
+    else:
+        csv = DictWriter(output, fieldnames=fieldnames,
+                         dialect=dialect, delimiter=delimiter)
+        csv.writeheader()
+    for row in rows:
+        csv.writerow(row)
+        if output.tell() >= chunk_size:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    if output.tell():
+        yield output.getvalue()
+
+
+def json_list_chunks(items, cls=DateJSONEncoder, chunk_size=CHUNK_SIZE):
+    """Encode items as a JSON list, yielding chunks of about
+    chunk_size bytes."""
+    encoder = cls()
+    chunk = ['[']
+    size = 0
+    first = True
+    for item in items:
+        if not first:
+            chunk.append(',')
+        first = False
+        encoded = encoder.encode(item)
+        chunk.append(encoded)
+        size += len(encoded)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+def in_transaction(items_factory, *args, **kwargs):
+    """Iterate on the items produced by items_factory in a transaction
+    of their own.
+
+    The response body is iterated after the request transaction is over,
+    so database reads must be done in a new one."""
+    with transaction.manager:
+        for item in items_factory(*args, **kwargs):
+            yield item
+
+
+def streaming_response(chunks, content_type, filename=None):
+    response = Response(app_iter=chunks, content_type=content_type)
+    if filename:
+        response.content_disposition = 'attachment; filename="%s"' % (
+            filename,)
+    return response
+
+
+def csv_streaming_response(rows, fieldnames=None, filename=None):
+    return streaming_response(
+        csv_chunks(rows, fieldnames), 'text/csv', filename)
+
+
+def json_streaming_response(items, cls=DateJSONEncoder):
+    return streaming_response(
+        json_list_chunks(items, cls), 'application/json')
@@ -0,0 +1,100 @@
+"""Fetch IMAP messages by ranges of UIDs, ahead of their processing."""
+import re
+import sys
+from threading import Thread
+from Queue import Queue
+
+FETCH_ITEMS = "(RFC822.SIZE BODY.PEEK[])"
+UID_RE = re.compile(r'\bUID (\d+)')
+SIZE_RE = re.compile(r'\bRFC822\.SIZE (\d+)')
+
+
+class FetchError(Exception):
+    pass
+
+
+def uid_ranges(uids, chunk_size):
+    """Split UIDs in chunks of at most chunk_size, in order.
+    Returns the (first, last) UIDs of each chunk."""
+    uids = sorted(set(int(uid) for uid in uids))
+    return [(uids[i], uids[min(i + chunk_size, len(uids)) - 1])
+            for i in range(0, len(uids), chunk_size)]
+
+
+def fetch_range(mailbox, first, last):
+    """Fetch the messages with UIDs in first:last, in one command.
+
+    Returns a list of (uid, size, message string), in UID order."""
+    status, data = mailbox.uid('fetch', '%d:%d' % (first, last), FETCH_ITEMS)
+    if status != 'OK':
+        raise FetchError(data)
+    messages = []
+    current = None
+    for part in data:
+        if isinstance(part, tuple):
+            header, message_string = part
+            uid = UID_RE.search(header)
+            size = SIZE_RE.search(header)
+            current = [uid and int(uid.group(1)),
+                       size and int(size.group(1)),
+                       message_string]
+            messages.append(current)
+        elif current is not None and current[0] is None and part:
+            # Some servers send the UID after the message literal
+            uid = UID_RE.search(part)
+            if uid:
+                current[0] = int(uid.group(1))
+    # Servers may send unsolicited FETCH responses (flag changes)
+    return sorted(tuple(message) for message in messages
+                  if message[0] is not None and first <= message[0] <= last)
+
+
+class FetchPipeline(object):
+    """Iterates on the fetched messages of UID ranges, a range at a time.
+
+    The next ranges are fetched in a background thread while the
+    current one is processed, so the IMAP round trips overlap with
+    parsing and storing the messages."""
+
+    def __init__(self, mailbox, ranges, prefetch=2):
+        self.mailbox = mailbox
+        self.ranges = ranges
+        self.prefetch = prefetch
+        self.stopped = False
+        self.bytes_fetched = 0
+
+    def fetch_all(self, queue):
+        try:
+            for (first, last) in self.ranges:
+                if self.stopped:
+                    return
+                messages = fetch_range(self.mailbox, first, last)
+                self.bytes_fetched += sum(
+                    len(message_string) for (_, _, message_string)
+                    in messages)
+                queue.put(((first, last), messages, None))
+            queue.put((None, None, None))
+        except Exception:
+            queue.put((None, None, sys.exc_info()))
+
+    def __iter__(self):
+        """Yields ((first, last), messages) for each range"""
+        queue = Queue(self.prefetch)
+        fetcher = Thread(target=self.fetch_all, args=(queue,))
+        fetcher.daemon = True
+        fetcher.start()
+        try:
+            while True:
+                uid_range, messages, error = queue.get()
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                if uid_range is None:
+                    break
+                yield uid_range, messages
+        finally:
+            # Unblock the fetcher if we stop early
+            self.stopped = True
+            while fetcher.is_alive():
+                while not queue.empty():
+                    queue.get()
+                fetcher.join(0.1)
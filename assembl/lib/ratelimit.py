@@ -0,0 +1,129 @@
+"""Token-bucket rate limits on outgoing mail, by recipient domain."""
+from time import time
+from threading import Lock
+from collections import OrderedDict
+from itertools import izip_longest
+
+
+class TokenBucket(object):
+    """Holds up to capacity tokens, refilled at rate tokens per second.
+
+    Tokens can be reserved ahead of time: the bucket then goes into debt,
+    and later reservations wait longer."""
+
+    def __init__(self, rate, capacity=1, now=None):
+        assert rate > 0
+        self.rate = float(rate)
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time() if now is None else now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available."""
+        self.refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def reserve(self, now):
+        """Take a token, and return the seconds until it can be used."""
+        wait = self.wait_time(now)
+        self.tokens -= 1
+        return wait
+
+
+class DomainRateLimiter(object):
+    """Token buckets for recipient domains.
+
+    A recipient uses the limit of the most specific domain that has one
+    (the empty domain matches all recipients). The recipients of a domain
+    and of its subdomains share its bucket. The counters are exposed
+    by :py:meth:`metrics`."""
+
+    def __init__(self, clock=time):
+        self.clock = clock
+        self.limits = {}
+        self.buckets = {}
+        self.counters = {}
+        self._lock = Lock()
+
+    def set_limit(self, domain, rate, capacity=1):
+        """Allow rate messages per second to the domain,
+        and bursts of capacity messages. A null rate means no limit."""
+        domain = domain.lower()
+        with self._lock:
+            self.buckets.pop(domain, None)
+            if rate:
+                self.limits[domain] = (rate, capacity)
+            else:
+                self.limits.pop(domain, None)
+
+    def limited_domain(self, email):
+        """The domain whose limit applies to this address, if any."""
+        domain = email.split("@")[-1].lower().split('.')
+        for i in range(len(domain) + 1):
+            dom = '.'.join(domain[i:])
+            if dom in self.limits:
+                return dom
+
+    def _bucket(self, domain, now):
+        bucket = self.buckets.get(domain, None)
+        if bucket is None:
+            rate, capacity = self.limits[domain]
+            bucket = self.buckets[domain] = TokenBucket(rate, capacity, now)
+        return bucket
+
+    def _count(self, domain, name):
+        counters = self.counters.setdefault(
+            domain, dict(sent=0, deferred=0))
+        counters[name] += 1
+
+    def reserve(self, email):
+        """Reserve a message to this address. Returns 0 if it can be sent
+        now, or the seconds to wait before sending it."""
+        domain = self.limited_domain(email)
+        if domain is None:
+            return 0
+        with self._lock:
+            wait = self._bucket(domain, self.clock()).reserve(self.clock())
+            self._count(domain, 'deferred' if wait else 'sent')
+        return wait
+
+    def wait_time(self, domain):
+        if domain is None:
+            return 0
+        with self._lock:
+            return self._bucket(domain, self.clock()).wait_time(self.clock())
+
+    def order(self, items, email_of):
+        """Order items to be sent: domains that are not throttled first,
+        and alternating between domains."""
+        groups = OrderedDict()
+        for item in items:
+            groups.setdefault(
+                self.limited_domain(email_of(item)), []).append(item)
+        domains = sorted(groups, key=self.wait_time)
+        missing = object()
+        return [item for batch in izip_longest(
+                    *[groups[domain] for domain in domains],
+                    fillvalue=missing)
+                for item in batch if item is not missing]
+
+    def metrics(self):
+        """The limits, tokens and message counts of each limited domain."""
+        now = self.clock()
+        with self._lock:
+            result = {}
+            for domain, (rate, capacity) in self.limits.iteritems():
+                bucket = self._bucket(domain, now)
+                bucket.refill(now)
+                result[domain] = dict(
+                    rate=rate, capacity=capacity, tokens=bucket.tokens,
+                    backlog=max(0, -bucket.tokens / bucket.rate),
+                    **self.counters.get(domain, dict(sent=0, deferred=0)))
+            return result
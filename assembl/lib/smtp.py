@@ -0,0 +1,112 @@
+"""Pools of SMTP connections, reused to send many messages to a relay."""
+import smtplib
+import socket
+import logging
+from threading import Lock, BoundedSemaphore
+
+log = logging.getLogger('assembl')
+
+# Errors after which smtplib has reset the session, which can be reused
+RESET_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                smtplib.SMTPDataError)
+
+
+class SMTPConnectionPool(object):
+    """Connections to a SMTP relay, kept open between messages.
+
+    At most max_connections connections are open at a time; senders wait
+    for a free one. Idle connections are reset (RSET) before reuse, which
+    also checks that the relay did not drop them. A connection is closed
+    after max_messages messages, or after an error."""
+
+    def __init__(self, host, port=25, max_connections=4, max_messages=100,
+                 timeout=60):
+        self.host = host
+        self.port = port
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self._idle = []  # (connection, messages sent)
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(max_connections)
+        self.connections_opened = 0
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        self.connections_opened += 1
+        return connection, 0
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            connection.close()
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, num_sent = self._idle.pop()
+            try:
+                connection.rset()
+                return connection, num_sent
+            except (smtplib.SMTPException, socket.error):
+                log.debug("Dropping a stale SMTP connection to %s",
+                          self.host)
+                connection.close()
+        return self._connect()
+
+    def _checkin(self, connection, num_sent):
+        if num_sent >= self.max_messages:
+            self._close(connection)
+        else:
+            with self._lock:
+                self._idle.append((connection, num_sent))
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """Send a message over a pooled connection.
+
+        Returns the refused recipients and raises as
+        :py:meth:`smtplib.SMTP.sendmail`."""
+        with self._slots:
+            connection, num_sent = self._checkout()
+            try:
+                result = connection.sendmail(from_addr, to_addrs, msg)
+            except RESET_ERRORS:
+                self._checkin(connection, num_sent + 1)
+                raise
+            except Exception:
+                connection.close()
+                raise
+            self._checkin(connection, num_sent + 1)
+            return result
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._close(connection)
+
+
+_pools = {}
+_pools_lock = Lock()
+
+
+def get_smtp_pool(host, port=25, **kwargs):
+    """The connection pool of this process for a SMTP relay."""
+    with _pools_lock:
+        pool = _pools.get((host, port), None)
+        if pool is None:
+            pool = _pools[(host, port)] = SMTPConnectionPool(
+                host, port, **kwargs)
+        return pool
+
+
+def close_smtp_pools():
+    with _pools_lock:
+        pools = _pools.values()
+        _pools.clear()
+    for pool in pools:
+        pool.close()
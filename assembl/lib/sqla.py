@@ -16,8 +16,8 @@ from anyjson import dumps, loads
 from colanderalchemy import SQLAlchemySchemaNode
 from sqlalchemy import (
     DateTime, MetaData, engine_from_config, event, Column, Integer,
-    inspect)
-from sqlalchemy.exc import NoInspectionAvailable
+    inspect, and_)
+from sqlalchemy.exc import NoInspectionAvailable, IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import AssociationProxy
 from sqlalchemy.orm import mapper, scoped_session, sessionmaker
@@ -35,7 +35,7 @@ from pyramid.httpexceptions import HTTPUnauthorized, HTTPBadRequest
 
 from .parsedatetime import parse_datetime
 from ..view_def import get_view_def
-from .zmqlib import get_pub_socket, send_changes
+from .zmqlib import get_publisher, changes_topic
 from ..semantic.namespaces import QUADNAMES
 from ..auth import *
 from .decl_enums import EnumSymbol, DeclEnumType
@@ -143,6 +143,347 @@ class ChainingContext(object):
         return self.context.get_instance_of_class(cls)
 
 
+_JSON_SCALAR_TYPES = (str, unicode, int, long, float, bool, types.NoneType)
+
+
+def _translate_to_json(v, view_name, user_id, permissions, base_uri):
+    """Translate a value obtained from a model instance to JSON."""
+    if isinstance(v, Base):
+        p = getattr(v, 'user_can', None)
+        if p and not v.user_can(
+                user_id, CrudPermissions.READ, permissions):
+            return None
+        if view_name:
+            return v.generic_json(
+                view_name, user_id, permissions, base_uri)
+        else:
+            return v.uri(base_uri)
+    elif isinstance(v, _JSON_SCALAR_TYPES):
+        return v
+    elif isinstance(v, EnumSymbol):
+        return v.name
+    elif isinstance(v, datetime):
+        return v.isoformat() + "Z"
+    elif isinstance(v, dict):
+        v = {_translate_to_json(k, view_name, user_id, permissions, base_uri):
+             _translate_to_json(val, view_name, user_id, permissions, base_uri)
+             for k, val in v.items()}
+        return {k: val for (k, val) in v.items()
+                if val is not None}
+    elif isinstance(v, Iterable):
+        v = [_translate_to_json(i, view_name, user_id, permissions, base_uri)
+             for i in v]
+        return [x for x in v if x is not None]
+    else:
+        raise NotImplementedError("Cannot translate", v)
+
+
+class _JsonClassTables(object):
+    """The introspection tables of a mapped class used by generic_json.
+
+    Those only depend on the class, so they are computed once."""
+    def __init__(self, cls):
+        mapper = cls.__mapper__
+        self.relns = {r.key: r for r in mapper.relationships}
+        self.cols = {c.key: c for c in mapper.columns}
+        self.fkeys = {c for c in mapper.columns if c.foreign_keys}
+        self.reln_of_fkeys = {
+            frozenset(r._calculated_foreign_keys): r
+            for r in mapper.relationships
+        }
+        self.fkey_of_reln = {r.key: r._calculated_foreign_keys
+                             for r in mapper.relationships}
+        self.methods = {name for (name, m) in pyinspect.getmembers(
+            cls, lambda m: pyinspect.ismethod(m)
+            and m.func_code.co_argcount == 1)}
+        self.properties = {name for (name, p) in pyinspect.getmembers(
+            cls, lambda p: pyinspect.isdatadescriptor(p))}
+
+    _cache = {}
+
+    @classmethod
+    def for_class(cls, target_cls):
+        tables = cls._cache.get(target_cls, None)
+        if tables is None:
+            tables = cls._cache[target_cls] = cls(target_cls)
+        return tables
+
+
+class _JsonPlan(object):
+    """A view_def compiled for a given class.
+
+    The view_def specification strings are parsed once, and turned into
+    a list of getter steps, each of which is a function of
+    ``(instance, result, user_id, permissions, base_uri)`` that adds
+    its value to the result dict. Columns that are not mentioned in the
+    view_def (if the ``_default`` is not ``False``) are also precomputed.
+
+    Plans are cached by (class, view_def name), and remember the view_def
+    they were compiled from, so they are recompiled whenever
+    :py:func:`assembl.view_def.get_view_def` reloads the view_def."""
+
+    _cache = {}
+
+    def __init__(self, cls, view_def_name, view_def):
+        self.source = view_def
+        self.steps = None
+        self.defaults = None
+        local_view = cls.expand_view_def(view_def)
+        if not local_view:
+            return
+        tables = _JsonClassTables.for_class(cls)
+        my_typename = cls.external_typename()
+        known = set()
+        steps = []
+        for name, spec in local_view.iteritems():
+            if name == "_default":
+                continue
+            elif spec is False:
+                known.add(name)
+                continue
+            step = self._compile_step(
+                tables, view_def_name, my_typename, name, spec, known)
+            if step is not None:
+                steps.append(step)
+        self.steps = steps
+        if local_view.get('_default') is not False:
+            self.defaults = self._compile_defaults(tables, known)
+
+    @classmethod
+    def get(cls, target_cls, view_def_name):
+        view_def = get_view_def(view_def_name or 'default')
+        key = (target_cls, view_def_name)
+        plan = cls._cache.get(key, None)
+        if plan is None or plan.source is not view_def:
+            plan = cls._cache[key] = cls(target_cls, view_def_name, view_def)
+        return plan
+
+    @staticmethod
+    def _compile_step(
+            tables, view_def_name, my_typename, name, spec, known):
+        if type(spec) is list:
+            if not spec:
+                spec = [True]
+            assert len(spec) == 1,\
+                "in viewdef %s, class %s, name %s, len(list) > 1" % (
+                    view_def_name, my_typename, name)
+            subspec = spec[0]
+        elif type(spec) is dict:
+            assert len(spec) == 1,\
+                "in viewdef %s, class %s, name %s, len(dict) > 1" % (
+                    view_def_name, my_typename, name)
+            assert "@id" in spec,\
+                "in viewdef %s, class %s, name %s, key should be '@id'" % (
+                    view_def_name, my_typename, name)
+            subspec = spec["@id"]
+        else:
+            subspec = spec
+        if subspec is True:
+            prop_name = name
+            view_name = None
+        else:
+            assert isinstance(subspec, types.StringTypes),\
+                "in viewdef %s, class %s, name %s, spec not a string" % (
+                    view_def_name, my_typename, name)
+            if subspec[0] == "'":
+                # literals.
+                literal_json = subspec[1:]
+                literal = loads(literal_json)
+                if isinstance(literal, (list, dict)):
+                    # mutable: give each result its own copy
+                    def literal_step(self, result, *args):
+                        result[name] = loads(literal_json)
+                else:
+                    def literal_step(self, result, *args):
+                        result[name] = literal
+                return literal_step
+            if ':' in subspec:
+                prop_name, view_name = subspec.split(':', 1)
+                if not view_name:
+                    view_name = view_def_name
+                if not prop_name:
+                    prop_name = name
+            else:
+                prop_name = subspec
+                view_name = None
+        if view_name:
+            assert get_view_def(view_name),\
+                "in viewdef %s, class %s, name %s, unknown viewdef %s" % (
+                    view_def_name, my_typename, name, view_name)
+
+        def value_step(self, result, user_id, permissions, base_uri):
+            val = getattr(self, prop_name)
+            if val is not None and type(val) not in _JSON_SCALAR_TYPES:
+                val = _translate_to_json(
+                    val, view_name, user_id, permissions, base_uri)
+            if val is not None:
+                result[name] = val
+
+        if prop_name == 'self':
+            if view_name:
+                def self_step(self, result, user_id, permissions, base_uri):
+                    r = self.generic_json(
+                        view_name, user_id, permissions, base_uri)
+                    if r is not None:
+                        result[name] = r
+            else:
+                def self_step(self, result, *args):
+                    result[name] = self.uri()
+            return self_step
+        elif prop_name == '@view':
+            def view_name_step(self, result, *args):
+                result[name] = view_def_name
+            return view_name_step
+        elif prop_name[0] == '&':
+            prop_name = prop_name[1:]
+            assert prop_name in tables.methods,\
+                "in viewdef %s, class %s, name %s, unknown method %s" % (
+                    view_def_name, my_typename, name, prop_name)
+
+            # Function call. PLEASE RETURN JSON, Base objects,
+            # or list or dicts thereof
+            def method_step(self, result, user_id, permissions, base_uri):
+                val = getattr(self, prop_name)()
+                result[name] = _translate_to_json(
+                    val, view_name, user_id, permissions, base_uri)
+            return method_step
+        elif prop_name in tables.cols:
+            assert not view_name,\
+                "in viewdef %s, class %s, viewdef for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            assert not isinstance(spec, list),\
+                "in viewdef %s, class %s, list for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            assert not isinstance(spec, dict),\
+                "in viewdef %s, class %s, dict for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            known.add(prop_name)
+            return value_step
+        elif prop_name in tables.properties:
+            known.add(prop_name)
+            if view_name or (prop_name not in tables.fkey_of_reln) or (
+                    tables.relns[prop_name].direction != MANYTOONE):
+                return value_step
+            fkeys = list(tables.fkey_of_reln[prop_name])
+            assert(len(fkeys) == 1)
+            fkey_name = fkeys[0].key
+            target_cls = tables.relns[prop_name].mapper.class_
+
+            def fkey_step(self, result, *args):
+                result[name] = target_cls.uri_generic(
+                    getattr(self, fkey_name))
+            return fkey_step
+        assert prop_name in tables.relns,\
+                "in viewdef %s, class %s, prop_name %s not a column, property or relation" % (
+                    view_def_name, my_typename, prop_name)
+        known.add(prop_name)
+        # Add derived prop?
+        reln = tables.relns[prop_name]
+        if reln.uselist:
+            if view_name:
+                if isinstance(spec, dict):
+                    def reln_step(self, result, user_id, permissions,
+                                  base_uri):
+                        result[name] = {
+                            ob.uri(base_uri): json
+                            for (ob, json) in BaseOps.generic_json_list(
+                                getattr(self, prop_name), view_name,
+                                user_id, permissions, base_uri)}
+                else:
+                    def reln_step(self, result, user_id, permissions,
+                                  base_uri):
+                        result[name] = [
+                            json for (ob, json) in BaseOps.generic_json_list(
+                                getattr(self, prop_name), view_name,
+                                user_id, permissions, base_uri)]
+            else:
+                assert not isinstance(spec, dict),\
+                    "in viewdef %s, class %s, dict without viewname for %s" % (
+                        view_def_name, my_typename, name)
+
+                def reln_step(self, result, user_id, permissions, base_uri):
+                    result[name] = [
+                        ob.uri(base_uri) for ob in BaseOps.filter_user_can(
+                            getattr(self, prop_name), user_id,
+                            CrudPermissions.READ, permissions)]
+            return reln_step
+        assert not isinstance(spec, dict),\
+            "in viewdef %s, class %s, dict for non-list relation %s" % (
+                view_def_name, my_typename, prop_name)
+        as_list = isinstance(spec, list)
+        if view_name:
+            def reln_step(self, result, user_id, permissions, base_uri):
+                ob = getattr(self, prop_name)
+                if ob and ob.user_can(
+                        user_id, CrudPermissions.READ, permissions):
+                    val = ob.generic_json(
+                        view_name, user_id, permissions, base_uri)
+                    if val is not None:
+                        result[name] = [val] if as_list else val
+                else:
+                    result[name] = [] if as_list else None
+            return reln_step
+        if len(reln._calculated_foreign_keys) == 1 \
+                and reln._calculated_foreign_keys < tables.fkeys:
+            # shortcut, avoid fetch
+            fkey_name = list(reln._calculated_foreign_keys)[0].name
+            target_cls = reln.mapper.class_
+
+            def reln_step(self, result, user_id, permissions, base_uri):
+                ob_id = getattr(self, fkey_name)
+                uri = target_cls.uri_generic(ob_id, base_uri) \
+                    if ob_id else None
+                if uri:
+                    result[name] = [uri] if as_list else uri
+                else:
+                    result[name] = [] if as_list else None
+        else:
+            def reln_step(self, result, user_id, permissions, base_uri):
+                ob = getattr(self, prop_name)
+                uri = ob.uri(base_uri) if ob else None
+                if uri:
+                    result[name] = [uri] if as_list else uri
+                else:
+                    result[name] = [] if as_list else None
+        return reln_step
+
+    @staticmethod
+    def _compile_defaults(tables, known):
+        """List the (name, column key, relation target class) of columns
+        that are not covered by the view_def."""
+        defaults = []
+        for name, col in tables.cols.items():
+            if name in known:
+                continue  # already done
+            as_rel = tables.reln_of_fkeys.get(frozenset((col, )))
+            if as_rel:
+                if as_rel.key in known:
+                    continue
+                defaults.append((as_rel.key, col.key, as_rel.mapper.class_))
+            else:
+                defaults.append((name, name, None))
+        return defaults
+
+    def apply(self, ob, user_id, permissions, base_uri):
+        result = {}
+        for step in self.steps:
+            step(ob, result, user_id, permissions, base_uri)
+        if self.defaults is not None:
+            for name, col_key, target_cls in self.defaults:
+                val = getattr(ob, col_key)
+                if target_cls is not None:
+                    result[name] = target_cls.uri_generic(
+                        val, base_uri) if val else None
+                elif val:
+                    if type(val) == datetime:
+                        val = val.isoformat() + "Z"
+                    result[name] = val
+                else:
+                    result[name] = None
+        return result
+
+
+
 class BaseOps(object):
     """Base class for SQLAlchemy models in Assembl.
 
@@ -587,263 +928,37 @@ class BaseOps(object):
         user_id = user_id or Everyone
         if not self.user_can(user_id, CrudPermissions.READ, permissions):
             return None
-        view_def = get_view_def(view_def_name or 'default')
-        my_typename = self.external_typename()
-        result = {}
-        local_view = self.expand_view_def(view_def)
-        if not local_view:
+        return self._apply_json_plan(
+            view_def_name, user_id, permissions, base_uri)
+
+    def _apply_json_plan(self, view_def_name, user_id, permissions, base_uri):
+        plan = _JsonPlan.get(self.__class__, view_def_name)
+        if plan.steps is None:
             return None
-        mapper = self.__class__.__mapper__
-        relns = {r.key: r for r in mapper.relationships}
-        cols = {c.key: c for c in mapper.columns}
-        fkeys = {c for c in mapper.columns if c.foreign_keys}
-        reln_of_fkeys = {
-            frozenset(r._calculated_foreign_keys): r
-            for r in mapper.relationships
-        }
-        fkey_of_reln = {r.key: r._calculated_foreign_keys
-                        for r in mapper.relationships}
-        methods = dict(pyinspect.getmembers(
-            self.__class__, lambda m: pyinspect.ismethod(m)
-            and m.func_code.co_argcount == 1))
-        properties = dict(pyinspect.getmembers(
-            self.__class__, lambda p: pyinspect.isdatadescriptor(p)))
-        known = set()
-        for name, spec in local_view.iteritems():
-            if name == "_default":
-                continue
-            elif spec is False:
-                known.add(name)
-                continue
-            elif type(spec) is list:
-                if not spec:
-                    spec = [True]
-                assert len(spec) == 1,\
-                    "in viewdef %s, class %s, name %s, len(list) > 1" % (
-                        view_def_name, my_typename, name)
-                subspec = spec[0]
-            elif type(spec) is dict:
-                assert len(spec) == 1,\
-                    "in viewdef %s, class %s, name %s, len(dict) > 1" % (
-                        view_def_name, my_typename, name)
-                assert "@id" in spec,\
-                    "in viewdef %s, class %s, name %s, key should be '@id'" % (
-                        view_def_name, my_typename, name)
-                subspec = spec["@id"]
-            else:
-                subspec = spec
-            if subspec is True:
-                prop_name = name
-                view_name = None
-            else:
-                assert isinstance(subspec, types.StringTypes),\
-                    "in viewdef %s, class %s, name %s, spec not a string" % (
-                        view_def_name, my_typename, name)
-                if subspec[0] == "'":
-                    # literals.
-                    result[name] = loads(subspec[1:])
-                    continue
-                if ':' in subspec:
-                    prop_name, view_name = subspec.split(':', 1)
-                    if not view_name:
-                        view_name = view_def_name
-                    if not prop_name:
-                        prop_name = name
-                else:
-                    prop_name = subspec
-                    view_name = None
-            if view_name:
-                assert get_view_def(view_name),\
-                    "in viewdef %s, class %s, name %s, unknown viewdef %s" % (
-                        view_def_name, my_typename, name, view_name)
-            #print prop_name, name, view_name
-
-            def translate_to_json(v):
-                if isinstance(v, Base):
-                    p = getattr(v, 'user_can', None)
-                    if p and not v.user_can(
-                            user_id, CrudPermissions.READ, permissions):
-                        return None
-                    if view_name:
-                        return v.generic_json(
-                            view_name, user_id, permissions, base_uri)
-                    else:
-                        return v.uri(base_uri)
-                elif isinstance(v, (
-                        str, unicode, int, long, float, bool, types.NoneType)):
-                    return v
-                elif isinstance(v, EnumSymbol):
-                    return v.name
-                elif isinstance(v, datetime):
-                    return v.isoformat() + "Z"
-                elif isinstance(v, dict):
-                    v = {translate_to_json(k): translate_to_json(val)
-                         for k, val in v.items()}
-                    return {k: val for (k, val) in v.items()
-                            if val is not None}
-                elif isinstance(v, Iterable):
-                    v = [translate_to_json(i) for i in v]
-                    return [x for x in v if x is not None]
-                else:
-                    raise NotImplementedError("Cannot translate", v)
+        return plan.apply(self, user_id, permissions, base_uri)
 
-            if prop_name == 'self':
-                if view_name:
-                    r = self.generic_json(
-                        view_name, user_id, permissions, base_uri)
-                    if r is not None:
-                        result[name] = r
-                else:
-                    result[name] = self.uri()
-                continue
-            elif prop_name == '@view':
-                result[name] = view_def_name
-                continue
-            elif prop_name[0] == '&':
-                prop_name = prop_name[1:]
-                assert prop_name in methods,\
-                    "in viewdef %s, class %s, name %s, unknown method %s" % (
-                        view_def_name, my_typename, name, prop_name)
-                # Function call. PLEASE RETURN JSON, Base objects,
-                # or list or dicts thereof
-                val = getattr(self, prop_name)()
-                result[name] = translate_to_json(val)
-                continue
-            elif prop_name in cols:
-                assert not view_name,\
-                    "in viewdef %s, class %s, viewdef for literal property %s" % (
-                        view_def_name, my_typename, prop_name)
-                assert not isinstance(spec, list),\
-                    "in viewdef %s, class %s, list for literal property %s" % (
-                        view_def_name, my_typename, prop_name)
-                assert not isinstance(spec, dict),\
-                    "in viewdef %s, class %s, dict for literal property %s" % (
-                        view_def_name, my_typename, prop_name)
-                known.add(prop_name)
-                val = getattr(self, prop_name)
-                if val is not None:
-                    val = translate_to_json(val)
-                if val is not None:
-                    result[name] = val
-                continue
-            elif prop_name in properties:
-                known.add(prop_name)
-                if view_name or (prop_name not in fkey_of_reln) or (
-                        relns[prop_name].direction != MANYTOONE):
-                    val = getattr(self, prop_name)
-                    if val is not None:
-                        val = translate_to_json(val)
-                    if val is not None:
-                        result[name] = val
-                else:
-                    fkeys = list(fkey_of_reln[prop_name])
-                    assert(len(fkeys) == 1)
-                    fkey = fkeys[0]
-                    result[name] = relns[prop_name].mapper.class_.uri_generic(
-                        getattr(self, fkey.key))
+    @staticmethod
+    def generic_json_list(
+            instances, view_def_name='default', user_id=None,
+            permissions=(P_READ, ), base_uri='local:'):
+        """Return (instance, json) pairs for the instances the user can read.
 
-                continue
-            assert prop_name in relns,\
-                    "in viewdef %s, class %s, prop_name %s not a column, property or relation" % (
-                        view_def_name, my_typename, prop_name)
-            known.add(prop_name)
-            # Add derived prop?
-            reln = relns[prop_name]
-            if reln.uselist:
-                vals = getattr(self, prop_name)
-                if view_name:
-                    if isinstance(spec, dict):
-                        result[name] = {
-                            ob.uri(base_uri):
-                            ob.generic_json(
-                                view_name, user_id, permissions, base_uri)
-                            for ob in vals
-                            if ob.user_can(
-                                user_id, CrudPermissions.READ, permissions)}
-                    else:
-                        result[name] = [
-                            ob.generic_json(
-                                view_name, user_id, permissions, base_uri)
-                            for ob in vals
-                            if ob.user_can(
-                                user_id, CrudPermissions.READ, permissions)]
-                else:
-                    assert not isinstance(spec, dict),\
-                        "in viewdef %s, class %s, dict without viewname for %s" % (
-                            view_def_name, my_typename, name)
-                    result[name] = [
-                        ob.uri(base_uri) for ob in vals
-                        if ob.user_can(
-                            user_id, CrudPermissions.READ, permissions)]
-                continue
-            assert not isinstance(spec, dict),\
-                "in viewdef %s, class %s, dict for non-list relation %s" % (
-                    view_def_name, my_typename, prop_name)
-            if view_name:
-                ob = getattr(self, prop_name)
-                if ob and ob.user_can(
-                        user_id, CrudPermissions.READ, permissions):
-                    val = ob.generic_json(
-                        view_name, user_id, permissions, base_uri)
-                    if val is not None:
-                        if isinstance(spec, list):
-                            result[name] = [val]
-                        else:
-                            result[name] = val
-                else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
+        The json of an instance may be None, as with :py:meth:`generic_json`.
+        Access is checked in bulk by :py:meth:`filter_user_can`, and not
+        again for each instance."""
+        user_id = user_id or Everyone
+        instances = BaseOps.filter_user_can(
+            instances, user_id, CrudPermissions.READ, permissions)
+        result = []
+        for instance in instances:
+            if instance.__class__.generic_json.__func__ is \
+                    BaseOps.generic_json.__func__:
+                json = instance._apply_json_plan(
+                    view_def_name, user_id, permissions, base_uri)
             else:
-                uri = None
-                if len(reln._calculated_foreign_keys) == 1 \
-                        and reln._calculated_foreign_keys < fkeys:
-                    # shortcut, avoid fetch
-                    fkey = list(reln._calculated_foreign_keys)[0]
-                    ob_id = getattr(self, fkey.name)
-                    if ob_id:
-                        uri = reln.mapper.class_.uri_generic(
-                            ob_id, base_uri)
-                else:
-                    ob = getattr(self, prop_name)
-                    if ob:
-                        uri = ob.uri(base_uri)
-                if uri:
-                    if isinstance(spec, list):
-                        result[name] = [uri]
-                    else:
-                        result[name] = uri
-                else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
-
-        if local_view.get('_default') is not False:
-            for name, col in cols.items():
-                if name in known:
-                    continue  # already done
-                as_rel = reln_of_fkeys.get(frozenset((col, )))
-                if as_rel:
-                    name = as_rel.key
-                    if name in known:
-                        continue
-                    else:
-                        ob_id = getattr(self, col.key)
-                        if ob_id:
-                            result[name] = as_rel.mapper.class_.uri_generic(
-                                ob_id, base_uri)
-                        else:
-                            result[name] = None
-                else:
-                    ob = getattr(self, name)
-                    if ob:
-                        if type(ob) == datetime:
-                            ob = ob.isoformat() + "Z"
-                        result[name] = ob
-                    else:
-                        result[name] = None
+                json = instance.generic_json(
+                    view_def_name, user_id, permissions, base_uri)
+            result.append((instance, json))
         return result
 
     dummy_context = DummyContext()
@@ -1476,6 +1591,53 @@ class BaseOps(object):
             return False
         return self.is_owner(user_id)
 
+    @classmethod
+    def user_can_bulk(cls, user_id, operation, permissions):
+        """Whether the user can perform the given Crud operation on all
+        instances of this exact class: True, False, IF_OWNED (decided by
+        :py:meth:`is_owner`), or None if each instance has to be asked,
+        because the class overrides :py:meth:`user_can`."""
+        if cls.user_can.__func__ is not BaseOps.user_can.__func__:
+            return None
+        user_id = user_id or Everyone
+        perm = cls.crud_permissions.can(operation, permissions)
+        if perm != IF_OWNED:
+            return bool(perm)
+        if user_id == Everyone or \
+                cls.is_owner.__func__ is BaseOps.is_owner.__func__:
+            return False
+        return IF_OWNED
+
+    @staticmethod
+    def filter_user_can(instances, user_id, operation, permissions):
+        """Keep the instances on which the user, with the given permissions,
+        can perform the given Crud operation.
+
+        Gives the same result as calling :py:meth:`user_can` on each instance,
+        but the decision is taken once per class with
+        :py:meth:`user_can_bulk`. When the instances come from a query,
+        prefer :py:meth:`restrict_to_owners` on that query."""
+        user_id = user_id or Everyone
+        decisions = {}
+        result = []
+        for instance in instances:
+            cls = instance.__class__
+            if cls in decisions:
+                decision = decisions[cls]
+            else:
+                decision = decisions[cls] = cls.user_can_bulk(
+                    user_id, operation, permissions)
+            if decision is True:
+                result.append(instance)
+            elif decision is False:
+                continue
+            elif decision == IF_OWNED:
+                if instance.is_owner(user_id):
+                    result.append(instance)
+            elif instance.user_can(user_id, operation, permissions):
+                result.append(instance)
+        return result
+
 
 class Timestamped(BaseOps):
     """An automatically timestamped mixin. Not used."""
@@ -1641,24 +1803,27 @@ def before_commit_listener(session):
         changes = defaultdict(list)
         for ((uri, view_def), (discussion, target)) in \
                 info['cdict'].iteritems():
-            discussion = bytes(discussion or "*")
             json = target.generic_json(view_def)
             if json:
-                changes[discussion].append(json)
+                if '@private' in json:
+                    # Private changes go to the topic of their user only
+                    topic = changes_topic(
+                        discussion or "*", json['@private'] or '')
+                else:
+                    topic = changes_topic(discussion or "*")
+                changes[topic].append(json)
         del info['cdict']
         session.cdict2 = changes
-    else:
-        print "EMPTY CDICT!"
 
 
 def after_commit_listener(session):
-    """After commit, actually send the Json representation of changed objects
-    to the :py:mod:`assembl.tasks.changes_router`, through 0MQ."""
-    if not getattr(session, 'zsocket', None):
-        session.zsocket = get_pub_socket()
+    """After commit, hand the Json representation of changed objects
+    to the changes publisher, which will send them to the
+    :py:mod:`assembl.tasks.changes_router` through 0MQ."""
     if getattr(session, 'cdict2', None):
-        for discussion, changes in session.cdict2.iteritems():
-            send_changes(session.zsocket, discussion, changes)
+        publisher = get_publisher()
+        for topic, changes in session.cdict2.iteritems():
+            publisher.publish(topic, changes)
         del session.cdict2
 
 
@@ -1731,6 +1896,27 @@ def mark_changed(session=None):
     z_mark_changed(session)
 
 
+def increment_counter(connection, table, key, delta, column='value'):
+    """Add delta to a counter column of the table, in the row identified
+    by the primary key values in key; the row is created if needed."""
+    pk_columns = list(table.primary_key.columns)
+    condition = and_(*[c == v for (c, v) in zip(pk_columns, key)])
+    update = table.update().where(condition).values(
+        {column: table.c[column] + delta})
+    if connection.execute(update).rowcount:
+        return
+    savepoint = connection.begin_nested()
+    try:
+        values = {c.name: v for (c, v) in zip(pk_columns, key)}
+        values[column] = delta
+        connection.execute(table.insert().values(**values))
+        savepoint.commit()
+    except IntegrityError:
+        # Inserted concurrently
+        savepoint.rollback()
+        connection.execute(update)
+
+
 def get_metadata():
     global _metadata
     return _metadata
@@ -2,6 +2,8 @@
 import re
 import unidecode
 import inspect
+import logging
+from os.path import join, dirname
 from time import sleep
 from StringIO import StringIO
 
@@ -113,3 +115,21 @@ def waiting_get(cls, id, lock=False):
             return objectInstance
         sleep(wait_time)
         wait_time *= 1.5
+
+
+def get_shared_cache_region(name):
+    """Get a dogpile cache region configured like the default one,
+    suitable to share data between processes. None if unavailable."""
+    from pyramid_dogpile_cache import (
+        get_region, build_dogpile_region_settings_from_settings)
+    try:
+        settings = config.get_config()
+        default_settings, _ = \
+            build_dogpile_region_settings_from_settings(settings)
+        fname = settings.get('dogpile_cache.arguments.filename')
+        if fname:
+            default_settings['arguments.filename'] = join(
+                dirname(dirname(dirname(__file__))), fname)
+        return get_region(name, **default_settings)
+    except Exception as e:
+        logging.getLogger('assembl').error(e)
@@ -1,21 +1,54 @@
-"""ZMQ setup for the changes socket"""
+"""ZMQ setup for the changes socket
+
+Changes are published by a per-process :py:class:`ChangesPublisher`,
+which coalesces the changes of successive transactions in short
+time windows, so that an object modified many times is sent only once.
+
+Each message has three frames: the topic, an order number, optionally
+followed by ``/msgpack`` if the payload is encoded with msgpack_ rather
+than JSON, and the list of changes.
+Public changes of a discussion go to the ``d:<discussion_id>;`` topic,
+while changes that are private to a user (marked with ``@private``) go
+to the ``u:<user uri>;d:<discussion_id>;`` topic, so that subscribers
+only receive what they may see. See :py:func:`changes_topic`.
+
+.. _msgpack: http://msgpack.org/
+"""
 import atexit
+import os
+import logging
 from itertools import count
+from collections import OrderedDict
+from threading import Thread, Condition
+from time import time
 
 import zmq
 import zmq.devices
 from time import sleep
+import simplejson as json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 context = zmq.Context.instance()
+log = logging.getLogger('assembl')
 
 INTERNAL_SOCKET = 'inproc://assemblchanges'
 CHANGES_SOCKET = None
 MULTIPLEX = True
 INITED = False
 DISPATCHER = None
+# How long we wait for changes to coalesce, in seconds
+BATCH_WINDOW = 0.05
+# Send a batch early if it reaches this size
+MAX_BATCH_SIZE = 500
+ENCODING = 'json'
 
 _counter = count()
 _active_sockets = []
+_publisher = None
 
 
 def start_dispatch_thread():
@@ -37,6 +70,8 @@ def start_dispatch_thread():
 def stop_sockets():
     #print "STOPPING SOCKETS"
     global CHANGES_SOCKET, MULTIPLEX, INITED, DISPATCHER
+    if _publisher is not None:
+        _publisher.close()
     for socket in _active_sockets:
         socket.close()
     INITED = False
@@ -51,30 +86,202 @@ def get_pub_socket():
     else:
         socket.connect(CHANGES_SOCKET)
     _active_sockets.append(socket)
-    # Related to "slow joiner" symptom
-    # http://zguide.zeromq.org/page:all#Getting-the-Message-Out
-    # It would be better to get the "ready" signal back but this is
-    # adequate for now.
-    sleep(0.2)
     return socket
 
 
-def send_changes(socket, discussion, changeset):
-    order = _counter.next()
-    socket.send(discussion, zmq.SNDMORE)
-    socket.send(str(order), zmq.SNDMORE)
-    socket.send_json(changeset)
-    print "sent", order, discussion, changeset
+def changes_topic(discussion, user_uri=None):
+    """The topic of changes for a discussion ("*" for all discussions),
+    private to a given user if specified"""
+    topic = "d:%s;" % (discussion,)
+    if user_uri is not None:
+        topic = "u:%s;%s" % (user_uri, topic)
+    return bytes(topic)
+
+
+def parse_changes_topic(topic):
+    """Parse a topic into a (discussion, user_uri) pair"""
+    user_uri = None
+    if topic.startswith('u:'):
+        user_uri, topic = topic[2:].split(';', 1)
+    return topic[2:-1], user_uri
+
+
+def encode_changes(changeset, encoding=None):
+    """Encode a list of changes as the (order, payload) frames"""
+    encoding = encoding or ENCODING
+    order = str(_counter.next())
+    if encoding == 'msgpack':
+        return (order + '/msgpack', msgpack.packb(changeset))
+    return (order, json.dumps(changeset, separators=(',', ':')))
+
+
+def decode_changes(frames):
+    """Decode the list of changes in a (topic, order, payload) message"""
+    if frames[-2].endswith('/msgpack'):
+        return msgpack.unpackb(frames[-1], encoding='utf-8')
+    return json.loads(frames[-1])
+
+
+def changes_as_json(frames):
+    """Give the list of changes in a message as JSON text"""
+    if frames[-2].endswith('/msgpack'):
+        return json.dumps(decode_changes(frames), separators=(',', ':'))
+    return frames[-1]
+
+
+def send_changes(socket, topic, changeset, encoding=None):
+    order, payload = encode_changes(changeset, encoding)
+    socket.send_multipart([topic, order, payload])
+
+
+class ChangesPublisher(object):
+    """Coalesces changes in time windows and publishes them on the
+    changes socket, from a single thread that owns the socket.
+
+    Changes to the same object (same @id and @view) within a window
+    are replaced by the latest. The ``stats`` attribute gives counters
+    of batch sizes and latency (time from the first change in a batch
+    to its sending, in seconds)."""
+
+    def __init__(self, window=None, max_batch_size=None, encoding=None):
+        self.window = BATCH_WINDOW if window is None else window
+        self.max_batch_size = max_batch_size or MAX_BATCH_SIZE
+        self.encoding = encoding or ENCODING
+        self.pid = os.getpid()
+        self.condition = Condition()
+        self.pending = OrderedDict()  # topic -> OrderedDict(key->json)
+        self.pending_count = 0
+        self.first_change_time = None
+        self.closing = False
+        self.socket = None
+        self.stats = {
+            "changes_received": 0,
+            "changes_sent": 0,
+            "batches_sent": 0,
+            "messages_sent": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "total_latency": 0.0,
+            "max_latency": 0.0,
+        }
+        self.thread = Thread(target=self.run, name="changes_publisher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def publish(self, topic, changes):
+        """Queue a list of changes (JSON objects) for a topic"""
+        if not changes:
+            return
+        with self.condition:
+            if self.closing:
+                return
+            by_key = self.pending.get(topic, None)
+            if by_key is None:
+                by_key = self.pending[topic] = OrderedDict()
+            for change in changes:
+                key = (change.get('@id', None), change.get('@view', None))
+                if key[0] is None:
+                    key = id(change)
+                else:
+                    # keep the order of the latest change
+                    by_key.pop(key, None)
+                by_key[key] = change
+            self.stats["changes_received"] += len(changes)
+            self.pending_count = sum(len(x) for x in self.pending.values())
+            if self.first_change_time is None:
+                self.first_change_time = time()
+            self.condition.notify()
+
+    def _take_batch(self):
+        """Wait for a full window (or batch) and take the pending changes"""
+        with self.condition:
+            while not self.pending and not self.closing:
+                self.condition.wait()
+            deadline = (self.first_change_time or time()) + self.window
+            while not self.closing and \
+                    self.pending_count < self.max_batch_size:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch, first_change_time = self.pending, self.first_change_time
+            self.pending = OrderedDict()
+            self.pending_count = 0
+            self.first_change_time = None
+            return batch, first_change_time
+
+    def run(self):
+        self.socket = get_pub_socket()
+        while True:
+            batch, first_change_time = self._take_batch()
+            if batch:
+                self._send_batch(batch, first_change_time)
+            elif self.closing:
+                break
+
+    def _send_batch(self, batch, first_change_time):
+        size = 0
+        for topic, by_key in batch.iteritems():
+            changes = by_key.values()
+            size += len(changes)
+            try:
+                send_changes(self.socket, topic, changes, self.encoding)
+                self.stats["messages_sent"] += 1
+            except Exception as e:
+                log.error("Could not send changes: %s" % (e,))
+        latency = time() - first_change_time
+        stats = self.stats
+        stats["changes_sent"] += size
+        stats["batches_sent"] += 1
+        stats["last_batch_size"] = size
+        stats["max_batch_size"] = max(stats["max_batch_size"], size)
+        stats["total_latency"] += latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        batches = stats["batches_sent"]
+        stats["mean_batch_size"] = (
+            float(stats["changes_sent"]) / batches if batches else 0)
+        stats["mean_latency"] = (
+            stats["total_latency"] / batches if batches else 0)
+        return stats
+
+    def close(self, timeout=2):
+        """Send pending changes and stop the publishing thread"""
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        if self.pid == os.getpid():
+            self.thread.join(timeout)
+
+
+def get_publisher():
+    """The changes publisher of this process"""
+    global _publisher
+    # Do not reuse the publishing thread of a parent process.
+    if _publisher is None or _publisher.pid != os.getpid():
+        _publisher = ChangesPublisher()
+    return _publisher
 
 
-def configure_zmq(sockdef, multiplex):
-    global CHANGES_SOCKET, MULTIPLEX
+def configure_zmq(sockdef, multiplex, batch_window=None, encoding=None):
+    global CHANGES_SOCKET, MULTIPLEX, BATCH_WINDOW, ENCODING
     assert isinstance(sockdef, str)
     CHANGES_SOCKET = sockdef
     MULTIPLEX = multiplex
+    if batch_window is not None:
+        BATCH_WINDOW = float(batch_window)
+    if encoding:
+        if encoding == 'msgpack' and msgpack is None:
+            log.error("msgpack is not installed, using json for changes")
+            encoding = 'json'
+        ENCODING = encoding
 
 
 def includeme(config):
     settings = config.registry.settings
     configure_zmq(settings['changes.socket'],
-                  settings['changes.multiplex'])
+                  settings['changes.multiplex'],
+                  settings.get('changes.batch_window', None),
+                  settings.get('changes.encoding', None))
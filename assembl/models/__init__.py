@@ -119,6 +119,7 @@ from .langstrings import (
     LocaleLabel,
     LangString,
     LangStringEntry,
+    TranslationMemory,
 )
 from .discussion import Discussion
 from .user_key_values import (
@@ -170,6 +171,10 @@ from .action import (
     ViewIdea,
     ViewPost,
 )
+from .analytics import (
+    AnalyticsAgentActivity,
+    AnalyticsRollup,
+)
 from .idea_content_link import (
     Extract,
     IdeaContentLink,
@@ -200,6 +205,8 @@ from .votes import (
     TokenCategorySpecification,
     TokenIdeaVote,
     TokenVoteSpecification,
+    VoteSpecVoter,
+    VoteValueCount,
 )
 from .annotation import (
     Webpage,
@@ -285,6 +292,10 @@ from .announcement import (
     Announcement,
     IdeaAnnouncement,
 )
+from .path_utils import (
+    DiscussionGlobalData,
+    discussion_structure_cache,
+)
 
 
 def includeme(config):
@@ -0,0 +1,333 @@
+"""Pre-aggregated discussion analytics, by hourly bucket.
+
+Counters are updated in the same flush as the posts, views and visits
+they summarize, so time series are answered by merging buckets instead
+of scanning those tables."""
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    DateTime,
+    ForeignKey,
+    event,
+    func,
+)
+from sqlalchemy.orm import attributes
+from sqlalchemy.orm.session import Session
+
+from . import Base
+from ..lib.sqla import increment_counter
+from .auth import AgentProfile, AgentStatusInDiscussion
+from .discussion import Discussion
+from .generic import Content
+from .post import Post
+from .action import ViewPost
+
+
+def bucket_of(date):
+    """The hourly bucket of a date."""
+    return date.replace(minute=0, second=0, microsecond=0)
+
+
+class AnalyticsRollup(Base):
+    """The number of agents whose visit or subscription dates
+    fall in each hourly bucket of a discussion"""
+    __tablename__ = 'analytics_rollup'
+
+    discussion_id = Column(Integer, ForeignKey(
+        Discussion.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    metric = Column(String(32), primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+    # The AgentStatusInDiscussion dates that are counted
+    METRICS = (
+        'first_visit', 'last_visit', 'first_subscribed', 'last_unsubscribed')
+
+
+class AnalyticsAgentActivity(Base):
+    """The number of posts or post views by an agent
+    in each hourly bucket of a discussion"""
+    __tablename__ = 'analytics_agent_activity'
+
+    discussion_id = Column(Integer, ForeignKey(
+        Discussion.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    kind = Column(String(8), primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    agent_id = Column(Integer, ForeignKey(
+        AgentProfile.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+    KINDS = ('post', 'view')
+
+
+def _record(session, cls, key, delta):
+    if session is None or key[2] is None:
+        return
+    deltas = session.info.setdefault('analytics_deltas', defaultdict(int))
+    deltas[(cls.__tablename__, key)] += delta
+
+
+def _record_post(mapper, connection, target, delta):
+    _record(attributes.instance_state(target).session, AnalyticsAgentActivity,
+            (target.discussion_id, 'post', target.creation_date and
+             bucket_of(target.creation_date), target.creator_id), delta)
+
+
+def _record_view(mapper, connection, target, delta):
+    _record(attributes.instance_state(target).session, AnalyticsAgentActivity,
+            (target.post.discussion_id, 'view', target.creation_date and
+             bucket_of(target.creation_date), target.actor_id), delta)
+
+
+def _value_before_flush(target, name):
+    history = attributes.get_history(target, name)
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(target, name)
+
+
+def _record_status(target, metric, date, delta):
+    _record(attributes.instance_state(target).session, AnalyticsRollup,
+            (target.discussion_id, metric, date and bucket_of(date)), delta)
+
+
+@event.listens_for(Post, 'after_insert', propagate=True)
+def post_insert_listener(mapper, connection, target):
+    _record_post(mapper, connection, target, 1)
+
+
+@event.listens_for(Post, 'after_delete', propagate=True)
+def post_delete_listener(mapper, connection, target):
+    _record_post(mapper, connection, target, -1)
+
+
+@event.listens_for(Post, 'after_update', propagate=True)
+def post_update_listener(mapper, connection, target):
+    discussion_id, creation_date, creator_id = [
+        _value_before_flush(target, name)
+        for name in ('discussion_id', 'creation_date', 'creator_id')]
+    if (discussion_id, creation_date, creator_id) == (
+            target.discussion_id, target.creation_date, target.creator_id):
+        return
+    session = attributes.instance_state(target).session
+    _record(session, AnalyticsAgentActivity,
+            (discussion_id, 'post', creation_date and
+             bucket_of(creation_date), creator_id), -1)
+    _record_post(mapper, connection, target, 1)
+    if discussion_id != target.discussion_id:
+        # Its views move to the other discussion
+        for (actor_id, date) in session.query(
+                ViewPost.actor_id, ViewPost.creation_date).filter(
+                ViewPost.post_id == target.id):
+            bucket = date and bucket_of(date)
+            _record(session, AnalyticsAgentActivity,
+                    (discussion_id, 'view', bucket, actor_id), -1)
+            _record(session, AnalyticsAgentActivity,
+                    (target.discussion_id, 'view', bucket, actor_id), 1)
+
+
+@event.listens_for(ViewPost, 'after_insert', propagate=True)
+def view_insert_listener(mapper, connection, target):
+    _record_view(mapper, connection, target, 1)
+
+
+@event.listens_for(ViewPost, 'after_delete', propagate=True)
+def view_delete_listener(mapper, connection, target):
+    _record_view(mapper, connection, target, -1)
+
+
+@event.listens_for(AgentStatusInDiscussion, 'after_insert', propagate=True)
+def status_insert_listener(mapper, connection, target):
+    for metric in AnalyticsRollup.METRICS:
+        _record_status(target, metric, getattr(target, metric), 1)
+
+
+@event.listens_for(AgentStatusInDiscussion, 'after_update', propagate=True)
+def status_update_listener(mapper, connection, target):
+    for metric in AnalyticsRollup.METRICS:
+        history = attributes.get_history(target, metric)
+        if not history.has_changes():
+            continue
+        for date in history.deleted or ():
+            _record_status(target, metric, date, -1)
+        for date in history.added or ():
+            _record_status(target, metric, date, 1)
+
+
+@event.listens_for(AgentStatusInDiscussion, 'after_delete', propagate=True)
+def status_delete_listener(mapper, connection, target):
+    for metric in AnalyticsRollup.METRICS:
+        _record_status(target, metric, getattr(target, metric), -1)
+
+
+_tables = {cls.__tablename__: cls.__table__
+           for cls in (AnalyticsRollup, AnalyticsAgentActivity)}
+
+
+def apply_analytics_deltas(session, flush_context):
+    deltas = session.info.pop('analytics_deltas', None)
+    if not deltas:
+        return
+    connection = session.connection()
+    # Sorted, so concurrent transactions lock rows in the same order
+    for (tablename, key), delta in sorted(deltas.iteritems()):
+        if delta:
+            increment_counter(connection, _tables[tablename], key, delta)
+
+
+def forget_analytics_deltas(session):
+    session.info.pop('analytics_deltas', None)
+
+
+event.listen(Session, 'after_flush', apply_analytics_deltas)
+event.listen(Session, 'after_rollback', forget_analytics_deltas)
+
+
+def rebuild_analytics(db, discussion_id=None):
+    """Recompute the analytics buckets from posts, views and visits."""
+    deltas = defaultdict(int)
+    posts = db.query(
+        Post.discussion_id, Post.creator_id, Post.creation_date)
+    views = db.query(
+        Content.discussion_id, ViewPost.actor_id, ViewPost.creation_date
+        ).join(ViewPost, ViewPost.post_id == Content.id)
+    statuses = db.query(AgentStatusInDiscussion.discussion_id, *[
+        getattr(AgentStatusInDiscussion, metric)
+        for metric in AnalyticsRollup.METRICS])
+    rollups = db.query(AnalyticsRollup)
+    activities = db.query(AnalyticsAgentActivity)
+    if discussion_id:
+        posts = posts.filter(Post.discussion_id == discussion_id)
+        views = views.filter(Content.discussion_id == discussion_id)
+        statuses = statuses.filter(
+            AgentStatusInDiscussion.discussion_id == discussion_id)
+        rollups = rollups.filter_by(discussion_id=discussion_id)
+        activities = activities.filter_by(discussion_id=discussion_id)
+    for kind, query in (('post', posts), ('view', views)):
+        for (d_id, agent_id, date) in query.yield_per(10000):
+            if date is not None:
+                deltas[(AnalyticsAgentActivity.__tablename__,
+                        (d_id, kind, bucket_of(date), agent_id))] += 1
+    for row in statuses.yield_per(10000):
+        for metric, date in zip(AnalyticsRollup.METRICS, row[1:]):
+            if date is not None:
+                deltas[(AnalyticsRollup.__tablename__,
+                        (row[0], metric, bucket_of(date)))] += 1
+    rollups.delete(synchronize_session=False)
+    activities.delete(synchronize_session=False)
+    db.flush()
+    connection = db.connection()
+    for tablename, rows in (
+            (AnalyticsRollup.__tablename__, AnalyticsRollup.__table__),
+            (AnalyticsAgentActivity.__tablename__,
+             AnalyticsAgentActivity.__table__)):
+        pk_names = [c.name for c in rows.primary_key.columns]
+        values = [dict(zip(pk_names, key), value=delta)
+                  for ((name, key), delta) in deltas.iteritems()
+                  if name == tablename]
+        if values:
+            connection.execute(rows.insert(), values)
+
+
+def _fraction(numerator, denominator):
+    if not denominator:
+        return None
+    return float(numerator) / denominator
+
+
+def time_series(db, discussion_id, intervals):
+    """Analytics of a discussion over consecutive (start, end) intervals,
+    as a list of dictionaries.
+
+    Dates are counted in the interval containing their hourly bucket."""
+    if not intervals:
+        return []
+    first_start = intervals[0][0]
+    last_end = intervals[-1][1]
+    starts = [start for (start, end) in intervals]
+
+    def interval_of(bucket):
+        n = bisect_right(starts, bucket) - 1
+        if n >= 0 and bucket < intervals[n][1]:
+            return n
+
+    counts = [defaultdict(int) for _ in intervals]
+    # Visits and subscriptions
+    rollup = AnalyticsRollup
+    before = dict(db.query(rollup.metric, func.sum(rollup.value)).filter(
+        rollup.discussion_id == discussion_id,
+        rollup.bucket < first_start).group_by(rollup.metric))
+    cumulative_visitors = before.get('first_visit', 0) or 0
+    for (metric, bucket, value) in db.query(
+            rollup.metric, rollup.bucket, rollup.value).filter(
+                rollup.discussion_id == discussion_id,
+                rollup.bucket >= first_start, rollup.bucket < last_end):
+        n = interval_of(bucket)
+        if n is not None:
+            counts[n][metric] += value
+    # Posts and views
+    activity = AnalyticsAgentActivity
+    authors = [set() for _ in intervals]
+    viewers = [set() for _ in intervals]
+    for (kind, bucket, agent_id, value) in db.query(
+            activity.kind, activity.bucket, activity.agent_id,
+            activity.value).filter(
+                activity.discussion_id == discussion_id,
+                activity.value > 0,
+                activity.bucket >= first_start, activity.bucket < last_end):
+        n = interval_of(bucket)
+        if n is None:
+            continue
+        if kind == 'post':
+            counts[n]['posts'] += value
+            authors[n].add(agent_id)
+        else:
+            viewers[n].add(agent_id)
+    cumulative_posts = db.query(func.sum(activity.value)).filter(
+        activity.discussion_id == discussion_id, activity.kind == 'post',
+        activity.bucket < first_start).scalar() or 0
+    # The first post of each author
+    first_posts = sorted(bucket for (bucket,) in db.query(
+        func.min(activity.bucket)).filter(
+            activity.discussion_id == discussion_id, activity.kind == 'post',
+            activity.value > 0).group_by(activity.agent_id))
+    results = []
+    for n, (start, end) in enumerate(intervals):
+        interval_counts = counts[n]
+        cumulative_posts += interval_counts['posts']
+        cumulative_visitors += interval_counts['first_visit']
+        count_post_authors = len(authors[n])
+        cumulative_authors = bisect_left(first_posts, end)
+        results.append(dict(
+            interval_id=n + 1,
+            interval_start=start,
+            interval_end=end,
+            count_first_time_logged_in_visitors=interval_counts[
+                'first_visit'],
+            count_cumulative_logged_in_visitors=cumulative_visitors,
+            fraction_cumulative_logged_in_visitors_who_posted_in_period=(
+                _fraction(count_post_authors, cumulative_visitors)),
+            count_post_authors=count_post_authors,
+            count_cumulative_post_authors=cumulative_authors,
+            fraction_cumulative_authors_who_posted_in_period=_fraction(
+                count_post_authors, cumulative_authors),
+            count_posts=interval_counts['posts'],
+            count_cumulative_posts=cumulative_posts,
+            recruitment_count_first_visit_in_period=interval_counts[
+                'first_visit'],
+            UNRELIABLE_recruitment_count_first_subscribed_in_period=(
+                interval_counts['first_subscribed']),
+            retention_count_last_visit_in_period=interval_counts[
+                'last_visit'],
+            UNRELIABLE_retention_count_first_subscribed_in_period=(
+                interval_counts['last_unsubscribed']),
+            UNRELIABLE_count_post_viewers=len(viewers[n]),
+        ))
+    return results
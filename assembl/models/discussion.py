@@ -22,7 +22,8 @@ from sqlalchemy import (
     inspect,
 )
 from sqlalchemy.orm import (
-    relationship, join, subqueryload_all, backref)
+    relationship, join, subqueryload_all, subqueryload, backref)
+from sqlalchemy.sql.expression import case, distinct
 from sqlalchemy.exc import InvalidRequestError
 
 from assembl.lib import config
@@ -696,6 +697,67 @@ class Discussion(DiscussionBoundBase):
             query = query.filter(ViewPost.creation_date < end_date)
         return query.first()[0]
 
+    @staticmethod
+    def interval_index(column, intervals):
+        """A SQL expression giving the index of the interval that contains
+        the value of a date column, among consecutive (start, end)
+        intervals."""
+        return case([(column < end, n)
+                     for (n, (start, end)) in enumerate(intervals)])
+
+    def count_contributions_per_interval(self, intervals):
+        """The (interval index, creator_id, count) of posts in
+        consecutive (start, end) intervals, in a single query."""
+        from .post import Post
+        index = self.interval_index(
+            Post.creation_date, intervals).label('interval_index')
+        return self.db.query(
+            index, Post.creator_id, func.count(Post.id)).filter(
+                Post.discussion_id == self.id,
+                Post.tombstone_condition(),
+                Post.creation_date >= intervals[0][0],
+                Post.creation_date < intervals[-1][1]
+            ).group_by(index, Post.creator_id).all()
+
+    def count_new_visitors_per_interval(self, intervals):
+        """The number of first visits in each of consecutive
+        (start, end) intervals, as a list."""
+        from .auth import AgentStatusInDiscussion
+        first_visit = AgentStatusInDiscussion.first_visit
+        index = self.interval_index(
+            first_visit, intervals).label('interval_index')
+        counts = dict(self.db.query(
+            index, func.count(AgentStatusInDiscussion.id)).filter(
+                AgentStatusInDiscussion.discussion_id == self.id,
+                first_visit >= intervals[0][0],
+                first_visit < intervals[-1][1]).group_by(index))
+        return [counts.get(n, 0) for n in range(len(intervals))]
+
+    def count_post_viewers_per_interval(self, intervals):
+        """The number of distinct post viewers in each of consecutive
+        (start, end) intervals, as a list."""
+        from .post import Post
+        from .action import ViewPost
+        index = self.interval_index(
+            ViewPost.creation_date, intervals).label('interval_index')
+        counts = dict(self.db.query(
+            index, func.count(distinct(ViewPost.actor_id))).join(Post).filter(
+                Post.discussion_id == self.id,
+                ViewPost.creation_date >= intervals[0][0],
+                ViewPost.creation_date < intervals[-1][1]).group_by(index))
+        return [counts.get(n, 0) for n in range(len(intervals))]
+
+    def get_visitors(self, attribute="last_visit"):
+        """The (visit date, AgentProfile) of visitors, from the latest
+        visit date, with accounts preloaded."""
+        from .auth import AgentProfile, AgentStatusInDiscussion
+        date = getattr(AgentStatusInDiscussion, attribute)
+        return self.db.query(date, AgentProfile).join(
+            AgentStatusInDiscussion.agent_profile).filter(
+                AgentStatusInDiscussion.discussion_id == self.id,
+                date != None).order_by(date.desc()).options(
+                    subqueryload(AgentProfile.accounts))
+
     def as_mind_map(self):
         import pygraphviz
         from colors import hsv
@@ -1006,10 +1006,18 @@ class RootIdea(Idea):
         'polymorphic_identity': 'root_idea',
     }
 
+    def _bulk_discussion_counts(self):
+        counters = self.prepare_counters(self.discussion_id)
+        if counters.all_counted:
+            return counters.discussion_counts
+
     @property
     def num_posts(self):
         """ In the root idea, num_posts is the count of all non-deleted mesages in the discussion """
         from .post import Post
+        counts = self._bulk_discussion_counts()
+        if counts is not None:
+            return counts[0]
         result = self.db.query(Post).filter(
             Post.discussion_id == self.discussion_id,
             Post.hidden==False,
@@ -1022,6 +1030,9 @@ class RootIdea(Idea):
         """ In the root idea, num_posts is the count of all non-deleted read mesages in the discussion """
         from .post import Post
         from .action import ViewPost
+        counts = self._bulk_discussion_counts()
+        if counts is not None:
+            return counts[1]
         discussion_data = self.get_discussion_data(self.discussion_id)
         result = self.db.query(Post).filter(
             Post.discussion_id == self.discussion_id,
@@ -1176,6 +1187,9 @@ class IdeaLink(HistoryMixin, DiscussionBoundBase):
         else:
             super(IdeaLink, self).send_to_changes(
                 connection, operation, discussion_id, view_def)
+        from .path_utils import discussion_structure_cache
+        discussion_structure_cache.mark_changed(
+            self.db, self.get_discussion_id(), True)
 
     @classmethod
     def get_discussion_conditions(cls, discussion_id, alias_maker=None):
@@ -85,6 +85,14 @@ class IdeaContentLink(DiscussionBoundBase):
         content = self.content or Content.get(self.content_id)
         return content.get_discussion_id()
 
+    def send_to_changes(self, connection=None, operation=CrudOperation.UPDATE,
+                        discussion_id=None, view_def="changes"):
+        super(IdeaContentLink, self).send_to_changes(
+            connection, operation, discussion_id, view_def)
+        from .path_utils import discussion_structure_cache
+        discussion_structure_cache.mark_changed(
+            self.db, self.get_discussion_id())
+
     @classmethod
     def get_discussion_conditions(cls, discussion_id, alias_maker=None):
         return ((cls.content_id == Content.id),
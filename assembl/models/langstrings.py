@@ -1,10 +1,12 @@
 """Classes for multilingual strings, using automatic or manual translation"""
 from collections import defaultdict
 from datetime import datetime
+from hashlib import sha256
 
 from sqlalchemy import (
     Column, ForeignKey, Integer, Boolean, String, SmallInteger,
-    UnicodeText, UniqueConstraint, event, inspect, Sequence)
+    UnicodeText, UniqueConstraint, DateTime, event, inspect, Sequence)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql.expression import case
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import (
@@ -16,7 +18,6 @@ from ..lib.sqla_types import CoerceUnicode
 import simplejson as json
 
 from . import Base, TombstonableMixin
-from ..lib import config
 from ..lib.abc import classproperty
 from ..auth import CrudPermissions, P_READ, P_ADMIN_DISC, P_SYSADMIN
 
@@ -863,6 +864,74 @@ class LangStringEntry(TombstonableMixin, Base):
     crud_permissions = CrudPermissions(P_READ, P_READ, P_SYSADMIN)
 
 
+class TranslationMemory(Base):
+    """A machine translation of a source text, shared by all LangStrings
+    with the same text, so identical strings are only translated once.
+
+    The source text is identified by its hash. The source locale is
+    :py:data:`Locale.UNDEFINED` when the service identified the language,
+    and the identified locale is then kept in ``detected_locale``."""
+    __tablename__ = "translation_memory"
+    __table_args__ = (
+        UniqueConstraint(
+            "source_hash", "source_locale", "target_locale", "service"),
+    )
+    id = Column(Integer, primary_key=True)
+    service = Column(String(60), nullable=False)
+    source_hash = Column(String(64), nullable=False)
+    source_locale = Column(String(32), nullable=False)
+    target_locale = Column(String(32), nullable=False)
+    detected_locale = Column(String(32))
+    translation = Column(UnicodeText)
+    creation_date = Column(DateTime, default=datetime.utcnow)
+
+    @staticmethod
+    def hash_text(text):
+        return sha256(text.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def lookup(cls, db, service, source_locale, target_locale, texts):
+        """Known translations of the given texts, as a dictionary of
+        text to (translation, detected_locale)."""
+        by_hash = {cls.hash_text(text): text for text in texts}
+        if not by_hash:
+            return {}
+        results = db.query(
+            cls.source_hash, cls.translation, cls.detected_locale).filter(
+                cls.service == service,
+                cls.source_locale == source_locale,
+                cls.target_locale == target_locale,
+                cls.source_hash.in_(by_hash.keys()))
+        return {by_hash[h]: (translation, detected)
+                for (h, translation, detected) in results}
+
+    @classmethod
+    def remember(cls, db, service, source_locale, target_locale, results):
+        """Store translations, given as a dictionary of
+        text to (translation, detected_locale)."""
+        if not results:
+            return
+        rows = [dict(
+            service=service, source_hash=cls.hash_text(text),
+            source_locale=source_locale, target_locale=target_locale,
+            translation=translation, detected_locale=detected)
+            for (text, (translation, detected)) in results.iteritems()]
+        try:
+            with db.begin_nested():
+                db.add_all([cls(**row) for row in rows])
+        except IntegrityError:
+            # Another worker translated some of those texts concurrently;
+            # keep the others.
+            for row in rows:
+                try:
+                    with db.begin_nested():
+                        db.add(cls(**row))
+                except IntegrityError:
+                    pass
+
+    crud_permissions = CrudPermissions(P_SYSADMIN, P_SYSADMIN, P_SYSADMIN)
+
+
 # class TranslationStamp(Base):
 #     "For future reference. Not yet created."
 #     __tablename__ = "translation_stamp"
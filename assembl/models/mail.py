@@ -12,6 +12,7 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import parseaddr
 from time import mktime
+from multiprocessing.pool import ThreadPool
 
 import jwzthreading
 from bs4 import BeautifulSoup, Comment
@@ -40,7 +41,7 @@ from .post import ImportedPost
 from .auth import EmailAccount
 from ..tasks.imap import import_mails
 from ..lib.sqla import mark_changed
-from ..tasks.translate import translate_content
+from ..lib.imap_fetch import FetchPipeline, uid_ranges
 
 
 class AbstractMailbox(PostSource):
@@ -363,9 +364,14 @@ class AbstractMailbox(PostSource):
         #Nothing was stripped...
         return html.tostring(doc)
 
-    def parse_email(self, message_string, existing_email=None):
-        """ Creates or replace a email from a string """
-        parsed_email = email.message_from_string(message_string)
+    @staticmethod
+    def parse_message(message_string, parsed_email=None):
+        """Parses the fields of an email from a string.
+
+        Does not use the database, so it can run in worker threads.
+        Returns (fields, parsed_email, error_description)"""
+        if parsed_email is None:
+            parsed_email = email.message_from_string(message_string)
         body = None
         error_description = None
 
@@ -394,7 +400,7 @@ class AbstractMailbox(PostSource):
             default_charset = message.get_charset() or 'ISO-8859-1'
             (text_part, html_part) = process_part(message, default_charset, text_part, html_part)
             if html_part:
-                return ('text/html',self.sanitize_html(AbstractMailbox.strip_full_message_quoting_html(html_part)))
+                return ('text/html',AbstractMailbox.sanitize_html(AbstractMailbox.strip_full_message_quoting_html(html_part)))
             elif text_part:
                 return ('text/plain', AbstractMailbox.strip_full_message_quoting_plaintext(text_part))
             else:
@@ -419,7 +425,7 @@ class AbstractMailbox(PostSource):
 
         new_message_id = parsed_email.get('Message-ID', None)
         if new_message_id:
-            new_message_id = self.clean_angle_brackets(
+            new_message_id = AbstractMailbox.clean_angle_brackets(
                 email_header_to_unicode(new_message_id))
         else:
             error_description = "Unable to parse the Message-ID for message string: \n%s" % message_string
@@ -429,52 +435,86 @@ class AbstractMailbox(PostSource):
 
         new_in_reply_to = parsed_email.get('In-Reply-To', None)
         if new_in_reply_to:
-            new_in_reply_to = self.clean_angle_brackets(
+            new_in_reply_to = AbstractMailbox.clean_angle_brackets(
                 email_header_to_unicode(new_in_reply_to))
 
         sender = email_header_to_unicode(parsed_email.get('From'))
         sender_name, sender_email = parseaddr(sender)
-        sender_email_account = EmailAccount.get_or_make_profile(self.db, sender_email, sender_name)
-        creation_date = datetime.utcfromtimestamp(
-            mktime(email.utils.parsedate(parsed_email['Date'])))
-        subject = email_header_to_unicode(parsed_email['Subject'], False)
-        recipients = email_header_to_unicode(parsed_email['To'])
-        body = body.strip()
+        fields = dict(
+            message_id=new_message_id,
+            in_reply_to=new_in_reply_to,
+            sender=sender,
+            sender_name=sender_name,
+            sender_email=sender_email,
+            creation_date=datetime.utcfromtimestamp(
+                mktime(email.utils.parsedate(parsed_email['Date']))),
+            subject=email_header_to_unicode(parsed_email['Subject'], False),
+            recipients=email_header_to_unicode(parsed_email['To']),
+            body=body.strip(),
+            mime_type=mimeType,
+            message_string=message_string)
+        return (fields, parsed_email, error_description)
+
+    def make_email(self, fields, email_object=None):
+        """Creates an email from parsed fields, or updates the given one"""
+        sender_email_account = EmailAccount.get_or_make_profile(
+            self.db, fields['sender_email'], fields['sender_name'])
+        if email_object is not None:
+            email_object.recipients = fields['recipients']
+            email_object.sender = fields['sender']
+            email_object.creation_date = fields['creation_date']
+            email_object.source_post_id = fields['message_id']
+            email_object.in_reply_to = fields['in_reply_to']
+            email_object.body_mime_type = fields['mime_type']
+            email_object.imported_blob = fields['message_string']
+            # TODO MAP: Make this nilpotent.
+            email_object.subject = LangString.create(fields['subject'])
+            email_object.body = LangString.create(fields['body'])
+        else:
+            email_object = Email(
+                discussion=self.discussion,
+                source=self,
+                recipients=fields['recipients'],
+                sender=fields['sender'],
+                subject=LangString.create(fields['subject']),
+                creation_date=fields['creation_date'],
+                source_post_id=fields['message_id'],
+                in_reply_to=fields['in_reply_to'],
+                body=LangString.create(fields['body']),
+                body_mime_type=fields['mime_type'],
+                imported_blob=fields['message_string']
+            )
+        email_object.creator = sender_email_account.profile
+        return email_object
+
+    def emails_by_message_id(self, message_ids):
+        """The emails of this mailbox with these message ids"""
+        if not message_ids:
+            return {}
+        return {e.source_post_id: e for e in self.db.query(Email).filter(
+            Email.source_post_id.in_(message_ids),
+            Email.discussion_id == self.discussion_id,
+            Email.source_id == self.id)}
+
+    def parse_email(self, message_string, existing_email=None):
+        """ Creates or replace a email from a string """
+        (fields, parsed_email, error_description) = self.parse_message(
+            message_string)
+        if error_description:
+            return (None, None, error_description)
         # Try/except for a normal situation is an anti-pattern,
         # but sqlalchemy doesn't have a function that returns
         # 0, 1 result or an exception
         try:
             email_object = self.db.query(Email).filter(
-                Email.source_post_id == new_message_id,
+                Email.source_post_id == fields['message_id'],
                 Email.discussion_id == self.discussion_id,
                 Email.source == self
             ).one()
             if existing_email and existing_email != email_object:
                 raise ValueError("The existing object isn't the same as the one found by message id")
-            email_object.recipients = recipients
-            email_object.sender = sender
-            email_object.creation_date = creation_date
-            email_object.source_post_id = new_message_id
-            email_object.in_reply_to = new_in_reply_to
-            email_object.body_mime_type = mimeType
-            email_object.imported_blob = message_string
-            # TODO MAP: Make this nilpotent.
-            email_object.subject = LangString.create(subject)
-            email_object.body = LangString.create(body)
         except NoResultFound:
-            email_object = Email(
-                discussion=self.discussion,
-                source=self,
-                recipients=recipients,
-                sender=sender,
-                subject=LangString.create(subject),
-                creation_date=creation_date,
-                source_post_id=new_message_id,
-                in_reply_to=new_in_reply_to,
-                body=LangString.create(body),
-                body_mime_type = mimeType,
-                imported_blob=message_string
-            )
+            email_object = None
         except MultipleResultsFound:
             """ TO find duplicates (this should no longer happen, but in case it ever does...
 
@@ -505,9 +545,8 @@ DELETE
 FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_post JOIN post ON (post.id=imported_post.id) GROUP BY message_id, source_id HAVING COUNT(post.id)>1)
 
 """
-            raise MultipleResultsFound("ID %s has duplicates in source %d"%(new_message_id,self.id))
-        email_object.creator = sender_email_account.profile
-        # email_object = self.db.merge(email_object)
+            raise MultipleResultsFound("ID %s has duplicates in source %d"%(fields['message_id'],self.id))
+        email_object = self.make_email(fields, email_object)
         return (email_object, parsed_email, error_description)
 
     """
@@ -726,18 +765,23 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
 
         The reference is La référence est http://tools.ietf.org/html/rfc3834
         """
-        #TODO:  This is a double-parse, refactor parse_message so we can reuse it
-        parsed_email = email.message_from_string(message_string)
+        return self.parsed_message_ok_to_import(
+            email.message_from_string(message_string))
+
+    @classmethod
+    def parsed_message_ok_to_import(cls, parsed_email):
+        """Same as :py:meth:`message_ok_to_import`, on a parsed message.
+        Does not use the database."""
         if parsed_email.get('Return-Path', None) == '<>':
             #TODO:  Check if a report-type=delivery-status; is present,
             # and process the bounce
             return False
         if parsed_email.get('Precedence', None) == 'bulk':
             # Possibly a mailing list message: Allow for mailing lists only
-            return isinstance(self, MailingList)
+            return issubclass(cls, MailingList)
         if parsed_email.get('Precedence', None) == 'list':
             # A mailing list message: Allow for mailing lists only
-            return isinstance(self, MailingList)
+            return issubclass(cls, MailingList)
         if parsed_email.get('Auto-Submitted', None) == 'auto-generated':
             return False
         return True
@@ -749,6 +793,12 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
         return source_post_id
 
 
+# Messages fetched per IMAP command
+IMAP_FETCH_CHUNK_SIZE = 200
+# Threads parsing the fetched messages
+IMAP_PARSE_THREADS = 4
+
+
 class IMAPMailbox(AbstractMailbox):
     """
     A IMAPMailbox refers to an Email inbox that can be accessed with IMAP.
@@ -820,33 +870,51 @@ class IMAPMailbox(AbstractMailbox):
             assert search_status == 'OK'
             email_ids = search_result[0].split()
 
-        def import_email(mailbox_obj, email_id):
+        mbox_id = mbox.id
+        mailbox_class = mbox.__class__
+
+        def parse(message):
+            (uid, size, message_string) = message
+            parsed_email = email.message_from_string(message_string)
+            if not mailbox_class.parsed_message_ok_to_import(parsed_email):
+                return (uid, None)
+            (fields, dummy, error) = AbstractMailbox.parse_message(
+                message_string, parsed_email)
+            if error:
+                raise Exception(error)
+            return (uid, fields)
+
+        def import_emails(mailbox_obj, last_uid, messages):
             session = mailbox_obj.db
-            #print "running fetch for message: "+email_id
-            status, message_data = mailbox.uid('fetch', email_id, "(RFC822)")
-            assert status == 'OK'
-
-            #print repr(message_data)
-            for response_part in message_data:
-                if isinstance(response_part, tuple):
-                    message_string = response_part[1]
-            assert message_string
-            if mailbox_obj.message_ok_to_import(message_string):
-                (email_object, dummy, error) = mailbox_obj.parse_email(message_string)
-                if error:
-                    raise Exception(error)
+            existing = mailbox_obj.emails_by_message_id(
+                [fields['message_id'] for (uid, fields) in messages if fields])
+            for (uid, fields) in messages:
+                if fields is None:
+                    print "Skipped message with imap id %s (bounce or vacation message)"% (uid)
+                    continue
+                email_object = mailbox_obj.make_email(
+                    fields, existing.get(fields['message_id'], None))
+                # The same message may appear twice in a mailbox
+                existing[fields['message_id']] = email_object
                 session.add(email_object)
-                translate_content(email_object)  # should delay
-            else:
-                print "Skipped message with imap id %s (bounce or vacation message)"% (email_id)
-            #print "Setting mailbox_obj.last_imported_email_uid to "+email_id
-            mailbox_obj.last_imported_email_uid = email_id
+            # Translations are queued by the post creation listener.
+            # Importing resumes after the last committed range.
+            mailbox_obj.last_imported_email_uid = str(last_uid)
             transaction.commit()
-            mailbox_obj = AbstractMailbox.get(mailbox_obj.id)
 
         if len(email_ids):
             print "Processing messages from IMAP: %d "% (len(email_ids))
-            new_emails = [import_email(mbox, email_id) for email_id in email_ids]
+            pipeline = FetchPipeline(mailbox, uid_ranges(
+                email_ids, IMAP_FETCH_CHUNK_SIZE))
+            pool = ThreadPool(IMAP_PARSE_THREADS)
+            try:
+                for ((first, last), messages) in pipeline:
+                    import_emails(AbstractMailbox.get(mbox_id), last,
+                                  pool.map(parse, messages))
+            finally:
+                pool.close()
+                pool.join()
+            mbox = AbstractMailbox.get(mbox_id)
         else:
             print "No IMAP messages to process"
 
@@ -10,6 +10,7 @@ import email
 from email import (charset as Charset)
 from email.mime.text import MIMEText
 from functools import partial
+from contextlib import contextmanager
 import threading
 
 from sqlalchemy import (
@@ -22,7 +23,9 @@ from sqlalchemy import (
     DateTime,
     ForeignKey,
     event,
-    inspect
+    inspect,
+    or_,
+    true,
 )
 from sqlalchemy.orm import (
     relationship, backref, aliased, contains_eager, joinedload)
@@ -31,14 +34,17 @@ from zope import interface
 from pyramid.httpexceptions import HTTPUnauthorized, HTTPBadRequest
 from pyramid.i18n import TranslationStringFactory, make_localizer
 from celery import current_task
-from jinja2 import Environment, PackageLoader
+from jinja2 import Environment, PackageLoader, BytecodeCache
 
 from . import Base, DiscussionBoundBase
 from ..lib.model_watcher import IModelEventWatcher
 from ..lib.decl_enums import DeclEnum
 from ..lib.utils import waiting_get
+from ..lib.sqla import mark_changed
+from ..auth import R_PARTICIPANT
 from .auth import (
-    User, Everyone, P_ADMIN_DISC, CrudPermissions, P_READ, UserTemplate)
+    User, Everyone, P_ADMIN_DISC, CrudPermissions, P_READ, UserTemplate,
+    LocalUserRole, Role)
 from .discussion import Discussion
 from .post import Post, SynthesisPost
 from assembl.semantic.virtuoso_mapping import QuadMapPatternS
@@ -189,6 +195,9 @@ class NotificationSubscription(DiscussionBoundBase):
     #allowed_transports Ex: email_bounce cannot be bounced by the same email.  For now we'll special case in code
     priority = 1 #An integer, if more than one subsciption match for one event, only the one with the lowest integer can create a notification
     unsubscribe_allowed = False
+    # The (verb, model class) events this subscription class can fire on.
+    # Events on subclasses of the model class are also routed here.
+    event_routes = ()
 
     __mapper_args__ = {
         'polymorphic_identity': NotificationSubscriptionClasses.ABSTRACT_NOTIFICATION_SUBSCRIPTION,
@@ -236,10 +245,33 @@ class NotificationSubscription(DiscussionBoundBase):
                 applicable_subscriptions.append(subscription)
         return applicable_subscriptions
 
-    @abstractmethod
+    @classmethod
+    def applicable_condition(cls, verb, object):
+        """The SQL condition on subscriptions of this class that would fire
+        on the object and verb given, or None if none would.
+
+        Must agree with :py:meth:`wouldCreateNotification`; the discussion,
+        status and participation conditions are added by the caller."""
+        return None
+
+    @classmethod
+    def notification_for(cls, verb, object):
+        """The :py:class:`Notification` subclass created for this event,
+        and its specific column values"""
+        raise NotImplementedError()
+
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
         """Process a CRUD event on a model, creating :py:class:`Notification` as appropriate"""
-        pass
+        from ..tasks.notify import notify
+        assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
+        notification_class, values = self.notification_for(verb, objectInstance)
+        notification = notification_class(
+            first_matching_subscription=self,
+            push_method=NotificationPushMethodType.EMAIL,
+            **values)
+        self.db.add(notification)
+        self.db.flush()
+        notify.delay(notification.id)
 
     def get_human_readable_description(self):
         """ A human readable description of this notification subscription
@@ -583,6 +615,7 @@ class CrudVerbs():
 class NotificationSubscriptionFollowSyntheses(NotificationSubscriptionGlobal):
     priority = 1
     unsubscribe_allowed = True
+    event_routes = ((CrudVerbs.CREATE, SynthesisPost),)
 
     def get_human_readable_description(self):
         return _("A synthesis is posted")
@@ -591,18 +624,13 @@ class NotificationSubscriptionFollowSyntheses(NotificationSubscriptionGlobal):
         parentWouldCreate = super(NotificationSubscriptionFollowSyntheses, self).wouldCreateNotification(discussion_id, verb, object)
         return parentWouldCreate and (verb == CrudVerbs.CREATE) and isinstance(object, SynthesisPost) and discussion_id == object.get_discussion_id()
 
-    def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
-        from ..tasks.notify import notify
-        assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
-        notification = NotificationOnPostCreated(
-            post = objectInstance,
-            first_matching_subscription = self,
-            push_method = NotificationPushMethodType.EMAIL,
-            #push_address = TODO
-            )
-        self.db.add(notification)
-        self.db.flush()
-        notify.delay(notification.id)
+    @classmethod
+    def applicable_condition(cls, verb, object):
+        return true()
+
+    @classmethod
+    def notification_for(cls, verb, object):
+        return NotificationOnPostCreated, dict(post_id=object.id)
 
     __mapper_args__ = {
         'polymorphic_identity': NotificationSubscriptionClasses.FOLLOW_SYNTHESES
@@ -611,6 +639,7 @@ class NotificationSubscriptionFollowSyntheses(NotificationSubscriptionGlobal):
 class NotificationSubscriptionFollowAllMessages(NotificationSubscriptionGlobal):
     priority = 1
     unsubscribe_allowed = True
+    event_routes = ((CrudVerbs.CREATE, Post),)
 
     def get_human_readable_description(self):
         return _("Any message is posted to the discussion")
@@ -619,18 +648,13 @@ class NotificationSubscriptionFollowAllMessages(NotificationSubscriptionGlobal):
         parentWouldCreate = super(NotificationSubscriptionFollowAllMessages, self).wouldCreateNotification(discussion_id, verb, object)
         return parentWouldCreate and (verb == CrudVerbs.CREATE) and isinstance(object, Post) and discussion_id == object.get_discussion_id()
 
-    def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
-        assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
-        from ..tasks.notify import notify
-        notification = NotificationOnPostCreated(
-            post_id = objectInstance.id,
-            first_matching_subscription = self,
-            push_method = NotificationPushMethodType.EMAIL,
-            #push_address = TODO
-            )
-        self.db.add(notification)
-        self.db.flush()
-        notify.delay(notification.id)
+    @classmethod
+    def applicable_condition(cls, verb, object):
+        return true()
+
+    @classmethod
+    def notification_for(cls, verb, object):
+        return NotificationOnPostCreated, dict(post_id=object.id)
 
     __mapper_args__ = {
         'polymorphic_identity': NotificationSubscriptionClasses.FOLLOW_ALL_MESSAGES
@@ -639,6 +663,7 @@ class NotificationSubscriptionFollowAllMessages(NotificationSubscriptionGlobal):
 class NotificationSubscriptionFollowOwnMessageDirectReplies(NotificationSubscriptionGlobal):
     priority = 1
     unsubscribe_allowed = True
+    event_routes = ((CrudVerbs.CREATE, Post),)
 
     def get_human_readable_description(self):
         return _("Someone directly responds to one of your messages")
@@ -653,18 +678,14 @@ class NotificationSubscriptionFollowOwnMessageDirectReplies(NotificationSubscrip
                  and object.parent.creator == self.user
                  )
 
-    def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
-        assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
-        from ..tasks.notify import notify
-        notification = NotificationOnPostCreated(
-            post = objectInstance,
-            first_matching_subscription = self,
-            push_method = NotificationPushMethodType.EMAIL,
-            #push_address = TODO
-            )
-        self.db.add(notification)
-        self.db.flush()
-        notify.delay(notification.id)
+    @classmethod
+    def applicable_condition(cls, verb, object):
+        if object.parent is not None:
+            return cls.user_id == object.parent.creator_id
+
+    @classmethod
+    def notification_for(cls, verb, object):
+        return NotificationOnPostCreated, dict(post_id=object.id)
 
     __mapper_args__ = {
         'polymorphic_identity': NotificationSubscriptionClasses.FOLLOW_OWN_MESSAGES_DIRECT_REPLIES
@@ -672,34 +693,127 @@ class NotificationSubscriptionFollowOwnMessageDirectReplies(NotificationSubscrip
 
 
 class ModelEventWatcherNotificationSubscriptionDispatcher(object):
-    """Calls :py:meth:`NotificationSubscription.process` on the appropriate
-    :py:class:`NotificationSubscription` subclass when a certain CRUD event
+    """Creates a :py:class:`Notification` for each user with a matching
+    :py:class:`NotificationSubscription` when a certain CRUD event
     is detected through the :py:class:`assembl.lib.model_watcher.IModelEventWatcher`
-    protocol"""
+    protocol.
+
+    Events are routed to the subscription classes that declare them in
+    :py:attr:`NotificationSubscription.event_routes`."""
     interface.implements(IModelEventWatcher)
 
-    def processEvent(self, verb, objectClass, objectId):
+    # (verb, model class) -> subscription classes, from their event_routes
+    _routing_table = None
+    # The same, including the routes of the model class's ancestors
+    _resolved_routes = {}
+
+    @classmethod
+    def routing_table(cls):
         from ..lib.utils import get_concrete_subclasses_recursive
+        if cls._routing_table is None:
+            routes = defaultdict(list)
+            for subscriptionClass in get_concrete_subclasses_recursive(
+                    NotificationSubscription):
+                for route in subscriptionClass.event_routes:
+                    routes[route].append(subscriptionClass)
+            cls._routing_table = dict(routes)
+        return cls._routing_table
+
+    @classmethod
+    def subscription_classes_for(cls, verb, objectClass):
+        """The subscription classes that may fire on this event"""
+        key = (verb, objectClass)
+        subscriptionClasses = cls._resolved_routes.get(key, None)
+        if subscriptionClasses is None:
+            routes = cls.routing_table()
+            subscriptionClasses = []
+            for modelClass in objectClass.mro():
+                for subscriptionClass in routes.get((verb, modelClass), ()):
+                    if subscriptionClass not in subscriptionClasses:
+                        subscriptionClasses.append(subscriptionClass)
+            cls._resolved_routes[key] = subscriptionClasses
+        return subscriptionClasses
+
+    def first_matching_subscriptions(self, verb, objectInstance):
+        """The (id, class) of the subscription with the best priority
+        for each user who should be notified of this event.
+
+        All subscription classes are matched in a single query."""
+        subscriptionClasses = self.subscription_classes_for(
+            verb, objectInstance.__class__)
+        conditions = []
+        for subscriptionClass in subscriptionClasses:
+            condition = subscriptionClass.applicable_condition(
+                verb, objectInstance)
+            if condition is not None:
+                conditions.append(
+                    (NotificationSubscription.type ==
+                        subscriptionClass.__mapper__.polymorphic_identity)
+                    & condition)
+        if not conditions:
+            return []
+        by_type = {subscriptionClass.__mapper__.polymorphic_identity:
+                   subscriptionClass
+                   for subscriptionClass in subscriptionClasses}
+        discussion_id = objectInstance.get_discussion_id()
+        query = objectInstance.db.query(
+            NotificationSubscription.id,
+            NotificationSubscription.type,
+            NotificationSubscription.user_id
+        ).join(LocalUserRole, (
+            (LocalUserRole.user_id == NotificationSubscription.user_id)
+            & (LocalUserRole.discussion_id == discussion_id)
+            & (LocalUserRole.requested == False))
+        ).join(Role, (Role.id == LocalUserRole.role_id)
+                     & (Role.name == R_PARTICIPANT)
+        ).filter(
+            NotificationSubscription.discussion_id == discussion_id,
+            NotificationSubscription.status ==
+                NotificationSubscriptionStatus.ACTIVE,
+            or_(*conditions)
+        ).distinct()
+        best = {}
+        for (subscription_id, subscription_type, user_id) in query:
+            subscriptionClass = by_type[subscription_type]
+            rank = (subscriptionClass.priority, subscription_id)
+            if user_id not in best or rank < best[user_id][0]:
+                best[user_id] = (rank, subscription_id, subscriptionClass)
+        return [(subscription_id, subscription_class)
+                for (_, subscription_id, subscription_class)
+                in sorted(best.itervalues())]
+
+    def create_notifications(self, verb, objectInstance, subscriptions):
+        """Bulk insert the notifications of the given (id, class)
+        subscriptions, and queue them for delivery"""
+        from ..tasks.notify import notify
+        rows_by_class = defaultdict(list)
+        for (subscription_id, subscriptionClass) in subscriptions:
+            notificationClass, values = subscriptionClass.notification_for(
+                verb, objectInstance)
+            values = dict(
+                values,
+                first_matching_subscription_id=subscription_id,
+                push_method=NotificationPushMethodType.EMAIL)
+            rows_by_class[notificationClass].append(values)
+        ids = []
+        for notificationClass, rows in rows_by_class.iteritems():
+            ids.extend(notificationClass.bulk_create(objectInstance.db, rows))
+        for id in ids:
+            notify.delay(id)
+        return ids
+
+    def processEvent(self, verb, objectClass, objectId):
         assert objectId
         objectInstance = waiting_get(objectClass, objectId)
         assert objectInstance
         assert objectInstance.id
         # We need the discussion id
         assert isinstance(objectInstance, DiscussionBoundBase)
-        applicableInstancesByUser = defaultdict(list)
-        subscriptionClasses = get_concrete_subclasses_recursive(NotificationSubscription)
-        for subscriptionClass in subscriptionClasses:
-            applicableInstances = subscriptionClass.findApplicableInstances(objectInstance.get_discussion_id(), CrudVerbs.CREATE, objectInstance)
-            for subscription in applicableInstances:
-                applicableInstancesByUser[subscription.user_id].append(subscription)
-        num_instances = len([v for v in applicableInstancesByUser.itervalues() if v])
+        subscriptions = self.first_matching_subscriptions(verb, objectInstance)
         print "processEvent: %d notifications created for %s %s %d" % (
-            num_instances, verb, objectClass.__name__, objectId)
+            len(subscriptions), verb, objectClass.__name__, objectId)
         with transaction.manager:
-            for userId, applicableInstances in applicableInstancesByUser.iteritems():
-                if(len(applicableInstances) > 0):
-                    applicableInstances.sort(cmp=lambda x,y: cmp(x.priority, y.priority))
-                    applicableInstances[0].process(objectInstance.get_discussion_id(), verb, objectInstance, applicableInstances[1:])
+            self.create_notifications(verb, objectInstance, subscriptions)
         if bool(current_task):
             # In a celery task, there's no one else to commit
             objectInstance.db.commit()
@@ -786,6 +900,107 @@ class NotificationClasses():
     ABSTRACT_NOTIFICATION_SUBSCRIPTION_ON_USERACCOUNT = "ABSTRACT_NOTIFICATION_SUBSCRIPTION_ON_USERACCOUNT"
 
 
+class MemoryBytecodeCache(BytecodeCache):
+    """Keeps compiled templates in memory, so Jinja environments
+    can share them"""
+
+    def __init__(self):
+        self.codes = {}
+
+    def load_bytecode(self, bucket):
+        code = self.codes.get(bucket.key, None)
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        self.codes[bucket.key] = bucket.bytecode_to_string()
+
+
+class NotificationRenderingCache(object):
+    """Localizers and Jinja environments used to render notifications,
+    shared by all threads.
+
+    There is one environment per locale, with the translations installed;
+    it keeps its loaded templates, so each (locale, template) is loaded
+    once, and the bytecode is only compiled once for all locales.
+
+    Within a :py:meth:`batch`, rendered fragments are also kept by key,
+    so the same post is rendered once per locale and not per recipient."""
+
+    locale_path = os.path.abspath(
+        join(dirname(__file__), os.path.pardir, 'locale'))
+
+    def __init__(self):
+        self.bytecode_cache = MemoryBytecodeCache()
+        self.localizers = {}
+        self.jinja_envs = {}
+        self.static_files = {}
+        self.threadlocals = threading.local()
+        self._lock = threading.Lock()
+
+    def get_localizer(self, locale):
+        localizer = self.localizers.get(locale, None)
+        if localizer is None:
+            localizer = make_localizer(locale, [self.locale_path])
+            with self._lock:
+                localizer = self.localizers.setdefault(locale, localizer)
+        return localizer
+
+    def get_jinja_env(self, locale):
+        jinja_env = self.jinja_envs.get(locale, None)
+        if jinja_env is None:
+            localizer = self.get_localizer(locale)
+            jinja_env = Environment(
+                loader=PackageLoader('assembl', 'templates'),
+                extensions=['jinja2.ext.i18n'],
+                bytecode_cache=self.bytecode_cache,
+                auto_reload=False)
+            jinja_env.install_gettext_callables(
+                partial(localizer.translate, domain='assembl'),
+                partial(localizer.pluralize, domain='assembl'),
+                newstyle=True)
+            with self._lock:
+                jinja_env = self.jinja_envs.setdefault(locale, jinja_env)
+        return jinja_env
+
+    def get_template(self, locale, name):
+        return self.get_jinja_env(locale).get_template(name)
+
+    def read_static(self, path):
+        """The content of a static file, such as a stylesheet"""
+        content = self.static_files.get(path, None)
+        if content is None:
+            with open(path) as f:
+                content = f.read().decode('utf_8')
+            self.static_files[path] = content
+        return content
+
+    @contextmanager
+    def batch(self):
+        """Keep rendered fragments in this thread until the end of the
+        batch"""
+        previous = getattr(self.threadlocals, 'fragments', None)
+        if previous is None:
+            self.threadlocals.fragments = {}
+        try:
+            yield
+        finally:
+            self.threadlocals.fragments = previous
+
+    def fragment(self, key, render):
+        """The fragment rendered by render(), memoized by key in a batch"""
+        fragments = getattr(self.threadlocals, 'fragments', None)
+        if fragments is None:
+            return render()
+        fragment = fragments.get(key, None)
+        if fragment is None:
+            fragment = fragments[key] = render()
+        return fragment
+
+
+notification_rendering = NotificationRenderingCache()
+
+
 class UnverifiedEmailException(Exception):
     pass
 
@@ -855,8 +1070,39 @@ class Notification(Base):
     delivery_confirmation_date = Column(
         DateTime,
         nullable = True)
+    # Set when delivery was deferred by the rate limits,
+    # the notification is not claimed again before that date
+    next_attempt_date = Column(
+        DateTime,
+        nullable = True)
 
-    threadlocals = threading.local()
+    @classmethod
+    def bulk_create(cls, db, rows):
+        """Insert notifications of this class, given as dictionaries of
+        column values, without going through the ORM. Returns their ids."""
+        mapper = inspect(cls)
+        tables = []
+        for m in reversed(list(mapper.iterate_to_root())):
+            if m.local_table not in tables:
+                tables.append(m.local_table)
+        if not rows:
+            return []
+        now = datetime.utcnow()
+        for row in rows:
+            row.setdefault('sqla_type', mapper.polymorphic_identity)
+            row.setdefault('creation_date', now)
+        base_table = tables[0]
+        # Postgres returns the ids in the order of the values
+        ids = [id for (id,) in db.execute(base_table.insert().values([
+            {k: v for (k, v) in row.iteritems() if k in base_table.c}
+            for row in rows]).returning(base_table.c.id))]
+        for table in tables[1:]:
+            db.execute(table.insert(), [
+                dict({k: v for (k, v) in row.iteritems() if k in table.c},
+                     id=id)
+                for (id, row) in zip(ids, rows)])
+        mark_changed(db)
+        return ids
 
     @abstractmethod
     def event_source_object(self):
@@ -897,32 +1143,15 @@ class Notification(Base):
     def get_notification_subject(self):
         """Typically for email"""
 
-    def get_unlocalized_jinja_env(self):
-        threadlocals = self.threadlocals
-        if getattr(threadlocals, 'jinja_env', None) is None:
-            threadlocals.jinja_env = Environment(
-                loader=PackageLoader('assembl', 'templates'),
-                extensions=['jinja2.ext.i18n'])
-        return threadlocals.jinja_env
+    def get_locale(self):
+        return self.first_matching_subscription.user.get_preferred_locale()
 
     def get_jinja_env(self):
-        jinja_env = self.get_unlocalized_jinja_env()
-        self.setup_localizer(jinja_env)
-        return jinja_env
+        return notification_rendering.get_jinja_env(self.get_locale())
 
     def get_localizer(self):
-        locale = self.first_matching_subscription.user.get_preferred_locale()
         # TODO: if locale has country code, make sure we fallback properly.
-        path = os.path.abspath(join(dirname(__file__), os.path.pardir, 'locale'))
-        return make_localizer(locale, [path])
-
-    def setup_localizer(self, jinja_env=None):
-        localizer = self.get_localizer()
-        jinja_env = jinja_env or self.get_unlocalized_jinja_env()
-        jinja_env.install_gettext_callables(
-            partial(localizer.translate, domain='assembl'),
-            partial(localizer.pluralize, domain='assembl'),
-            newstyle=True)
+        return notification_rendering.get_localizer(self.get_locale())
 
     def get_from_email_address(self):
         from_email = self.first_matching_subscription.discussion.admin_source.admin_sender
@@ -1031,6 +1260,19 @@ class NotificationOnPostCreated(NotificationOnPost):
             subject += (self.post.subject.first_original().value or "")
         return subject
 
+    def render_post_fragment(self, jinja_env):
+        """The HTML parts of the email that only depend on the post
+        and the locale"""
+        post = self.post
+        fragment = {
+            'body': post.get_original_body_as_html(),
+            'attachments': (post.get_attachments_as_html_list()
+                            if post.has_attachments() else [])
+        }
+        if isinstance(post, SynthesisPost):
+            fragment['synthesis'] = post.publishes_synthesis.as_html(jinja_env)
+        return fragment
+
     def render_to_email_html_part(self):
         from ..lib.frontend_urls import FrontendUrls, URL_DISCRIMINANTS, SOURCE_DISCRIMINANTS
         from premailer import Premailer
@@ -1038,22 +1280,22 @@ class NotificationOnPostCreated(NotificationOnPost):
         discussion = self.first_matching_subscription.discussion
         (theme_name, theme_relative_path) = get_theme_info(discussion)
         assembl_css_path = os.path.normpath(os.path.join(get_theme_base_path(), theme_relative_path, 'assembl_notifications.css'))
-        assembl_css = open(assembl_css_path)
-        assert assembl_css
         ink_css_path = os.path.normpath(os.path.join(os.path.abspath(__file__), '..' , '..', 'static', 'js', 'bower', 'ink', 'css', 'ink.css'))
-        ink_css = open(ink_css_path)
-        assert ink_css
-        jinja_env = self.get_jinja_env()
+        locale = self.get_locale()
+        jinja_env = notification_rendering.get_jinja_env(locale)
         template_data={'subscription': self.first_matching_subscription,
                        'notification': self,
                        'frontendUrls': FrontendUrls(discussion),
-                       'ink_css': ink_css.read(),
-                       'assembl_notification_css': assembl_css.read().decode('utf_8'),
+                       'ink_css': notification_rendering.read_static(ink_css_path),
+                       'assembl_notification_css': notification_rendering.read_static(assembl_css_path),
                        'discriminants': {
                                             'url': URL_DISCRIMINANTS,
                                             'source': SOURCE_DISCRIMINANTS
                                         },
-                       'jinja_env': jinja_env
+                       'jinja_env': jinja_env,
+                       'post_fragment': notification_rendering.fragment(
+                           ('post', self.post_id, locale),
+                           partial(self.render_post_fragment, jinja_env))
                        }
         if isinstance(self.post, SynthesisPost):
             template = jinja_env.get_template('notifications/html_mail_post_synthesis.jinja2')
@@ -3,10 +3,14 @@
 
 from functools import total_ordering
 from collections import defaultdict
-from bisect import bisect_right
+from bisect import bisect_left, bisect_right
+from threading import Lock
+from uuid import uuid4
+import logging
 
-from sqlalchemy import String
+from sqlalchemy import String, event
 from sqlalchemy.orm import (with_polymorphic, aliased)
+from sqlalchemy.orm.session import Session
 from sqlalchemy.sql.expression import or_, union, except_
 from sqlalchemy.sql.functions import count
 
@@ -19,11 +23,10 @@ from .annotation import Webpage
 from .idea import IdeaVisitor, Idea, IdeaLink, RootIdea
 from .discussion import Discussion
 from .action import ViewPost
+from ..lib.config import get_config
+from ..lib.utils import get_shared_cache_region
 
-# TODO: Write a discussion structure cache manager.
-# This will have caches of parent, children, counts, etc. at need
-# and understand the invalidation relationships
-# Tie it to request? use request.set_property?
+log = logging.getLogger('assembl')
 
 
 # Cas à surveiller:
@@ -409,6 +412,10 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
         for id, paths in post_path_global_collection.paths.iteritems():
             self.paths[id] = paths.clone()
         self.discussion = post_path_global_collection.discussion
+        root_idea_id = getattr(
+            post_path_global_collection, "root_idea_id", None)
+        if root_idea_id is not None:
+            self.root_idea_id = root_idea_id
 
     def visit_idea(self, idea_id, level, prev_result):
         if isinstance(idea_id, Idea):
@@ -478,6 +485,8 @@ class PostPathCounter(PostPathCombiner):
         self.read_counts = {}
         self.user_id = user_id
         self.calc_subset = calc_subset
+        self.all_counted = False
+        self.discussion_counts = None
 
     def copy_result(self, idea_id, parent_result, child_result):
         # When the parent has no information, and can get it from a single child
@@ -532,6 +541,96 @@ class PostPathCounter(PostPathCombiner):
         self.viewed_counts[idea_id] = viewed_count
         return (post_count, viewed_count)
 
+    def get_all_counts(self):
+        """Compute the total and read counts of all ideas at once.
+
+        Instead of one query per idea, this makes a single query for the
+        path and read status of all posts of the discussion, and counts
+        the posts below the (reduced) paths of each idea by bisection
+        in the sorted post paths.
+        Also computes the counts of live posts in the discussion,
+        as used by the root idea."""
+        db = self.discussion.db
+        post = with_polymorphic(
+            Post, [], Post.__table__,
+            aliased=False, flat=True)
+        content = with_polymorphic(
+            Content, [], Content.__table__,
+            aliased=False, flat=True)
+        q = db.query(
+            post.id, post.ancestry, post.publication_state,
+            content.tombstone_date).join(
+            content, content.id == post.id).filter(
+            content.discussion_id == self.discussion.id,
+            content.hidden == False,
+            post.publication_state.in_(countable_publication_states)
+            | (content.tombstone_date == None))
+        if self.user_id:
+            q = q.outerjoin(
+                ViewPost,
+                (ViewPost.post_id == post.id)
+                & (ViewPost.tombstone_date == None)
+                & (ViewPost.actor_id == self.user_id)
+                ).add_columns(ViewPost.id)
+        seen = set()
+        read_by_path = {}
+        live_total = live_read = 0
+        for row in q:
+            (post_id, ancestry, state, tombstone_date) = row[:4]
+            if post_id in seen:
+                # many ViewPosts
+                continue
+            seen.add(post_id)
+            read = bool(self.user_id and row[4])
+            if tombstone_date is None:
+                live_total += 1
+                live_read += read
+            if state in countable_publication_states:
+                read_by_path["%s%d," % (ancestry or '', post_id)] = read
+        post_paths = sorted(read_by_path)
+        read_cumul = [0]
+        for path in post_paths:
+            read_cumul.append(read_cumul[-1] + read_by_path[path])
+        self.discussion_counts = (live_total, live_read)
+
+        def range_counts(post_path):
+            # All paths starting with 'x,' lie in ['x,', 'x-')
+            start = bisect_left(post_paths, post_path)
+            end = bisect_left(post_paths, post_path[:-1] + '-', start)
+            return (end - start, read_cumul[end] - read_cumul[start])
+
+        for idea_id, path_collection in self.paths.items():
+            # The deepest path above a post decides its inclusion
+            total = read = 0
+            stack = []  # [path, count, read count, children count, ...]
+
+            def pop():
+                path, count, read_count, sub_count, sub_read = stack.pop()
+                if stack:
+                    stack[-1][3] += count
+                    stack[-1][4] += read_count
+                if path.positive:
+                    return (count - sub_count, read_count - sub_read)
+                return (0, 0)
+
+            for path in path_collection.paths:
+                while stack and not path.post_path.startswith(
+                        stack[-1][0].post_path):
+                    (t, r) = pop()
+                    total += t
+                    read += r
+                stack.append(
+                    [path] + list(range_counts(path.post_path)) + [0, 0])
+            while stack:
+                (t, r) = pop()
+                total += t
+                read += r
+            (path_collection.count, path_collection.viewed_count) = (
+                total, read)
+            self.counts[idea_id] = total
+            self.viewed_counts[idea_id] = read
+        self.all_counted = True
+
     def get_orphan_counts(self, include_deleted=False):
         return self.get_counts_for_query(
             self.orphan_clause(self.user_id, include_deleted=include_deleted))
@@ -546,16 +645,202 @@ class PostPathCounter(PostPathCombiner):
         return result
 
 
+class DiscussionStructure(object):
+    """The part of the discussion data that does not depend on the user:
+    idea hierarchy and post paths, reduced and combined along the hierarchy.
+
+    It is shared between requests through the
+    :py:data:`discussion_structure_cache`, and must not be mutated."""
+    def __init__(self, db, discussion, parent_dict=None, children_dict=None):
+        self.discussion_id = discussion.id
+        if parent_dict is None:
+            parent_dict = self.load_parent_dict(db, discussion.id)
+            children_dict = None
+        self.parent_dict = parent_dict
+        if children_dict is None:
+            children_dict = self.load_children_dict(
+                db, discussion.id, parent_dict)
+        self.children_dict = children_dict
+        self.post_path_collection_raw = PostPathGlobalCollection(discussion)
+        combiner = PostPathCombiner(None)
+        combiner.init_from(self.post_path_collection_raw)
+        Idea.visit_idea_ids_depth_first(
+            combiner, discussion.id, children_dict)
+        self.post_path_combined = combiner
+        # Do not keep the session-bound discussion in a shared structure
+        self.post_path_collection_raw.discussion = None
+        combiner.discussion = None
+
+    @staticmethod
+    def load_parent_dict(db, discussion_id):
+        source = aliased(Idea, name="source")
+        target = aliased(Idea, name="target")
+        return dict(db.query(
+            IdeaLink.target_id, IdeaLink.source_id
+            ).join(source, source.id == IdeaLink.source_id
+            ).join(target, target.id == IdeaLink.target_id
+            ).filter(
+            source.discussion_id == discussion_id,
+            IdeaLink.tombstone_date == None,
+            source.tombstone_date == None,
+            target.tombstone_date == None,
+            target.discussion_id == discussion_id))
+
+    @staticmethod
+    def load_children_dict(db, discussion_id, parent_dict):
+        if not parent_dict:
+            (root_id,) = db.query(
+                RootIdea.id).filter_by(
+                discussion_id=discussion_id).first()
+            return {None: (root_id,), root_id: ()}
+        children = defaultdict(list)
+        for child, parent in parent_dict.iteritems():
+            children[parent].append(child)
+        root = set(children.keys()) - set(parent_dict.keys())
+        assert len(root) == 1
+        children[None] = [root.pop()]
+        # do not let a shared structure grow by lookup
+        return dict(children)
+
+
+class DiscussionStructureCache(object):
+    """A process-wide cache of :py:class:`DiscussionStructure`, by discussion.
+
+    The cache is invalidated by :py:meth:`BaseOps.send_to_changes` of
+    IdeaLink (hierarchy changes), and IdeaContentLink and Post
+    (post path changes), when the transaction is committed.
+    In ``shared`` mode (the default), a generation token is kept in a
+    dogpile cache region for each discussion, so that invalidations made
+    in one process are seen by all others. ``local`` mode should only be
+    used with a single process, and ``off`` disables the cache.
+    This is set by the ``discussion_structure_cache`` configuration key."""
+
+    HIERARCHY = 'h'
+    CONTENT = 'c'
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = Lock()
+        self._mode = None
+        self._region = None
+
+    @property
+    def mode(self):
+        if self._mode is None:
+            mode = get_config().get('discussion_structure_cache', 'shared')
+            if mode == 'shared':
+                self._region = self._get_region()
+                if self._region is None:
+                    log.error("Could not setup the shared generation cache. "
+                              "Disabling the discussion structure cache.")
+                    mode = 'off'
+            self._mode = mode
+        return self._mode
+
+    @staticmethod
+    def _get_region():
+        return get_shared_cache_region('discussion_structure')
+
+    def _generation_key(self, kind, discussion_id):
+        return "%s_%d" % (kind, discussion_id)
+
+    def _generations(self, discussion_id):
+        if self._region is None:
+            return (None, None)
+        keys = [self._generation_key(kind, discussion_id)
+                for kind in (self.HIERARCHY, self.CONTENT)]
+        return tuple(self._region.get_multi(keys))
+
+    def get(self, db, discussion):
+        """Get the structure of the discussion, from cache if valid."""
+        if self.mode == 'off':
+            return DiscussionStructure(db, discussion)
+        discussion_id = discussion.id
+        if discussion_id in db.info.get('structure_changes', ()):
+            # Uncommitted structure changes: do not share.
+            return DiscussionStructure(db, discussion)
+        generations = self._generations(discussion_id)
+        entry = self.entries.get(discussion_id, None)
+        if entry is not None and entry[0] == generations:
+            return entry[1]
+        if entry is not None and entry[0][0] == generations[0]:
+            # Only the post paths changed; keep the idea hierarchy.
+            old = entry[1]
+            structure = DiscussionStructure(
+                db, discussion, old.parent_dict, old.children_dict)
+        else:
+            structure = DiscussionStructure(db, discussion)
+        with self.lock:
+            self.entries[discussion_id] = (generations, structure)
+        return structure
+
+    def invalidate(self, discussion_id, hierarchy=False):
+        if self.mode == 'off':
+            return
+        kinds = (self.HIERARCHY, self.CONTENT) if hierarchy \
+            else (self.CONTENT, )
+        if self._region is not None:
+            self._region.set_multi({
+                self._generation_key(kind, discussion_id): uuid4().hex
+                for kind in kinds})
+        with self.lock:
+            self.entries.pop(discussion_id, None)
+
+    @staticmethod
+    def mark_changed(db, discussion_id, hierarchy=False):
+        """Note that the discussion structure was changed in this session.
+
+        The cache will be invalidated when the session is committed."""
+        if discussion_id is None:
+            return
+        pending = db.info.setdefault('structure_changes', {})
+        pending[discussion_id] = pending.get(discussion_id, False) or hierarchy
+
+
+discussion_structure_cache = DiscussionStructureCache()
+
+
+def structure_after_commit_listener(session):
+    pending = session.info.pop('structure_changes', None)
+    if pending:
+        for discussion_id, hierarchy in pending.iteritems():
+            discussion_structure_cache.invalidate(discussion_id, hierarchy)
+
+
+def structure_rollback_listener(session):
+    session.info.pop('structure_changes', None)
+
+
+def structure_delete_listener(mapper, connection, target):
+    # Deleted objects send a Tombstone to the changes, so we cannot
+    # rely on send_to_changes.
+    try:
+        discussion_id = target.get_discussion_id()
+    except AttributeError:
+        # the parent object may already be gone
+        return
+    discussion_structure_cache.mark_changed(
+        target.db, discussion_id, isinstance(target, IdeaLink))
+
+
+event.listen(Session, 'after_commit', structure_after_commit_listener)
+event.listen(Session, 'after_rollback', structure_rollback_listener)
+for cls in (IdeaLink, IdeaContentLink, Post):
+    event.listen(cls, 'after_delete', structure_delete_listener,
+                 propagate=True)
+
+
 class DiscussionGlobalData(object):
-    "Cache for global discussion data, lasts as long as the pyramid request object."
+    """Cache for global discussion data, lasts as long as the pyramid request object.
+
+    The user-independent part comes from the
+    :py:data:`discussion_structure_cache`."""
     def __init__(self, db, discussion_id, user_id=None, discussion=None):
         self.discussion_id = discussion_id
         self.db = db
         self.user_id = user_id
         self._discussion = discussion
-        self._parent_dict = None
-        self._children_dict = None
-        self._post_path_collection_raw = None
+        self._structure = None
         self._post_path_counter = None
 
     @property
@@ -564,73 +849,51 @@ class DiscussionGlobalData(object):
             self._discussion = Discussion.get(self.discussion_id)
         return self._discussion
 
+    @property
+    def structure(self):
+        if self._structure is None:
+            self._structure = discussion_structure_cache.get(
+                self.db, self.discussion)
+        return self._structure
+
     @property
     def parent_dict(self):
         """dictionary child_idea.id -> parent_idea.id.
 
         TODO: Make it dict(id->id[]) for multiparenting"""
-        if self._parent_dict is None:
-            source = aliased(Idea, name="source")
-            target = aliased(Idea, name="target")
-            self._parent_dict = dict(self.db.query(
-                IdeaLink.target_id, IdeaLink.source_id
-                ).join(source, source.id == IdeaLink.source_id
-                ).join(target, target.id == IdeaLink.target_id
-                ).filter(
-                source.discussion_id == self.discussion_id,
-                IdeaLink.tombstone_date == None,
-                source.tombstone_date == None,
-                target.tombstone_date == None,
-                target.discussion_id == self.discussion_id))
-        return self._parent_dict
+        return self.structure.parent_dict
 
     def idea_ancestry(self, idea_id):
         """generator of ids of ancestor ideas"""
+        parent_dict = self.parent_dict
         while idea_id:
             yield idea_id
-            idea_id = self.parent_dict.get(idea_id, None)
+            idea_id = parent_dict.get(idea_id, None)
 
     @property
     def children_dict(self):
-        if self._children_dict is None:
-            if not self.parent_dict:
-                (root_id,) = self.db.query(
-                    RootIdea.id).filter_by(
-                    discussion_id=self.discussion_id).first()
-                self._children_dict = {None: (root_id,), root_id: ()}
-                return self._children_dict
-            children = defaultdict(list)
-            for child, parent in self.parent_dict.iteritems():
-                children[parent].append(child)
-            root = set(children.keys()) - set(self.parent_dict.keys())
-            assert len(root) == 1
-            children[None] = [root.pop()]
-            self._children_dict = children
-        return self._children_dict
+        return self.structure.children_dict
 
     @property
     def post_path_collection_raw(self):
-        if self._post_path_collection_raw is None:
-            self._post_path_collection_raw = PostPathGlobalCollection(self.discussion)
-        return self._post_path_collection_raw
+        return self.structure.post_path_collection_raw
 
     def post_path_counter(self, user_id, calc_all):
         if (self._post_path_counter is None
                 or not isinstance(self._post_path_counter, PostPathCounter)):
-            collection = self.post_path_collection_raw
-            counter = PostPathCounter(
-                self.discussion, user_id, None if calc_all else ())
-            counter.init_from(self.post_path_collection_raw)
-            Idea.visit_idea_ids_depth_first(
-                counter, self.discussion_id, self.children_dict)
+            # The paths are already combined along the idea hierarchy.
+            counter = PostPathCounter(None, user_id)
+            counter.init_from(self.structure.post_path_combined)
+            counter.discussion = self.discussion
             self._post_path_counter = counter
+        if calc_all and not self._post_path_counter.all_counted:
+            self._post_path_counter.get_all_counts()
         return self._post_path_counter
 
     def reset_hierarchy(self):
-        self._parent_dict = None
-        self._children_dict = None
+        self._structure = None
         self._post_path_counter = None
 
     def reset_content_links(self):
-        self._post_path_collection_raw = None
+        self._structure = None
         self._post_path_counter = None
@@ -175,6 +175,17 @@ class Post(Content):
         'with_polymorphic': '*'
     }
 
+    def send_to_changes(self, connection=None, operation=CrudOperation.UPDATE,
+                        discussion_id=None, view_def="changes"):
+        super(Post, self).send_to_changes(
+            connection, operation, discussion_id, view_def)
+        if operation != CrudOperation.CREATE:
+            # New posts do not change the post paths, but moved or
+            # hidden posts may.
+            from .path_utils import discussion_structure_cache
+            discussion_structure_cache.mark_changed(
+                self.db, self.discussion_id)
+
     def get_descendants(self):
         assert self.id
         descendants = self.db.query(Post).filter(
@@ -571,11 +582,14 @@ def orm_insert_listener(mapper, connection, target):
             discussion_id=target.discussion_id).count() <= 1:
         creator = target.creator or AgentProfile.get(target.creator_id)
         creator.send_to_changes(connection, CrudOperation.UPDATE, target.discussion_id)
-    # Eagerly translate the post
-    # Actually causes DB deadlocks. TODO: Revise this.
-    # Let's only do this on import.
-    # from ..tasks.translate import translate_content_task
-    # translate_content_task.delay(target.id)
+    # Eagerly translate the post, once this transaction is committed.
+    discussion = target.discussion
+    if discussion.translation_service_class:
+        from ..tasks.translate import enqueue_translations
+        targets = set(discussion.discussion_locales)
+        enqueue_translations(target.db, {
+            ls_id: targets for ls_id in (target.body_id, target.subject_id)
+            if ls_id})
 
 event.listen(Post, 'after_insert', orm_insert_listener, propagate=True)
 
@@ -2,21 +2,30 @@
 from abc import abstractproperty, abstractmethod
 from datetime import datetime
 import simplejson as json
-import math
 from collections import defaultdict
 from csv import DictWriter
+from itertools import combinations, groupby
+from operator import itemgetter
+from uuid import uuid4
+import logging
 
+import numpy as np
 from sqlalchemy import (
     Column, Integer, ForeignKey, Boolean, String, Float, DateTime, Unicode,
-    Text, and_, UniqueConstraint)
+    Text, and_, UniqueConstraint, event, func, case)
 from sqlalchemy.sql import functions
-from sqlalchemy.orm import (relationship, backref, joinedload, aliased)
+from sqlalchemy.orm import (
+    relationship, backref, joinedload, aliased, attributes)
+from sqlalchemy.orm.session import Session
 from pyramid.settings import asbool
+from dogpile.cache import make_region
+from dogpile.cache.api import NO_VALUE
 
 from . import (Base, DiscussionBoundBase, HistoryMixin)
 from ..lib.abc import abstractclassmethod
-from ..lib.sqla import DuplicateHandling
+from ..lib.sqla import DuplicateHandling, increment_counter, mark_changed
 from ..lib.sqla_types import URLString
+from ..lib.utils import get_shared_cache_region
 from .discussion import Discussion
 from .idea import Idea, AppendingVisitor
 from .auth import User
@@ -26,6 +35,151 @@ from ..semantic.namespaces import (VOTE, ASSEMBL, DCTERMS, QUADNAMES)
 from ..views.traversal import AbstractCollectionDefinition
 from .langstrings import LangString
 
+log = logging.getLogger('assembl')
+
+
+class VoteArrays(object):
+    """The live votes on some vote specifications, as parallel arrays
+    named after the vote columns.
+
+    Each row stands for ``num_votes`` identical votes (one, unless read
+    from the vote counters). ``ideas`` holds the distinct voted idea ids,
+    and ``idea_index`` the position of the idea of each row in ``ideas``."""
+
+    def __init__(self, columns, rows):
+        data = zip(*rows) or [()] * len(columns)
+        for name, values in zip(columns, data):
+            if name == 'vote_value':
+                dtype = np.float64
+            else:
+                dtype = np.int64
+                # votes without a category, for instance
+                values = [0 if v is None else v for v in values]
+            setattr(self, name, np.array(values, dtype=dtype))
+        if 'num_votes' not in columns:
+            self.num_votes = np.ones(len(self.idea_id), dtype=np.int64)
+        self.ideas, self.idea_index = np.unique(
+            self.idea_id, return_inverse=True)
+
+    def __len__(self):
+        return len(self.idea_id)
+
+    def per_idea(self, weights=None):
+        """Sum the weights of the votes (or count them) on each idea."""
+        if not len(self.ideas):
+            # older numpy versions reject a null minlength
+            return np.zeros(0)
+        weights = self.num_votes if weights is None \
+            else weights * self.num_votes
+        return np.bincount(
+            self.idea_index, weights, minlength=len(self.ideas))
+
+    def count_cells(self, cells, size, weights=None, rows=None):
+        """Count the votes (or sum their weights) in each cell,
+        given the cell of each row (or of the selected rows)."""
+        num_votes = self.num_votes if rows is None else self.num_votes[rows]
+        if weights is not None:
+            num_votes = weights * num_votes
+        counts = np.bincount(cells, num_votes, minlength=size)
+        return counts if weights is not None else counts.astype(np.int64)
+
+    @classmethod
+    def query(cls, db, vote_cls, spec_ids, columns):
+        """Read the live votes of these specifications in a single query."""
+        columns = ('vote_spec_id',) + tuple(columns)
+        rows = db.query(*[getattr(vote_cls, name) for name in columns]
+                        ).select_from(vote_cls).filter(
+                            vote_cls.vote_spec_id.in_(spec_ids),
+                            vote_cls.tombstone_date == None
+                        ).yield_per(10000)
+        return cls(columns, list(rows))
+
+    @classmethod
+    def counted(cls, db, spec_ids):
+        """Read the vote counters of these specifications."""
+        columns = ('vote_spec_id', 'idea_id', 'token_category_id',
+                   'vote_value', 'num_votes')
+        rows = db.query(*[getattr(VoteValueCount, name) for name in columns]
+                        ).filter(VoteValueCount.vote_spec_id.in_(spec_ids),
+                                 VoteValueCount.num_votes > 0)
+        return cls(columns, list(rows))
+
+    @classmethod
+    def counted_by_idea(cls, db, spec_ids, idea_ids):
+        """Read the vote counters of these specifications one idea at a
+        time, in the order of idea_ids. Generates (idea id, votes) pairs,
+        skipping the ideas without votes."""
+        ranks = {}
+        for idea_id in idea_ids:
+            ranks.setdefault(idea_id, len(ranks))
+        if not ranks:
+            return
+        columns = ('vote_spec_id', 'idea_id', 'token_category_id',
+                   'vote_value', 'num_votes')
+        rows = db.query(*[getattr(VoteValueCount, name) for name in columns]
+                        ).filter(VoteValueCount.vote_spec_id.in_(spec_ids),
+                                 VoteValueCount.num_votes > 0,
+                                 VoteValueCount.idea_id.in_(ranks.keys())
+                        ).order_by(case(ranks, value=VoteValueCount.idea_id)
+                        ).yield_per(10000)
+        for idea_id, idea_rows in groupby(rows, itemgetter(1)):
+            yield idea_id, cls(columns, list(idea_rows))
+
+
+class VoteResultsCache(object):
+    """Computed vote results, kept in a dogpile cache region along with
+    a generation token for each vote specification they depend on.
+
+    Votes created, replaced or tombstoned renew the generation of their
+    specification when the session is committed; until then, the session
+    does not use the cache."""
+
+    def __init__(self):
+        self._region = None
+
+    @property
+    def region(self):
+        if self._region is None:
+            self._region = get_shared_cache_region('vote_results')
+            if self._region is None:
+                log.error("Could not setup the shared vote results cache. "
+                          "Using a process-local cache.")
+                self._region = make_region().configure(
+                    'dogpile.cache.memory')
+        return self._region
+
+    @staticmethod
+    def generation_key(spec_id):
+        return "g_%d" % (spec_id, )
+
+    def get(self, db, spec_ids, key, compute):
+        """The cached value of key, or the result of compute()."""
+        changed = db.info.get('vote_spec_changes', ())
+        if any(spec_id in changed for spec_id in spec_ids):
+            return compute()
+        keys = [self.generation_key(spec_id) for spec_id in spec_ids]
+        values = [None if v is NO_VALUE else v
+                  for v in self.region.get_multi(keys + [key])]
+        generations = tuple(values[:-1])
+        entry = values[-1]
+        if entry is not None and entry[0] == generations:
+            return entry[1]
+        results = compute()
+        self.region.set(key, (generations, results))
+        return results
+
+    def invalidate(self, spec_ids):
+        self.region.set_multi({
+            self.generation_key(spec_id): uuid4().hex
+            for spec_id in spec_ids})
+
+    @staticmethod
+    def mark_changed(db, spec_id):
+        db.info.setdefault('vote_spec_changes', set()).add(spec_id)
+
+
+vote_results_cache = VoteResultsCache()
+
 
 class AbstractVoteSpecification(DiscussionBoundBase):
     """The representation of a way to vote on an idea.
@@ -92,39 +246,73 @@ class AbstractVoteSpecification(DiscussionBoundBase):
     # Do we want an URL to get the vote result on a specific spec+target combination?
 
     @abstractmethod
-    def results_for(self, voting_results, histogram_size=None):
+    def tally(self, votes, histogram_size=None):
+        """The results of each voted idea, by idea id,
+        given the :py:class:`VoteArrays` of this specification."""
         return {
-            "n": len(voting_results)
+            idea_id: {"n": n}
+            for (idea_id, n) in zip(votes.ideas.tolist(),
+                                    votes.per_idea().tolist())
         }
 
-    def _gather_results(self):
-        vote_cls = self.get_vote_class()
-        voting_results = self.db.query(vote_cls).filter_by(
-            vote_spec_id=self.id,
-            tombstone_date=None)
-        by_idea = defaultdict(list)
-        for vote in voting_results:
-            by_idea[vote.idea_id].append(vote)
-        return by_idea
+    # The vote columns used to compute results
+    result_columns = ('idea_id', 'voter_id', 'vote_value')
 
-    def voting_results(self, histogram_size=None):
-        by_idea = self._gather_results()
+    def _vote_arrays(self):
+        return VoteArrays.counted(self.db, [self.id])
+
+    def _compute_voting_results(self, histogram_size=None):
+        votes = self._vote_arrays()
         results = {
-            Idea.uri_generic(votable_id):
-            self.results_for(voting_results, histogram_size)
-            for (votable_id, voting_results) in by_idea.iteritems()
+            Idea.uri_generic(votable_id): idea_results
+            for (votable_id, idea_results)
+            in self.tally(votes, histogram_size).iteritems()
         }
         results["n_voters"] = self.db.query(
-            getattr(self.get_vote_class(), "voter_id")).filter_by(
-            vote_spec_id=self.id,
-            tombstone_date=None).distinct().count()
-
+            func.count(VoteSpecVoter.voter_id)).filter(
+                VoteSpecVoter.vote_spec_id == self.id,
+                VoteSpecVoter.num_votes > 0).scalar()
         return results
 
+    def voting_results(self, histogram_size=None):
+        return vote_results_cache.get(
+            self.db, [self.id], "r_%d_%s" % (self.id, histogram_size),
+            lambda: self._compute_voting_results(histogram_size))
+
     @abstractmethod
-    def csv_results(self, csv_file):
+    def csv_fieldnames(self, histogram_size=None):
         pass
 
+    @abstractmethod
+    def csv_rows(self, histogram_size=None):
+        "The rows of the CSV results, as dictionaries, generated lazily"
+        pass
+
+    def csv_results(self, csv_file, histogram_size=None):
+        dw = DictWriter(csv_file, self.csv_fieldnames(histogram_size),
+                        dialect='excel', delimiter=';')
+        dw.writeheader()
+        for row in self.csv_rows(histogram_size):
+            dw.writerow(row)
+
+    def _ordered_results(self, histogram_size=None):
+        """Generate (idea name, results) for each voted idea,
+        depth first in the idea graph.
+
+        The votes are read in that order, and each idea is tallied
+        as soon as its votes are read."""
+        ordered_idea_ids = Idea.visit_idea_ids_depth_first(
+            AppendingVisitor(), self.get_discussion_id())
+        if not ordered_idea_ids:
+            return
+        idea_names = dict(self.db.query(Idea.id, Idea.short_title).filter(
+            Idea.id.in_(ordered_idea_ids)))
+        for idea_id, votes in VoteArrays.counted_by_idea(
+                self.db, [self.id], ordered_idea_ids):
+            idea_results = self.tally(votes, histogram_size).get(idea_id)
+            if idea_results:
+                yield (idea_names[idea_id].encode('utf-8'), idea_results)
+
     def votes_of_current_user(self):
         "CAN ONLY BE CALLED FROM API V2"
         from ..auth.util import get_current_user_id
@@ -223,15 +411,6 @@ class AbstractVoteSpecification(DiscussionBoundBase):
     crud_permissions = CrudPermissions(P_ADMIN_DISC, P_READ)
 
 
-def empty_matrix(size, dim):
-    if dim == 0:
-        return 0
-    if dim == 1:
-        # shortcut
-        return [0] * size
-    return [empty_matrix(size, dim-1) for i in range(size)]
-
-
 class TokenVoteSpecification(AbstractVoteSpecification):
     __tablename__ = "token_vote_specification"
     __mapper_args__ = {
@@ -242,48 +421,53 @@ class TokenVoteSpecification(AbstractVoteSpecification):
         Integer, ForeignKey(AbstractVoteSpecification.id), primary_key=True)
     exclusive_categories = Column(Boolean, default=False)
 
-    def results_for(self, voting_results, histogram_size=None):
-        sums = defaultdict(int)
-        nums = defaultdict(int)
-        for v in voting_results:
-            sums[v.token_category_id] += v.vote_value
-            nums[v.token_category_id] += 1
-        specs = {spec.id: spec.typename for spec in self.token_categories}
-        sums = {specs[id]: total for (id, total) in sums.iteritems()}
-        nums = {specs[id]: total for (id, total) in nums.iteritems()}
+    def tally(self, votes, histogram_size=None):
+        results = super(TokenVoteSpecification, self).tally(votes)
+        categories = sorted(
+            (spec.id, spec.typename) for spec in self.token_categories)
+        category_ids = np.array([id for (id, _) in categories], np.int64)
+        voted = np.in1d(votes.token_category_id, category_ids)
+        size = len(votes.ideas) * len(categories)
+        if not size:
+            for idea_results in results.itervalues():
+                idea_results.update(nums={}, sums={})
+            return results
+        cells = votes.idea_index[voted] * len(categories) + np.searchsorted(
+            category_ids, votes.token_category_id[voted])
+        shape = (len(votes.ideas), len(categories))
+        nums = votes.count_cells(cells, size, rows=voted).reshape(shape)
+        sums = votes.count_cells(
+            cells, size, votes.vote_value[voted], voted).reshape(shape)
+        for n, idea_id in enumerate(votes.ideas.tolist()):
+            idea_nums = nums[n].tolist()
+            idea_sums = sums[n].tolist()
+            results[idea_id].update(
+                nums={typename: idea_nums[c]
+                      for (c, (_, typename)) in enumerate(categories)
+                      if idea_nums[c]},
+                sums={typename: int(idea_sums[c])
+                      for (c, (_, typename)) in enumerate(categories)
+                      if idea_nums[c]})
+        return results
+
+    def _names_from_type(self):
         return {
-            "n": len(voting_results),
-            "nums": nums,
-            "sums": sums
+            spec.typename: spec.name.first_original().value.encode('utf-8')
+            for spec in self.token_categories
         }
 
-    def csv_results(self, csv_file, histogram_size=None):
-        specs = self.token_categories
-        names_from_type = {
-            spec.typename: spec.name.first_original().value.encode('utf-8') for spec in specs
-        }
-        spec_names = names_from_type.values()
+    def csv_fieldnames(self, histogram_size=None):
+        spec_names = self._names_from_type().values()
         spec_names.sort()
         spec_names.insert(0, "idea")
-        dw = DictWriter(csv_file, spec_names, dialect='excel', delimiter=';')
-        dw.writeheader()
-        by_idea = self._gather_results()
-        values = {
-            votable_id: self.results_for(voting_results)
-            for (votable_id, voting_results) in by_idea.iteritems()
-        }
-        idea_names = dict(self.db.query(Idea.id, Idea.short_title).filter(
-            Idea.id.in_(by_idea.keys())))
-        idea_names = {
-            id: name.encode('utf-8') for (id, name) in idea_names.iteritems()}
-        ordered_idea_ids = Idea.visit_idea_ids_depth_first(
-            AppendingVisitor(), self.get_discussion_id())
-        ordered_idea_ids = [id for id in ordered_idea_ids if id in values]
-        for idea_id in ordered_idea_ids:
-            base = values[idea_id]
+        return spec_names
+
+    def csv_rows(self, histogram_size=None):
+        names_from_type = self._names_from_type()
+        for idea_name, base in self._ordered_results():
             sums = {names_from_type[k]: v for (k, v) in base['sums'].iteritems()}
-            sums['idea'] = idea_names[idea_id]
-            dw.writerow(sums)
+            sums['idea'] = idea_name
+            yield sums
 
     @classmethod
     def get_vote_class(cls):
@@ -402,125 +586,124 @@ class LickertVoteSpecification(AbstractVoteSpecification):
                         for spec in group_specs
                     }
                 if histogram_size:
-                    self.joint_histogram(
-                        group_specs, histogram_size, base_results)
-                print(base_results)
+                    spec_ids = [spec.id for spec in group_specs]
+                    base_results.update(vote_results_cache.get(
+                        self.db, spec_ids, "j_%s_%d" % (
+                            "_".join(map(str, spec_ids)), histogram_size),
+                        lambda: self.joint_histogram(
+                            group_specs, histogram_size, {})))
                 return base_results
         return super(LickertVoteSpecification, self
                      ).voting_results(histogram_size)
 
+    def bins(self, values, histogram_size):
+        """The histogram bin of each vote value."""
+        bin_size = float(self.maximum - self.minimum) / histogram_size
+        if not bin_size:
+            return np.zeros(len(values), np.int64)
+        # truncate towards zero, then clip
+        bins = ((values - self.minimum) / bin_size).astype(np.int64)
+        return np.clip(bins, 0, histogram_size - 1)
+
     @classmethod
     def joint_histogram(
-            cls, group_specs, histogram_size, joint_histograms,
-            votes_by_idea_user_spec=None):
-        if votes_by_idea_user_spec is None:
-            votes_by_idea_user_spec = defaultdict(lambda: defaultdict(dict))
-            for spec in group_specs:
-                votes_by_idea = spec._gather_results()
-                for idea_id, votes in votes_by_idea.iteritems():
-                    for vote in votes:
-                        votes_by_idea_user_spec[idea_id][
-                            vote.voter_id][spec] = vote
-        bin_sizes = {
-            spec: float(spec.maximum - spec.minimum) / histogram_size
-            for spec in group_specs
-        }
-        group_spec_ids = {x.id for x in group_specs}
-        group_signature = ",".join([spec.uri() for spec in group_specs])
-        joint_histograms[group_signature] = histograms_by_idea = {}
-        sums = [0] * len(group_specs)
-        sum_squares = [0] * len(group_specs)
-        sum_prods = 0
-        for idea_id, votes_by_user_spec in votes_by_idea_user_spec.iteritems():
-            histogram = empty_matrix(histogram_size, len(group_specs))
-            results = dict(histogram=histogram)
-            histograms_by_idea[Idea.uri_generic(idea_id)] = results
-            n = 0
-            for votes_by_spec in votes_by_user_spec.itervalues():
-                spec_ids = {spec.id for spec in votes_by_spec}
-                if group_spec_ids <= spec_ids:  # only full
-                    n += 1
-                    h = histogram
-                    prod = 1
-                    for gn, spec in enumerate(group_specs):
-                        vote_val = votes_by_spec[spec].vote_value
-                        sums[gn] += vote_val
-                        sum_squares[gn] += vote_val*vote_val
-                        prod *= vote_val
-                        bin_num = int((vote_val - spec.minimum)
-                                      / bin_sizes[spec])
-                        bin_num = min(bin_num, histogram_size-1)
-                        bin_num = max(bin_num, 0)
-                        if gn == len(group_specs) - 1:
-                            h[bin_num] += 1
-                        else:
-                            h = h[bin_num]
-                    sum_prods += prod
-            results['n'] = n
-            if len(group_specs) == 2 and n > 1:
-                try:
-                    b1 = (sums[0]*sums[1] - n*sum_prods
-                          ) / (sums[0]*sums[0] - n*sum_squares[0])
-                    b0 = (sums[1] - b1*sums[0])/n
-                    results['b0'] = b0
-                    results['b1'] = b1
-                except ZeroDivisionError:
-                    pass
-
-        if len(group_specs) > 2:
-            # eliminate a dimension and recurse
-            for n in range(len(group_specs)):
-                sub_group_specs = group_specs[:n] + group_specs[n+1:]
-                cls.joint_histogram(
-                    sub_group_specs, histogram_size, joint_histograms,
-                    votes_by_idea_user_spec)
-
-    def results_for(self, voting_results, histogram_size=None):
-        base = super(LickertVoteSpecification, self).results_for(voting_results)
-        n = len(voting_results)
-        avg = sum((r.vote_value for r in voting_results)) / n
-        moment2 = sum((r.vote_value**2 for r in voting_results)) / n
-        var = moment2 - avg**2
-        std_dev = math.sqrt(var)
-        base.update(dict(avg=avg, std_dev=std_dev))
+            cls, group_specs, histogram_size, joint_histograms, votes=None):
+        """Add the joint histograms of voters who voted on all the specs
+        of each sub-group (of two or more) of these specs,
+        with a linear regression for pairs of specs."""
+        if votes is None:
+            votes = VoteArrays.query(
+                group_specs[0].db, cls.get_vote_class(),
+                [spec.id for spec in group_specs], cls.result_columns)
+        num_specs = len(group_specs)
+        num_ideas = len(votes.ideas)
+        # One row per (idea, voter), one column per spec
+        spec_ids = np.array([spec.id for spec in group_specs], np.int64)
+        spec_order = np.argsort(spec_ids)
+        spec_index = spec_order[np.searchsorted(
+            spec_ids[spec_order], votes.vote_spec_id)]
+        voters, voter_index = np.unique(votes.voter_id, return_inverse=True)
+        pairs, pair_index = np.unique(
+            votes.idea_index * len(voters) + voter_index, return_inverse=True)
+        pair_ideas = pairs // max(len(voters), 1)
+        matrix = np.empty((len(pairs), num_specs))
+        matrix.fill(np.nan)
+        matrix[pair_index, spec_index] = votes.vote_value
+        idea_ids = votes.ideas.tolist()
+        for size in range(num_specs, 1, -1):
+            for positions in combinations(range(num_specs), size):
+                specs = [group_specs[p] for p in positions]
+                group_signature = ",".join([spec.uri() for spec in specs])
+                joint_histograms[group_signature] = histograms_by_idea = {}
+                if not num_ideas:
+                    continue
+                values = matrix[:, list(positions)]
+                full = ~np.isnan(values).any(1)
+                values = values[full]
+                ideas = pair_ideas[full]
+                shape = (histogram_size,) * size
+                cells = np.ravel_multi_index(tuple(
+                    spec.bins(values[:, n], histogram_size)
+                    for (n, spec) in enumerate(specs)), shape)
+                histograms = np.bincount(
+                    ideas * (histogram_size ** size) + cells,
+                    minlength=num_ideas * histogram_size ** size
+                    ).reshape((num_ideas,) + shape)
+                counts = np.bincount(ideas, minlength=num_ideas)
+                if size == 2:
+                    x, y = values[:, 0], values[:, 1]
+                    sums_x = np.bincount(ideas, x, minlength=num_ideas)
+                    sums_y = np.bincount(ideas, y, minlength=num_ideas)
+                    sums_xx = np.bincount(ideas, x * x, minlength=num_ideas)
+                    sums_xy = np.bincount(ideas, x * y, minlength=num_ideas)
+                for i, idea_id in enumerate(idea_ids):
+                    n = int(counts[i])
+                    results = dict(histogram=histograms[i].tolist(), n=n)
+                    histograms_by_idea[Idea.uri_generic(idea_id)] = results
+                    if size == 2 and n > 1:
+                        denominator = sums_x[i] ** 2 - n * sums_xx[i]
+                        if denominator:
+                            b1 = (sums_x[i] * sums_y[i] - n * sums_xy[i]
+                                  ) / denominator
+                            results['b0'] = float(
+                                (sums_y[i] - b1 * sums_x[i]) / n)
+                            results['b1'] = float(b1)
+        return joint_histograms
+
+    def tally(self, votes, histogram_size=None):
+        results = super(LickertVoteSpecification, self).tally(votes)
+        if not len(votes):
+            return results
+        counts = votes.per_idea()
+        avgs = votes.per_idea(votes.vote_value) / counts
+        moments2 = votes.per_idea(votes.vote_value ** 2) / counts
+        std_devs = np.sqrt(np.maximum(moments2 - avgs ** 2, 0))
         if histogram_size:
-            histogram = [0] * histogram_size
-            bin_size = float(self.maximum - self.minimum) / histogram_size
-            for vote in voting_results:
-                bin_num = int((vote.vote_value - self.minimum) / bin_size)
-                bin_num = min(bin_num, histogram_size-1)
-                bin_num = max(bin_num, 0)
-                histogram[bin_num] += 1
-            base['histogram'] = histogram
-        return base
+            histograms = votes.count_cells(
+                votes.idea_index * histogram_size + self.bins(
+                    votes.vote_value, histogram_size),
+                len(votes.ideas) * histogram_size
+                ).reshape(len(votes.ideas), histogram_size)
+        for n, idea_id in enumerate(votes.ideas.tolist()):
+            base = results[idea_id]
+            base.update(avg=float(avgs[n]), std_dev=float(std_devs[n]))
+            if histogram_size:
+                base['histogram'] = histograms[n].tolist()
+        return results
 
-    def csv_results(self, csv_file, histogram_size=None):
-        histogram_size = histogram_size or 10
-        bin_size = float(self.maximum - self.minimum) / histogram_size
-        bins = range(histogram_size)
+    def csv_fieldnames(self, histogram_size=None):
+        bins = range(histogram_size or 10)
         bins.insert(0, "idea")
         bins.extend(["avg", "std_dev"])
-        dw = DictWriter(csv_file, bins, dialect='excel', delimiter=';')
-        dw.writeheader()
-        by_idea = self._gather_results()
-        values = {
-            votable_id: self.results_for(voting_results, histogram_size)
-            for (votable_id, voting_results) in by_idea.iteritems()
-        }
-        idea_names = dict(self.db.query(Idea.id, Idea.short_title).filter(
-            Idea.id.in_(by_idea.keys())))
-        idea_names = {
-            id: name.encode('utf-8') for (id, name) in idea_names.iteritems()}
-        ordered_idea_ids = Idea.visit_idea_ids_depth_first(
-            AppendingVisitor(), self.get_discussion_id())
-        ordered_idea_ids = [id for id in ordered_idea_ids if id in values]
-        for idea_id, base in ordered_idea_ids:
-            base = values[idea_id]
+        return bins
+
+    def csv_rows(self, histogram_size=None):
+        for idea_name, base in self._ordered_results(histogram_size or 10):
             r = dict(enumerate(base['histogram']))
-            r['idea'] = idea_names[idea_id]
+            r['idea'] = idea_name
             r['avg'] = base['avg']
             r['std_dev'] = base['std_dev']
-            dw.writerow(r)
+            yield r
 
     def is_valid_vote(self, vote):
         if not super(LickertVoteSpecification, self).is_valid_vote(vote):
@@ -533,38 +716,25 @@ class BinaryVoteSpecification(AbstractVoteSpecification):
         'polymorphic_identity': 'binary_vote_specification'
     }
 
-    def results_for(self, voting_results, histogram_size=None):
-        base = super(BinaryVoteSpecification, self).results_for(voting_results)
-        n = len(voting_results)
-        positive = len([r for r in voting_results if r.vote_value])
-        base["yes"] = positive
-        base["no"] = n - positive
-        return base
+    def tally(self, votes, histogram_size=None):
+        results = super(BinaryVoteSpecification, self).tally(votes)
+        positives = votes.per_idea(votes.vote_value != 0)
+        for n, idea_id in enumerate(votes.ideas.tolist()):
+            base = results[idea_id]
+            base["yes"] = int(positives[n])
+            base["no"] = base["n"] - base["yes"]
+        return results
 
-    def csv_results(self, csv_file, histogram_size=None):
-        dw = DictWriter(csv_file, ["idea", "yes", "no"],
-                        dialect='excel', delimiter=';')
-        dw.writeheader()
-        by_idea = self._gather_results()
-        values = {
-            votable_id: self.results_for(voting_results)
-            for (votable_id, voting_results) in by_idea.iteritems()
-        }
-        idea_names = dict(self.db.query(Idea.id, Idea.short_title).filter(
-            Idea.id.in_(by_idea.keys())))
-        idea_names = {
-            id: name.encode('utf-8') for (id, name) in idea_names.iteritems()}
-        ordered_idea_ids = Idea.visit_idea_ids_depth_first(
-            AppendingVisitor(), self.get_discussion_id())
-        ordered_idea_ids = [id for id in ordered_idea_ids if id in values]
-        for idea_id, base in ordered_idea_ids:
-            base = values[idea_id]
-            r = {
-                'idea': idea_names[idea_id],
+    def csv_fieldnames(self, histogram_size=None):
+        return ["idea", "yes", "no"]
+
+    def csv_rows(self, histogram_size=None):
+        for idea_name, base in self._ordered_results():
+            yield {
+                'idea': idea_name,
                 'yes': base['yes'],
                 'no': base['no']
             }
-            dw.writerow(r)
 
     @classmethod
     def get_vote_class(cls):
@@ -582,39 +752,37 @@ class MultipleChoiceVoteSpecification(AbstractVoteSpecification):
 
     num_choices = Column(Integer, nullable=False)
 
-    def results_for(self, voting_results, histogram_size=None):
-        base = super(
-            MultipleChoiceVoteSpecification, self).results_for(voting_results)
-        by_result = defaultdict(int)
-        for r in voting_results:
-            by_result[r.vote_value] += 1
-        base['results'] = dict(by_result)
-        return base
+    def tally(self, votes, histogram_size=None):
+        results = super(
+            MultipleChoiceVoteSpecification, self).tally(votes)
+        if not len(votes):
+            return results
+        choices = votes.vote_value.astype(np.int64)
+        num_choices = int(max(self.num_choices, choices.max() + 1))
+        counts = votes.count_cells(
+            votes.idea_index * num_choices + choices,
+            len(votes.ideas) * num_choices
+            ).reshape(len(votes.ideas), num_choices)
+        for n, idea_id in enumerate(votes.ideas.tolist()):
+            results[idea_id]['results'] = {
+                choice: count for (choice, count)
+                in enumerate(counts[n].tolist()) if count}
+        return results
 
-    def csv_results(self, csv_file, histogram_size=None):
-        candidates = [
-            c.encode('utf-8') for c in self.settings_json['candidates']]
-        cols = candidates[:]
+    def _candidates(self):
+        return [c.encode('utf-8') for c in self.settings_json['candidates']]
+
+    def csv_fieldnames(self, histogram_size=None):
+        cols = self._candidates()
         cols.insert(0, "idea")
-        dw = DictWriter(csv_file, cols, dialect='excel', delimiter=';')
-        dw.writeheader()
-        by_idea = self._gather_results()
-        values = {
-            votable_id: self.results_for(voting_results)
-            for (votable_id, voting_results) in by_idea.iteritems()
-        }
-        idea_names = dict(self.db.query(Idea.id, Idea.short_title).filter(
-            Idea.id.in_(by_idea.keys())))
-        idea_names = {
-            id: name.encode('utf-8') for (id, name) in idea_names.iteritems()}
-        ordered_idea_ids = Idea.visit_idea_ids_depth_first(
-            AppendingVisitor(), self.get_discussion_id())
-        ordered_idea_ids = [id for id in ordered_idea_ids if id in values]
-        for idea_id in ordered_idea_ids:
-            base = values[idea_id]
+        return cols
+
+    def csv_rows(self, histogram_size=None):
+        candidates = self._candidates()
+        for idea_name, base in self._ordered_results():
             r = {candidates[k]: n for (k, n) in base['results'].items()}
-            r['idea'] = idea_names[idea_id]
-            dw.writerow(r)
+            r['idea'] = idea_name
+            yield r
 
     @classmethod
     def get_vote_class(cls):
@@ -950,3 +1118,207 @@ class TokenIdeaVote(AbstractIdeaVote):
     @classmethod
     def external_typename(cls):
         return cls.__name__
+
+
+class VoteValueCount(Base):
+    """The number of live votes with a given value on an idea,
+    for a vote specification (and token category, if any)"""
+    __tablename__ = 'vote_value_count'
+
+    vote_spec_id = Column(Integer, ForeignKey(
+        AbstractVoteSpecification.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    idea_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    # 0 for votes without a token category
+    token_category_id = Column(Integer, primary_key=True, default=0)
+    vote_value = Column(Float, primary_key=True)
+    num_votes = Column(Integer, nullable=False, default=0)
+
+
+class VoteSpecVoter(Base):
+    """The number of live votes of a voter for a vote specification"""
+    __tablename__ = 'vote_spec_voter'
+
+    vote_spec_id = Column(Integer, ForeignKey(
+        AbstractVoteSpecification.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    voter_id = Column(Integer, ForeignKey(
+        User.id, ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    num_votes = Column(Integer, nullable=False, default=0)
+
+
+_vote_columns = (
+    'tombstone_date', 'vote_spec_id', 'idea_id', 'voter_id', 'vote_value',
+    'token_category_id')
+
+
+def _vote_state(target, previous=False):
+    """The vote columns of the target, before the flush if previous."""
+    values = {}
+    for name in _vote_columns:
+        if not hasattr(target.__class__, name):
+            values[name] = None
+        elif previous:
+            history = attributes.get_history(target, name)
+            values[name] = (
+                history.deleted or history.unchanged or history.added
+                or (None,))[0]
+        else:
+            values[name] = getattr(target, name)
+    return values
+
+
+def _record_vote(target, values, delta):
+    session = attributes.instance_state(target).session
+    spec_id = values['vote_spec_id']
+    if session is None or spec_id is None:
+        return
+    _mark_vote_change(target, spec_id)
+    if values['tombstone_date'] is not None or values['vote_value'] is None:
+        return
+    deltas = session.info.setdefault('vote_count_deltas', defaultdict(int))
+    deltas[(VoteValueCount.__tablename__, (
+        spec_id, values['idea_id'], values['token_category_id'] or 0,
+        float(values['vote_value'])))] += delta
+    deltas[(VoteSpecVoter.__tablename__, (
+        spec_id, values['voter_id']))] += delta
+
+
+@event.listens_for(AbstractIdeaVote, 'after_insert', propagate=True)
+def vote_insert_listener(mapper, connection, target):
+    _record_vote(target, _vote_state(target), 1)
+
+
+@event.listens_for(AbstractIdeaVote, 'after_update', propagate=True)
+def vote_update_listener(mapper, connection, target):
+    # Replaced votes are tombstoned (updated) and copied (inserted)
+    _record_vote(target, _vote_state(target, True), -1)
+    _record_vote(target, _vote_state(target), 1)
+
+
+@event.listens_for(AbstractIdeaVote, 'after_delete', propagate=True)
+def vote_delete_listener(mapper, connection, target):
+    _record_vote(target, _vote_state(target, True), -1)
+
+
+def _mark_vote_change(target, spec_id):
+    session = attributes.instance_state(target).session
+    if session is not None and spec_id is not None:
+        VoteResultsCache.mark_changed(session, spec_id)
+
+
+@event.listens_for(AbstractVoteSpecification, 'after_update', propagate=True)
+def vote_spec_change_listener(mapper, connection, target):
+    _mark_vote_change(target, target.id)
+
+
+@event.listens_for(TokenCategorySpecification, 'after_update')
+def token_category_change_listener(mapper, connection, target):
+    _mark_vote_change(target, target.token_vote_specification_id)
+
+
+_counter_tables = {cls.__tablename__: cls.__table__
+                   for cls in (VoteValueCount, VoteSpecVoter)}
+
+
+def apply_vote_count_deltas(session, flush_context):
+    deltas = session.info.pop('vote_count_deltas', None)
+    if not deltas:
+        return
+    connection = session.connection()
+    # Sorted, so concurrent transactions lock rows in the same order
+    for (tablename, key), delta in sorted(deltas.iteritems()):
+        if delta:
+            increment_counter(connection, _counter_tables[tablename],
+                              key, delta, 'num_votes')
+
+
+def vote_results_after_commit_listener(session):
+    spec_ids = session.info.pop('vote_spec_changes', None)
+    if spec_ids:
+        vote_results_cache.invalidate(spec_ids)
+
+
+def vote_results_rollback_listener(session):
+    session.info.pop('vote_spec_changes', None)
+    session.info.pop('vote_count_deltas', None)
+
+
+event.listen(Session, 'after_flush', apply_vote_count_deltas)
+event.listen(Session, 'after_commit', vote_results_after_commit_listener)
+event.listen(Session, 'after_rollback', vote_results_rollback_listener)
+
+
+def _expected_vote_counts(db, spec_ids=None):
+    """The vote counters, recomputed from the live votes."""
+    counts = {}
+    for vote_cls in (LickertIdeaVote, BinaryIdeaVote,
+                     MultipleChoiceIdeaVote, TokenIdeaVote):
+        key_columns = [
+            vote_cls.vote_spec_id, vote_cls.idea_id,
+            getattr(vote_cls, 'token_category_id', None),
+            vote_cls.vote_value]
+        key_columns = [c for c in key_columns if c is not None]
+        query = db.query(*(key_columns + [func.count(vote_cls.id)])
+                         ).select_from(vote_cls).filter(
+                            vote_cls.tombstone_date == None
+                         ).group_by(*key_columns)
+        if spec_ids is not None:
+            query = query.filter(vote_cls.vote_spec_id.in_(spec_ids))
+        for row in query:
+            if len(row) == 4:
+                row = (row[0], row[1], None, row[2], row[3])
+            spec_id, idea_id, category_id, value, num_votes = row
+            counts[(VoteValueCount.__tablename__, (
+                spec_id, idea_id, category_id or 0, float(value)))
+                ] = num_votes
+    query = db.query(
+        AbstractIdeaVote.vote_spec_id, AbstractIdeaVote.voter_id,
+        func.count(AbstractIdeaVote.id)).filter(
+            AbstractIdeaVote.tombstone_date == None).group_by(
+            AbstractIdeaVote.vote_spec_id, AbstractIdeaVote.voter_id)
+    if spec_ids is not None:
+        query = query.filter(AbstractIdeaVote.vote_spec_id.in_(spec_ids))
+    for (spec_id, voter_id, num_votes) in query:
+        counts[(VoteSpecVoter.__tablename__, (spec_id, voter_id))
+               ] = num_votes
+    return counts
+
+
+def rebuild_vote_counts(db, spec_ids=None, check_only=False):
+    """Compare the vote counters with the live votes, and rebuild them
+    unless check_only.
+
+    Returns the discrepancies, as a dictionary of (counter, expected)
+    values by (table name, primary key)."""
+    expected = _expected_vote_counts(db, spec_ids)
+    actual = {}
+    for tablename, table in _counter_tables.iteritems():
+        query = db.query(table).filter(table.c.num_votes != 0)
+        if spec_ids is not None:
+            query = query.filter(table.c.vote_spec_id.in_(spec_ids))
+        for row in query:
+            row = list(row)
+            actual[(tablename, tuple(row[:-1]))] = row[-1]
+    discrepancies = {
+        key: (actual.get(key, 0), expected.get(key, 0))
+        for key in set(actual) | set(expected)
+        if actual.get(key, 0) != expected.get(key, 0)}
+    if discrepancies and not check_only:
+        connection = db.connection()
+        for tablename, table in _counter_tables.iteritems():
+            delete = table.delete()
+            if spec_ids is not None:
+                delete = delete.where(table.c.vote_spec_id.in_(spec_ids))
+            connection.execute(delete)
+            pk_names = [c.name for c in table.primary_key.columns]
+            values = [dict(zip(pk_names, key), num_votes=num_votes)
+                      for ((name, key), num_votes) in expected.iteritems()
+                      if name == tablename]
+            if values:
+                connection.execute(table.insert(), values)
+        mark_changed(db)
+        for spec_id in {key[1][0] for key in discrepancies}:
+            VoteResultsCache.mark_changed(db, spec_id)
+    return discrepancies
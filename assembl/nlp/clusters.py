@@ -7,13 +7,16 @@ from os.path import join, exists
 from os import makedirs, unlink
 from itertools import chain, groupby
 from random import Random
-
-from sqlalchemy import (text, column, bindparam)
-from sqlalchemy.orm import defer, with_polymorphic
-from gensim import corpora, models as gmodels, similarities
-from gensim.utils import tokenize as gtokenize
+from uuid import uuid4
+
+from sqlalchemy import (text, column, bindparam, or_)
+from sqlalchemy.orm import with_polymorphic
+from sqlalchemy.sql.functions import max as sql_max
+from gensim import corpora, models as gmodels
+from gensim.utils import (
+    tokenize as gtokenize, pickle as gpickle, unpickle as gunpickle)
 import numpy as np
-from scipy.sparse import lil_matrix
+from scipy.sparse import csr_matrix
 import sklearn.cluster
 from sklearn.metrics.pairwise import pairwise_distances
 from sklearn.metrics.cluster.unsupervised import (
@@ -25,6 +28,7 @@ from assembl.lib.config import get_config
 from assembl.models import (
     Content, Idea, Discussion, RootIdea, Post, IdeaLink, LangStringEntry, Locale)
 from .indexedcorpus import IdMmCorpus
+from .vectorindex import VectorIndex
 from . import (
     get_stop_words, get_stemmer, DummyStemmer, ReversibleStemmer)
 
@@ -33,6 +37,8 @@ DICTIONARY_FNAME = 'dico.dict'
 STEMS_FNAME = 'stems.dict'
 PHRASES_FNAME = 'phrases.model'
 CORPUS_FNAME = 'posts.mm'
+STATE_FNAME = 'corpus_state.pickle'
+DEFAULT_DRIFT_THRESHOLD = 0.2
 
 
 class Tokenizer(object):
@@ -99,6 +105,50 @@ class BOWizer(object):
         self.dictionary.save(join(dirname, DICTIONARY_FNAME))
 
 
+class CorpusState(object):
+    """What was indexed in the corpus of a language.
+
+    The corpus is built from scratch, and then new posts are appended
+    to it. ``build_id`` identifies the full build; models derived from the
+    corpus are rebuilt when it changes. ``model_num_terms`` is the size of
+    the dictionary at build time: terms added later are ignored by models.
+    Vocabulary drift is the proportion of tokens of the corpus that are
+    outside of that initial vocabulary."""
+
+    def __init__(self, last_post_ids=None, model_num_terms=0,
+                 tokens=0, new_term_tokens=0):
+        self.build_id = uuid4().hex
+        self.last_post_ids = last_post_ids or {}
+        self.model_num_terms = model_num_terms
+        self.tokens = tokens
+        self.new_term_tokens = new_term_tokens
+
+    @property
+    def drift(self):
+        return float(self.new_term_tokens) / (self.tokens or 1)
+
+    def count_tokens(self, bows):
+        model_num_terms = self.model_num_terms
+        for bow in bows:
+            for termid, count in bow:
+                self.tokens += count
+                if termid >= model_num_terms:
+                    self.new_term_tokens += count
+
+    @staticmethod
+    def fname(lang):
+        return join(nlp_data, lang, STATE_FNAME)
+
+    @classmethod
+    def load(cls, lang):
+        fname = cls.fname(lang)
+        if exists(fname):
+            return gunpickle(fname)
+
+    def save(self, lang):
+        gpickle(self, self.fname(lang))
+
+
 def identity(x):
     return x
 
@@ -131,15 +181,17 @@ class Scrambler(object):
 class SemanticAnalysisData(object):
     _corpora = None
     _corpus = None
+    _corpus_state = None
     _dictionary = None
     _post_ids = None
     _tfidf_model = None
     _gensim_model = None
     _subcorpus = None
-    _similarity_matrix = None
+    _similarity_index = None
     _stemmer = None
     _trans = None
     _topic_intensities = None
+    _topic_matrix = None
     _model_matrix = None
     _ideas_by_post = None
     _idea_hry = None
@@ -345,6 +397,11 @@ class SemanticAnalysisData(object):
             self._broadest_ideas_by_post = broadest_ideas_by_post
         return self._broadest_ideas_by_post
 
+    @staticmethod
+    def drift_threshold():
+        return float(get_config().get(
+            'nlp.drift_threshold', DEFAULT_DRIFT_THRESHOLD))
+
     def create_dictionaries(self, all_languages=False):
         db = self.discussion.db
         by_main_lang = defaultdict(list)
@@ -366,36 +423,90 @@ class SemanticAnalysisData(object):
             if not exists(dirname):
                 makedirs(dirname)
             corpus_fname = join(dirname, CORPUS_FNAME)
-            if exists(corpus_fname):
-                corpus = IdMmCorpus(corpus_fname)
-                doc_count = db.query(Content).with_polymorphic(
-                    Content).options(defer(Content.like_count)).join(
-                    Discussion).filter(Discussion.id.in_(discussion_ids)
-                                       ).count()
-                if corpus.num_docs == doc_count:
-                    corpora[lang] = corpus
-                    if my_discussion_lang == lang:
-                        self._corpus = corpus
-                    continue
-            tokenizer = Tokenizer(lang)
-            bowizer = BOWizer(lang, tokenizer, False)
-            posts = db.query(Content).join(Discussion).filter(
-                Discussion.id.in_(discussion_ids))
-            bowizer.phrases.add_vocab((
-                tokenizer.tokenize_post(post) for post in posts))
-            bowizer.dictionary.add_documents((
-                bowizer.phrases[tokenizer.tokenize_post(post)]
-                for post in posts))
-            IdMmCorpus.serialize(corpus_fname, (
-                (post.id, bowizer.post_to_bow(post))
-                for post in posts))
-            bowizer.save()
-            corpus = IdMmCorpus(corpus_fname)
+            state = CorpusState.load(lang)
+            corpus = None
+            if exists(corpus_fname) and state is not None:
+                corpus = self.update_corpus(lang, discussion_ids, state)
+            if corpus is None:
+                corpus = self.build_corpus(lang, discussion_ids)
             corpora[lang] = corpus
             if my_discussion_lang == lang:
                 self._corpus = corpus
         return corpora
 
+    def build_corpus(self, lang, discussion_ids):
+        """Build the corpus of a language from scratch."""
+        db = self.discussion.db
+        corpus_fname = join(nlp_data, lang, CORPUS_FNAME)
+        tokenizer = Tokenizer(lang)
+        bowizer = BOWizer(lang, tokenizer, False)
+        posts = db.query(Content).join(Discussion).filter(
+            Discussion.id.in_(discussion_ids))
+        bowizer.phrases.add_vocab((
+            tokenizer.tokenize_post(post) for post in posts))
+        bowizer.dictionary.add_documents((
+            bowizer.phrases[tokenizer.tokenize_post(post)]
+            for post in posts))
+        state = CorpusState(
+            dict(db.query(Content.discussion_id, sql_max(Content.id)).filter(
+                Content.discussion_id.in_(discussion_ids)).group_by(
+                Content.discussion_id)),
+            len(bowizer.dictionary))
+
+        def bows():
+            for post in posts:
+                bow = bowizer.post_to_bow(post)
+                state.count_tokens((bow, ))
+                yield (post.id, bow)
+        IdMmCorpus.serialize(corpus_fname, bows())
+        bowizer.save()
+        state.save(lang)
+        return IdMmCorpus(corpus_fname)
+
+    def update_corpus(self, lang, discussion_ids, state):
+        """Append the posts created since the last update to the corpus
+        of a language, and extend its dictionary.
+
+        Returns None if the vocabulary drifted too much, and the corpus
+        should be rebuilt."""
+        db = self.discussion.db
+        corpus_fname = join(nlp_data, lang, CORPUS_FNAME)
+        last_post_ids = state.last_post_ids
+        posts = db.query(Content).filter(or_(*[
+            (Content.discussion_id == discussion_id)
+            & (Content.id > last_post_ids.get(discussion_id, 0))
+            for discussion_id in discussion_ids])).order_by(Content.id)
+        tokenizer = Tokenizer(lang)
+        tokens = [(post.discussion_id, post.id, tokenizer.tokenize_post(post))
+                  for post in posts]
+        if not tokens:
+            return IdMmCorpus(corpus_fname)
+        bowizer = BOWizer(lang, tokenizer)
+        bowizer.phrases.add_vocab((t for (_, _, t) in tokens))
+        phrased = [(d_id, post_id, bowizer.phrases[t])
+                   for (d_id, post_id, t) in tokens]
+        bowizer.dictionary.add_documents((p for (_, _, p) in phrased))
+        bows = [(post_id, bowizer.dictionary.doc2bow(p))
+                for (_, post_id, p) in phrased]
+        state.count_tokens((bow for (_, bow) in bows))
+        if state.drift > self.drift_threshold():
+            return None
+        IdMmCorpus.append(corpus_fname, bows, len(bowizer.dictionary))
+        bowizer.save()
+        for (discussion_id, post_id, _) in phrased:
+            last_post_ids[discussion_id] = max(
+                post_id, last_post_ids.get(discussion_id, 0))
+        state.save(lang)
+        return IdMmCorpus(corpus_fname)
+
+    @property
+    def corpus_state(self):
+        if self._corpus_state is None:
+            # make sure the corpus is up to date
+            _ = self.corpus
+            self._corpus_state = CorpusState.load(self.lang)
+        return self._corpus_state
+
     @property
     def lang(self):
         return self.discussion.discussion_locales[0].split('_')[0]
@@ -444,6 +555,25 @@ class SemanticAnalysisData(object):
             self._subcorpus = self.corpus[self.post_ids]
         return self._subcorpus
 
+    def new_post_ids(self, model):
+        """The ids of the posts of the discussion that are not yet
+        included in the model, or None if the model must be rebuilt."""
+        if getattr(model, 'build_id', None) != self.corpus_state.build_id:
+            return None
+        post_ids = self.post_ids
+        return post_ids[post_ids > model.indexed_post_id]
+
+    def _set_indexed(self, model):
+        model.build_id = self.corpus_state.build_id
+        model.indexed_post_id = self.post_ids[-1]
+
+    def _initial_vocabulary(self, bows):
+        # The tfidf model only knows the initial vocabulary,
+        # and will filter out newer terms for the other models.
+        model_num_terms = self.corpus_state.model_num_terms
+        return ([(termid, val) for (termid, val) in bow
+                 if termid < model_num_terms] for bow in bows)
+
     @property
     def tfidf_model(self):
         if self._tfidf_model is None:
@@ -451,83 +581,129 @@ class SemanticAnalysisData(object):
             if doc_count < 10:
                 return None
             dictionary = self.dictionary
-            tfidf_model = gmodels.TfidfModel(id2word=dictionary)
             tfidf_fname = join(self.dirname, "tfidf_%d.model" % (
                 self.discussion.id,))
-            subcorpus = self.subcorpus
+            tfidf_model = None
             if exists(tfidf_fname):
-                tfidf_model = tfidf_model.load(tfidf_fname)
-                # assumption: count implies identity.
-                # Wrong in corner cases: hidden, etc.
-                if tfidf_model.num_docs != doc_count:
+                tfidf_model = gmodels.TfidfModel.load(tfidf_fname)
+                new_post_ids = self.new_post_ids(tfidf_model)
+                if new_post_ids is None:
                     unlink(tfidf_fname)
-                    tfidf_model = gmodels.TfidfModel(id2word=dictionary)
-            if tfidf_model.num_docs != doc_count:
-                tfidf_model.initialize(subcorpus)
+                    tfidf_model = None
+                elif len(new_post_ids):
+                    # Update the document frequencies
+                    for bow in self._initial_vocabulary(
+                            self.corpus[new_post_ids]):
+                        tfidf_model.num_docs += 1
+                        tfidf_model.num_nnz += len(bow)
+                        for termid, _ in bow:
+                            tfidf_model.dfs[termid] = \
+                                tfidf_model.dfs.get(termid, 0) + 1
+                    wglobal = getattr(tfidf_model, 'wglobal',
+                                      gmodels.tfidfmodel.df2idf)
+                    tfidf_model.idfs = {
+                        termid: wglobal(df, tfidf_model.num_docs)
+                        for termid, df in tfidf_model.dfs.iteritems()}
+                    self._set_indexed(tfidf_model)
+                    tfidf_model.save(tfidf_fname)
+            if tfidf_model is None:
+                tfidf_model = gmodels.TfidfModel(id2word=dictionary)
+                tfidf_model.initialize(
+                    self._initial_vocabulary(self.subcorpus))
+                self._set_indexed(tfidf_model)
                 tfidf_model.save(tfidf_fname)
             self._tfidf_model = tfidf_model
         return self._tfidf_model
 
+    def _new_gensim_model(self, **model_kwargs):
+        dictionary = self.dictionary
+        model_num_terms = self.corpus_state.model_num_terms
+        if len(dictionary) > model_num_terms:
+            # Models only know the initial vocabulary
+            dictionary = {i: dictionary[i] for i in range(model_num_terms)}
+        return self.model_cls(
+            id2word=dictionary, num_topics=self.num_topics, **model_kwargs)
+
+    @staticmethod
+    def _add_to_gensim_model(gensim_model, tfidf_corpus):
+        if getattr(gensim_model, 'update', None):
+            gensim_model.update(tfidf_corpus)
+        elif getattr(gensim_model, 'add_documents', None):
+            gensim_model.add_documents(tfidf_corpus)
+
     @property
     def gensim_model(self):
         if self._gensim_model is None:
             doc_count = self.post_ids_query.count()
             if doc_count < 10:
                 return None
-            dictionary = self.dictionary
+            tfidf_model = self.tfidf_model
             discussion = self.discussion
             model_fname = join(self.dirname, "model_%s_%d.model" % (
                 self.model_cls.__name__, discussion.id,))
             model_kwargs = {}  # self.gensim_model_kwargs
-            gensim_model = self.model_cls(
-                id2word=dictionary, num_topics=self.num_topics, **model_kwargs)
+            gensim_model = None
             if exists(model_fname):
-                gensim_model = gensim_model.load(model_fname)
+                gensim_model = self.model_cls.load(model_fname)
                 same_kwargs = all((
                     getattr(gensim_model, k) == v
                     for (k, v) in model_kwargs.iteritems()))
-                same_kwargs = same_kwargs and getattr(
-                    gensim_model, 'num_updates', doc_count) == doc_count
+                new_post_ids = self.new_post_ids(gensim_model)
                 if not (same_kwargs
                         and gensim_model.num_topics == self.num_topics
-                        and gensim_model.docs_processed == doc_count):
+                        and new_post_ids is not None):
                     unlink(model_fname)
-                    gensim_model = self.model_cls(
-                        id2word=dictionary,
-                        num_topics=self.num_topics, **model_kwargs)
-            if gensim_model.docs_processed != doc_count:
-                subcorpus = self.subcorpus
-                tfidf_corpus = self.tfidf_model[subcorpus]
-                if getattr(gensim_model, 'update', None):
-                    gensim_model.update(tfidf_corpus)
-                elif getattr(gensim_model, 'add_documents', None):
-                    gensim_model.add_documents(tfidf_corpus)
-                gensim_model.docs_processed = doc_count
+                    gensim_model = None
+                elif len(new_post_ids):
+                    # Online update with the new posts only
+                    self._add_to_gensim_model(
+                        gensim_model, tfidf_model[self.corpus[new_post_ids]])
+                    self._set_indexed(gensim_model)
+                    gensim_model.save(model_fname)
+            if gensim_model is None:
+                gensim_model = self._new_gensim_model(**model_kwargs)
+                self._add_to_gensim_model(
+                    gensim_model, tfidf_model[self.subcorpus])
+                self._set_indexed(gensim_model)
                 gensim_model.save(model_fname)
             self._gensim_model = gensim_model
         return self._gensim_model
 
     @property
-    def similarity_matrix(self):
-        if self._similarity_matrix is None:
-            subcorpus = self.subcorpus
-            tfidf_model = self.tfidf_model
+    def similarity_index(self):
+        """A persistent vector index of the topic vectors of all posts.
+
+        New posts are appended, projected with the current model. The index
+        is rebuilt with the corpus, on a full build or when the vocabulary
+        drifted beyond ``nlp.drift_threshold``, as the models are then
+        retrained from scratch."""
+        if self._similarity_index is None:
             gensim_model = self.gensim_model
-            similarity_fname = join(
-                self.dirname, 'similarity_%d.model' % (self.discussion.id,))
-            similarity = None
-            if exists(similarity_fname):
-                similarity = similarities.MatrixSimilarity.load(
-                    similarity_fname)
-                if similarity.index.shape[0] != tfidf_model.num_docs:
-                    unlink(similarity_fname)
-                    similarity = None
-            if similarity is None:
-                similarity = similarities.MatrixSimilarity(
-                    gensim_model[tfidf_model[subcorpus]])
-                similarity.save(similarity_fname)
-            self._similarity_matrix = similarity
-        return self._similarity_matrix
+            if gensim_model is None:
+                return None
+            dirname = join(self.dirname, 'similarity_%s_%d' % (
+                self.model_cls.__name__, self.discussion.id))
+            build_id = self.corpus_state.build_id
+            with VectorIndex.updating(dirname):
+                index = VectorIndex.open(
+                    dirname, dim=self.num_topics, build_id=build_id)
+                if index.build_id != build_id or \
+                        index.dim != self.num_topics:
+                    VectorIndex.clear(dirname)
+                    index = VectorIndex.open(
+                        dirname, dim=self.num_topics, build_id=build_id)
+                post_ids = self.post_ids
+                max_id = index.max_id
+                if max_id is not None:
+                    post_ids = post_ids[post_ids > max_id]
+                if len(post_ids):
+                    vectors = self.gensimvecs_to_csr(
+                        gensim_model[self.tfidf_model[
+                            self.corpus[post_ids]]],
+                        self.num_topics, np.ones(self.num_topics))
+                    index.append(post_ids, vectors.toarray())
+            self._similarity_index = index
+        return self._similarity_index
 
     @property
     def stemmer(self):
@@ -564,31 +740,63 @@ class SemanticAnalysisData(object):
         return self._topic_intensities
 
     def gensimvecs_to_csr(self, vecs, width, topic_intensities):
-        model_matrix = lil_matrix(
-            (len(vecs), width), dtype=np.float64)
-        for nrow, row in enumerate(vecs):
-            for ncol, val in row:
-                model_matrix[nrow, ncol] = val * topic_intensities[ncol]
-        return model_matrix.tocsr()
+        vecs = list(vecs)
+        indptr = np.zeros(len(vecs) + 1, dtype=np.int64)
+        indptr[1:] = np.array(
+            [len(row) for row in vecs], dtype=np.int64).cumsum()
+        entries = np.fromiter(
+            chain.from_iterable(chain.from_iterable(vecs)), np.float64,
+            int(2 * indptr[-1])).reshape(-1, 2)
+        indices = entries[:, 0].astype(np.int32)
+        data = entries[:, 1] * topic_intensities[indices]
+        model_matrix = csr_matrix(
+            (data, indices, indptr), shape=(len(vecs), width))
+        model_matrix.sum_duplicates()
+        return model_matrix
+
+    def project(self, subcorpus):
+        """The topic matrix of a corpus, weighted by topic intensities."""
+        return self.gensimvecs_to_csr(
+            self.gensim_model[self.tfidf_model[subcorpus]],
+            self.num_topics, self.topic_intensities)
+
+    @property
+    def topic_matrix(self):
+        """The topic matrix of all posts, in post_ids order.
+
+        The corpus is transformed once; matrices of post subsets
+        are slices of this one."""
+        if self._topic_matrix is None:
+            if not self.tfidf_model or not self.gensim_model:
+                return None
+            self._topic_matrix = self.project(self.subcorpus)
+        return self._topic_matrix
+
+    def post_rows(self, post_ids):
+        """The rows of these posts in the topic matrix,
+        or None if some are not in the discussion posts."""
+        all_post_ids = self.post_ids
+        post_ids = np.asarray(post_ids, dtype=all_post_ids.dtype)
+        rows = all_post_ids.searchsorted(post_ids)
+        if len(rows) and (rows.max() >= len(all_post_ids) or np.any(
+                all_post_ids[rows] != post_ids)):
+            return None
+        return rows
 
     def make_model_matrix(self, post_ids=None):
-        num_topics = self.num_topics
-        tfidf_model = self.tfidf_model
-        gensim_model = self.gensim_model
-        if not tfidf_model or not gensim_model:
+        topic_matrix = self.topic_matrix
+        if topic_matrix is None:
             return None
         if post_ids is None:
             post_ids = self.post_ids
-            subcorpus = self.subcorpus
-        else:
-            corpus = self.corpus
-            subcorpus = corpus[post_ids]
         if len(post_ids) < 3 * self.min_samples:
             return None
-        tfidf_corpus = tfidf_model[subcorpus]
-        topic_intensities = self.topic_intensities
-        return self.gensimvecs_to_csr(
-            gensim_model[tfidf_corpus], num_topics, topic_intensities)
+        if post_ids is self.post_ids:
+            return topic_matrix
+        rows = self.post_rows(post_ids)
+        if rows is None:
+            return self.project(self.corpus[post_ids])
+        return topic_matrix[rows]
 
     @property
     def model_matrix(self):
@@ -596,6 +804,31 @@ class SemanticAnalysisData(object):
             self._model_matrix = self.make_model_matrix()
         return self._model_matrix
 
+    def cluster_centroids(self, post_clusters):
+        """The centroids of each cluster and of its complement
+        among all posts, as a list of pairs.
+
+        Complement centroids are derived from the sum of the whole
+        topic matrix minus the sum of the cluster."""
+        topic_matrix = self.topic_matrix
+        total = topic_matrix.sum(0).A1
+        num_posts = topic_matrix.shape[0]
+        centroids = []
+        for cluster in post_clusters:
+            rows = self.post_rows(cluster)
+            if rows is None:
+                cluster_matrix = self.project(self.corpus[cluster])
+            else:
+                rows = np.unique(rows)
+                cluster_matrix = topic_matrix[rows]
+            cluster_sum = cluster_matrix.sum(0).A1
+            cluster_size = cluster_matrix.shape[0]
+            complement_size = max(num_posts - cluster_size, 1)
+            centroids.append((
+                cluster_sum / max(cluster_size, 1),
+                (total - cluster_sum) / complement_size))
+        return centroids
+
     def parse_topic(self, topic, trans=identity):
         if not topic:
             return {}
@@ -606,26 +839,12 @@ class SemanticAnalysisData(object):
             for (v, k) in words))
 
     def calc_features(self, post_clusters):
-        corpus = self.corpus
-        tfidf_model = self.tfidf_model
         gensim_model = self.gensim_model
-        topic_intensities = self.topic_intensities
         trans = self.trans
         all_cluster_features = []
-        post_ids = self.post_ids
-        for cluster in post_clusters:
-            cluster_corpus = corpus[cluster]
-            clusterneg_corpus = corpus[
-                list(set(post_ids) - set(cluster))]
-
-            def centroid(corpus):
-                clust_lda = [gensim_model[tfidf_model[c]] for c in corpus]
-                clust_lda = self.gensimvecs_to_csr(
-                    clust_lda, self.num_topics, topic_intensities)
-                return clust_lda.sum(0).A1 / clust_lda.shape[0]
-
-            difference_vals = centroid(cluster_corpus) - \
-                centroid(clusterneg_corpus)
+        for centroid, complement_centroid in self.cluster_centroids(
+                post_clusters):
+            difference_vals = centroid - complement_centroid
             difference = difference_vals.argsort()
             extremes = defaultdict(float)
             for id in chain(difference[0:5], difference[-1:-6:-1]):
@@ -640,31 +859,36 @@ class SemanticAnalysisData(object):
             all_cluster_features.append((pos_terms, neg_terms))
         return all_cluster_features
 
-    def get_similar_posts(self, post_id=None, text=None, cutoff=0.15):
-        discussion = self.discussion
-        post_ids = discussion.db.query(Content.id).filter_by(
-            discussion_id=discussion.id).all()
-        post_ids = [x for (x,) in post_ids]
-        similarity = self.similarity_matrix
+    def get_similar_posts(self, post_id=None, text=None, cutoff=0.15,
+                          limit=100):
+        """The (post_id, score) of the posts closest to a post or a text,
+        by decreasing score, with scores above cutoff times the best one.
+
+        Suitable for live queries, as the index is memory-mapped and
+        only the limit best candidates are sorted."""
+        index = self.similarity_index
+        if index is None:
+            return []
         tfidf_model = self.tfidf_model
         gensim_model = self.gensim_model
-        lang = self.lang
-        bowizer = BOWizer(lang)
+        bowizer = BOWizer(self.lang)
         assert post_id or text, "Please give a text or a post_id"
         if post_id:
             words = bowizer.post_to_bow(Content.get(post_id))
         else:
             words = bowizer.text_to_bow(text)
-        query_vec = gensim_model[tfidf_model[words]]
-        results = [(v, post_ids[n])
-                   for (n, v) in enumerate(similarity[query_vec])]
-        results.sort(reverse=True)
+        query_vec = np.zeros(self.num_topics)
+        for (ncol, val) in gensim_model[tfidf_model[words]]:
+            query_vec[ncol] = val
+        # Ask for more to account for self and duplicates
+        post_ids, scores = index.query(query_vec, limit + 5)
         # forget self and duplicates
-        results = [x for x in results if x[0] < 0.999]
-        cutoff *= results[0][0]
-        results = [(post_id, score) for (score, post_id) in results
-                   if score > cutoff]
-        return results
+        keep = (scores < 0.999) & (post_ids != (post_id or 0))
+        post_ids, scores = post_ids[keep][:limit], scores[keep][:limit]
+        if not len(scores):
+            return []
+        keep = scores > cutoff * scores[0]
+        return zip(post_ids[keep].tolist(), scores[keep].tolist())
 
     def show_similar_posts(self, post_id=None, text=None, cutoff=0.15):
         discussion = self.discussion
@@ -672,7 +896,8 @@ class SemanticAnalysisData(object):
         post_ids = [x[0] for x in similar]
         posts = discussion.db.query(Content).filter(Content.id.in_(post_ids))
         posts = {post.id: post for post in posts}
-        results = [(posts[post_id], score) for (post_id, score) in similar]
+        results = [(posts[similar_id], score)
+                   for (similar_id, score) in similar]
         return [
             dict(id=post.uri(), score=score, subject=post.subject.first_original().value,
                  content=(post.get_original_body_as_text() or ''))
@@ -765,8 +990,9 @@ class SKLearnClusteringSemanticAnalysis(SemanticAnalysisData):
         index_by_post_id = {post_id: n for (n, post_id) in enumerate(post_ids)}
         if not eps:
             # This is silly, but approximate eps with optics
-            o = Optics(self.min_samples, metric)
-            o.calculate_distances(model_matrix.todense())
+            o = Optics(self.min_samples, metric, OPTICS_MAX_NEIGHBOURS
+                       if len(post_ids) > OPTICS_DENSE_LIMIT else None)
+            o.calculate_distances(model_matrix)
             RD = o.RD
             print "optics result:", RD
             a, b = min(RD[1:]), max(RD)
@@ -818,10 +1044,10 @@ class SKLearnClusteringSemanticAnalysis(SemanticAnalysisData):
             for post_id in post_ids
         }
         clusters = [
-            dict(cluster=cluster,
+            dict(cluster=post_cluster,
                  features=all_cluster_features[n],
                  idea_scores=all_idea_scores[n])
-            for (n, cluster) in enumerate(post_clusters)
+            for (n, post_cluster) in enumerate(post_clusters)
         ]
         clusters.append(dict(
             cluster=remainder, idea_scores=all_idea_scores[-1]))
@@ -910,6 +1136,12 @@ class SKLearnClusteringSemanticAnalysis(SemanticAnalysisData):
         return f
 
 
+# Above this number of posts, OPTICS uses bounded neighbourhoods
+# instead of the full distance matrix.
+OPTICS_DENSE_LIMIT = 20000
+OPTICS_MAX_NEIGHBOURS = 100
+
+
 class OpticsSemanticsAnalysis(SemanticAnalysisData):
     _optics = None
     _optics_clusters = None
@@ -991,10 +1223,16 @@ class OpticsSemanticsAnalysis(SemanticAnalysisData):
             return (idea_data["id"],)
         return results
 
+    @property
+    def use_dense_optics(self):
+        return self.model_matrix.shape[0] <= OPTICS_DENSE_LIMIT
+
     @property
     def optics(self):
         if self._optics is None:
-            self._optics = Optics(self.min_samples, self.metric)
+            self._optics = Optics(
+                self.min_samples, self.metric,
+                None if self.use_dense_optics else OPTICS_MAX_NEIGHBOURS)
         return self._optics
 
     @property
@@ -1009,7 +1247,8 @@ class OpticsSemanticsAnalysis(SemanticAnalysisData):
         if self._optics_clusters is None:
             optics = self.optics
             self._optics_clusters = optics.extract_clusters(
-                self.model_matrix.todense(), self.eps, D=self.distance_matrix)
+                self.model_matrix, self.eps,
+                D=self.distance_matrix if self.use_dense_optics else None)
             self._optics_clusters.sort(key=optics.cluster_depth)
         return self._optics_clusters
 
@@ -1047,10 +1286,14 @@ class OpticsSemanticsAnalysis(SemanticAnalysisData):
     @property
     def silhouette_score(self):
         if self._silhouette_score is None:
-            self._silhouette_score = metrics.silhouette_score(
-                self.model_matrix,
-                self.optics.as_labels(self.optics_clusters),
-                metric=self.metric)
+            labels = self.optics.as_labels(self.optics_clusters)
+            if self._distance_matrix is not None:
+                # Reuse the distances computed for optics
+                self._silhouette_score = metrics.silhouette_score(
+                    self._distance_matrix, labels, metric='precomputed')
+            else:
+                self._silhouette_score = metrics.silhouette_score(
+                    self.model_matrix, labels, metric=self.metric)
         return self._silhouette_score
 
     @property
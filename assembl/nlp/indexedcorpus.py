@@ -19,12 +19,14 @@ of each document.
 """
 
 import itertools
+from os.path import getsize
 
 import logging
 import numpy
 
 from gensim import utils
 from gensim.corpora import IndexedCorpus, MmCorpus
+from gensim.matutils import MmWriter
 logger = logging.getLogger('gensim.corpora.indexedcorpus')
 
 
@@ -68,6 +70,55 @@ class IdMmCorpus(MmCorpus):
             fname, '.dockeys')
         utils.pickle(key_order, dockeys_fname)
 
+    @classmethod
+    def append(cls, fname, corpus, num_terms=0, index_fname=None,
+               dockeys_fname=None):
+        """Append (key, bow) documents to a corpus serialized with
+        :py:meth:`serialize`, updating its headers, index and keys in place.
+
+        Returns the number of appended documents."""
+        old = cls(fname)
+        assert old.index is not None and old.dockeys is not None,\
+            "cannot append to a corpus without index or keys"
+        index_fname = index_fname or utils.smart_extension(fname, '.index')
+        dockeys_fname = dockeys_fname or utils.smart_extension(
+            fname, '.dockeys')
+        offsets = list(old.index)
+        dockeys = list(old.dockeys)
+        num_docs, num_nnz = old.num_docs, old.num_nnz
+        num_terms = max(num_terms, old.num_terms)
+        end = getsize(fname)
+        if offsets and offsets[-1] == end:
+            # The last document was empty
+            offsets[-1] = -1
+        with utils.smart_open(fname, 'rb+') as fout:
+            fout.seek(end)
+            for key, bow in corpus:
+                posnow = fout.tell()
+                if offsets and offsets[-1] == posnow:
+                    offsets[-1] = -1
+                offsets.append(posnow)
+                dockeys.append(key)
+                for termid, weight in sorted(bow):
+                    if abs(weight) <= 1e-12:
+                        continue
+                    fout.write(utils.to_utf8("%i %i %s\n" % (
+                        num_docs + 1, termid + 1, weight)))
+                    num_nnz += 1
+                    num_terms = max(num_terms, termid + 1)
+                num_docs += 1
+            # Same fixed-width headers as MmWriter.fake_headers
+            stats = '%i %i %i' % (num_docs, num_terms, num_nnz)
+            if len(stats) > 50:
+                raise ValueError('Invalid stats: matrix too large!')
+            fout.seek(len(MmWriter.HEADER_LINE))
+            fout.write(utils.to_utf8(stats.ljust(50)))
+        utils.pickle(offsets, index_fname)
+        utils.pickle(dockeys, dockeys_fname)
+        logger.info("appended %d documents to %s" % (
+            num_docs - old.num_docs, fname))
+        return num_docs - old.num_docs
+
     def __getitem__(self, docno):
         if self.index is None:
             raise RuntimeError("cannot call corpus[docid] without an index")
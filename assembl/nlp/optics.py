@@ -42,6 +42,8 @@
  maparent@acm.org
 '''
 
+from heapq import heappush, heappop
+
 import numpy as N
 from sklearn.metrics.pairwise import pairwise_distances
 
@@ -142,63 +144,121 @@ def euclid(i, x):
     return N.sqrt(N.sum(d, axis=1))
 
 
+def nearest_neighbours(x, k, metric='cosine', chunk_size=1000):
+    """The k nearest neighbours of each row of x, as (indices, distances)
+    arrays of shape (m, k), sorted by distance.
+
+    Distances are computed by chunks of rows, so memory use is
+    O(chunk_size * m) instead of O(m * m)."""
+    m = x.shape[0]
+    k = min(k, m)
+    indices = N.empty((m, k), dtype=N.int)
+    distances = N.empty((m, k))
+    rows = N.arange(chunk_size)[:, N.newaxis]
+    for start in xrange(0, m, chunk_size):
+        end = min(start + chunk_size, m)
+        D = pairwise_distances(x[start:end], x, metric=metric)
+        if k < m:
+            ind = N.argpartition(D, k - 1, axis=1)[:, :k]
+        else:
+            ind = N.tile(N.arange(m), (end - start, 1))
+        dist = D[rows[:end - start], ind]
+        order = N.argsort(dist, axis=1, kind='mergesort')
+        indices[start:end] = ind[rows[:end - start], order]
+        distances[start:end] = dist[rows[:end - start], order]
+    return indices, distances
+
+
 class Optics(object):
-    """A calculation using the optics algorithm."""
-    def __init__(self, min_points=4, distMethod='cosine'):
+    """A calculation using the optics algorithm.
+
+    If max_neighbours is given, neighbourhoods are bounded to that many
+    nearest neighbours instead of using the full distance matrix.
+    This approximates the ordering for large data sets."""
+    def __init__(self, min_points=4, distMethod='cosine', max_neighbours=None):
         self.min_points = min_points
         self.distMethod = distMethod
+        self.max_neighbours = max_neighbours
         self.RD = None
 
     def calculate_distances(self, x, D=None):
-        if len(x.shape) > 1:
-            m, n = x.shape
+        m = D.shape[0] if D is not None else x.shape[0]
+        if D is None and self.max_neighbours and \
+                self.max_neighbours < m:
+            self._calculate_sparse_distances(x)
         else:
-            m = x.shape[0]
-            n == 1
+            self._calculate_dense_distances(x, D)
+        self.RD[0] = 0  # we set this point to 0 as it does not get overwritten
+        # negative distance is a disaster
+        self.RD = N.maximum(self.RD, 0)
+        self.RDO = self.RD[self.order]
 
+    def _calculate_dense_distances(self, x, D=None):
         D = D if D is not None else pairwise_distances(x, metric=self.distMethod)
+        D = N.asarray(D)
+        m = D.shape[0]
 
-        self.CD = CD = N.zeros(m)
+        # The min_points-th smallest distance of each row; a partial sort
+        # is enough.
+        self.CD = CD = N.partition(D, self.min_points, axis=1)[
+            :, self.min_points]
         self.RD = RD = N.ones(m)*1E10
 
-        for i in xrange(m):
-            # again you can use the euclid function if you don't want scipy
-            # d = euclid(x[i],x)
-            # d.sort()
-            # CD[i] = d[min_points]
-
-            tempInd = D[i].argsort()
-            tempD = D[i][tempInd]
-            # tempD.sort() no, this function changes the reference
-            CD[i] = tempD[self.min_points]  # **2
-
         self.order = order = []
-        seeds = N.arange(m, dtype=N.int)
-
-        ind = 0
-        while len(seeds) != 1:
-            # for seed in seeds:
-            ob = seeds[ind]
-            seedInd = N.where(seeds != ob)
-            seeds = seeds[seedInd]
+        processed = N.zeros(m, dtype=bool)
+        # Reachability distances of seeds, with processed points masked out
+        seed_RD = RD.copy()
+        ob = 0
+        for _ in xrange(m - 1):
+            processed[ob] = True
+            seed_RD[ob] = N.inf
+            order.append(ob)
+            self._update_reachability(RD, seed_RD, processed, D[ob], CD[ob])
+            # argmin returns the first index among ties, as in the reference
+            # implementation which kept seeds in index order.
+            ob = N.argmin(seed_RD)
+        order.append(ob)
+
+    @staticmethod
+    def _update_reachability(RD, seed_RD, processed, distances, core_distance):
+        reach = N.maximum(distances, core_distance)
+        improved = (reach < RD) & ~processed
+        RD[improved] = reach[improved]
+        seed_RD[improved] = reach[improved]
+
+    def _calculate_sparse_distances(self, x):
+        m = x.shape[0]
+        # Each point is its own first neighbour
+        k = max(self.max_neighbours, self.min_points) + 1
+        neighbours, distances = nearest_neighbours(x, k, self.distMethod)
+        self.CD = CD = distances[:, self.min_points]
+        self.RD = RD = N.ones(m)*1E10
 
+        self.order = order = []
+        processed = N.zeros(m, dtype=bool)
+        # Heap of (reachability, index), with stale entries skipped on pop.
+        seeds = []
+        # Next candidate when no seed is reachable
+        next_unprocessed = 0
+        ob = 0
+        for _ in xrange(m - 1):
+            processed[ob] = True
             order.append(ob)
-            tempX = N.ones(len(seeds))*CD[ob]
-            tempD = D[ob][seeds]  # [seeds]
-            # you can use this function if you don't want to use scipy
-            # tempD = euclid(x[ob],x[seeds])
-
-            temp = N.column_stack((tempX, tempD))
-            mm = N.max(temp, axis=1)
-            ii = N.where(RD[seeds] > mm)[0]
-            RD[seeds[ii]] = mm[ii]
-            ind = N.argmin(RD[seeds])
-
-        order.append(seeds[0])
-        RD[0] = 0  # we set this point to 0 as it does not get overwritten
-        # negative distance is a disaster
-        RD = N.maximum(RD, 0)
-        self.RDO = RD[order]
+            ind = neighbours[ob]
+            reach = N.maximum(distances[ob], CD[ob])
+            improved = (reach < RD[ind]) & ~processed[ind]
+            for j, r in zip(ind[improved], reach[improved]):
+                RD[j] = r
+                heappush(seeds, (r, j))
+            while seeds:
+                r, ob = heappop(seeds)
+                if not processed[ob] and r == RD[ob]:
+                    break
+            else:
+                while processed[next_unprocessed]:
+                    next_unprocessed += 1
+                ob = next_unprocessed
+        order.append(ob)
 
     def up_point(self, i):
         RD = self.RDO
@@ -1,5 +1,7 @@
 """Abstract and concrete classes for a machine translation service."""
 from abc import abstractmethod
+from collections import defaultdict, OrderedDict
+from time import sleep
 import urllib2
 from traceback import print_exc
 import re
@@ -14,7 +16,7 @@ from assembl.lib.abc import (abstractclassmethod, classproperty)
 from assembl.lib import config
 from assembl.lib.enum import OrderedEnum
 from assembl.models.langstrings import (
-    Locale, LangString, LangStringEntry, LocaleLabel)
+    Locale, LangString, LangStringEntry, LocaleLabel, TranslationMemory)
 from assembl.lib.locale import strip_country
 
 
@@ -186,9 +188,112 @@ class TranslationService(object):
             return LangStringStatus.CANNOT_IDENTIFY, str(e)
         return LangStringStatus.UNKNOWN_ERROR, str(e)
 
+    def translate_batch(self, texts, target, source=None, db=None):
+        """Translate many texts to the same target, from the same source.
+
+        Returns a list of (translation, source locale) pairs, as
+        :py:meth:`translate`. Services that accept many texts per
+        request should override this; texts are given within
+        :py:attr:`max_batch_strings` and :py:attr:`max_batch_chars`."""
+        return [self.translate(text, target, source, db) for text in texts]
+
+    # Limits of a single request to the service
+    max_batch_strings = 128
+    max_batch_chars = 5000
+
+    def batches(self, texts):
+        """Split texts in batches within the service limits."""
+        batch = []
+        chars = 0
+        for text in texts:
+            if batch and (len(batch) >= self.max_batch_strings or
+                          chars + len(text) > self.max_batch_chars):
+                yield batch
+                batch = []
+                chars = 0
+            batch.append(text)
+            chars += len(text)
+        if batch:
+            yield batch
+
     def translate_lse(
             self, source_lse, target, retranslate=False,
             constrain_to_discussion_locales=SECURE_IDENTIFICATION_LIMIT):
+        pending = self.prepare_translation(
+            source_lse, target, retranslate, constrain_to_discussion_locales)
+        if not isinstance(pending, PendingTranslation):
+            return pending
+        try:
+            result = self.translate(
+                source_lse.value, target.code, pending.source,
+                source_lse.db)
+        except Exception as e:
+            print_exc()
+            return self.fail_translation(pending, e)
+        return self.finish_translation(
+            pending, result, constrain_to_discussion_locales)
+
+    def translate_lse_batch(
+            self, jobs, retranslate=False,
+            constrain_to_discussion_locales=SECURE_IDENTIFICATION_LIMIT):
+        """Translate many (source LangStringEntry, target Locale) pairs.
+
+        Identical texts are translated once, and known translations
+        are taken from the :py:class:`TranslationMemory`. Other texts
+        are sent to :py:meth:`translate_batch` in :py:meth:`batches`.
+        Returns the resulting LangStringEntries, as :py:meth:`translate_lse`,
+        in the order of the jobs."""
+        results = [
+            self.prepare_translation(
+                source_lse, target, retranslate,
+                constrain_to_discussion_locales)
+            for (source_lse, target) in jobs]
+        by_direction = defaultdict(list)
+        for n, pending in enumerate(results):
+            if isinstance(pending, PendingTranslation):
+                by_direction[(pending.source, pending.target.code)].append(
+                    (n, pending))
+        service_name = self.__class__.__name__
+        for (source, target_code), pendings in by_direction.iteritems():
+            db = pendings[0][1].source_lse.db
+            memory_locale = source or Locale.UNDEFINED
+            texts = list(OrderedDict.fromkeys(
+                (pending.source_lse.value for (_, pending) in pendings)))
+            known = TranslationMemory.lookup(
+                db, service_name, memory_locale, target_code, texts)
+            errors = {}
+            for batch in self.batches(
+                    [text for text in texts if text not in known]):
+                try:
+                    translations = self.translate_batch(
+                        batch, target_code, source, db)
+                except Exception as e:
+                    print_exc()
+                    errors.update({text: e for text in batch})
+                    continue
+                translations = dict(zip(batch, translations))
+                TranslationMemory.remember(
+                    db, service_name, memory_locale, target_code,
+                    translations)
+                known.update(translations)
+            for n, pending in pendings:
+                text = pending.source_lse.value
+                if text in errors:
+                    results[n] = self.fail_translation(pending, errors[text])
+                else:
+                    results[n] = self.finish_translation(
+                        pending, known[text],
+                        constrain_to_discussion_locales)
+        return results
+
+    def prepare_translation(
+            self, source_lse, target, retranslate=False,
+            constrain_to_discussion_locales=SECURE_IDENTIFICATION_LIMIT):
+        """Do everything needed to translate a LangStringEntry to a target
+        Locale, short of calling the service.
+
+        Returns a :py:class:`PendingTranslation` if the service has to
+        translate, or else the resulting LangStringEntry."""
         if not source_lse.value:
             # don't translate empty strings
             return source_lse
@@ -228,79 +333,117 @@ class TranslationService(object):
                 locale_id = Locale.UNDEFINED_LOCALEID,
                 value='')
             is_new_lse = True
+        pending = PendingTranslation(
+            source_lse, target, target_lse, is_new_lse, source_locale)
         if self.canTranslate(source_locale, target.code):
-            try:
-                trans, lang = self.translate(
-                    source_lse.value,
-                    target.code,
-                    source_locale if source_locale != Locale.UNDEFINED
-                    else None,
-                    source_lse.db)
-                lang = self.asPosixLocale(lang)
-                # What if detected language is not a discussion language?
-                if source_locale == Locale.UNDEFINED:
-                    if constrain_to_discussion_locales and (
-                            self.strlen_nourl(source_lse.value) <
-                            constrain_to_discussion_locales):
-                        if (not lang) or not Locale.any_compatible(
-                                lang, self.discussion.discussion_locales):
-                            self.set_error(
-                                source_lse,
-                                LangStringStatus.IDENTIFIED_TO_UNKNOWN,
-                                "Identified to "+lang)
-                            return source_lse
-                    source_lse.identify_locale(lang, dict(
-                        service=self.__class__.__name__))
-                    # This should never actually happen, because
-                    # it would mean that the language id. was forgotten.
-                    # Still, to be sure that all cases are covered.
-                    mt_target_name = self.get_mt_name(lang, target.code)
-                    other_target_lse = source_lse.langstring.entries_as_dict.get(
-                        Locale.get_id_of(mt_target_name), None)
-                    if other_target_lse:
-                        target_lse = other_target_lse
-                        is_new_lse = False
-                source_locale = source_lse.locale_code
-                if Locale.compatible(source_locale, target.code):
-                    return source_lse
-                target_lse.value = trans
-                target_lse.error_count = 0
-                target_lse.error_code = None
-                target_lse.locale_identification_data_json = dict(
-                    service=self.__class__.__name__)
-                if trans.strip() == source_lse.value.strip():
-                    # TODO: Check modulo spaces in the middle
-                    target_lse.error_count = 1
-                    target_lse.error_code = \
-                        LangStringStatus.IDENTICAL_TRANSLATION.value
-            except Exception as e:
-                print_exc()
-                self.set_error(target_lse, *self.decode_exception(e))
-                target_lse.value = None
-        else:
-            # Note: when retranslating, we may lose a valid translation.
+            return pending
+        # Note: when retranslating, we may lose a valid translation.
+        if source_locale == Locale.UNDEFINED:
+            if not self.distinct_identify_step:
+                # At least do this much.
+                self.confirm_locale(source_lse)
+                pending.source_locale = source_lse.locale_code
+        self.set_error(
+            target_lse, LangStringStatus.CANNOT_TRANSLATE,
+            "cannot translate")
+        target_lse.value = None
+        return self._store_translation(pending)
+
+    def finish_translation(
+            self, pending, result,
+            constrain_to_discussion_locales=SECURE_IDENTIFICATION_LIMIT):
+        """Store the (translation, source locale) result of the service
+        for a :py:class:`PendingTranslation`."""
+        source_lse = pending.source_lse
+        target = pending.target
+        target_lse = pending.target_lse
+        source_locale = pending.source_locale
+        try:
+            trans, lang = result
+            lang = self.asPosixLocale(lang)
+            # What if detected language is not a discussion language?
             if source_locale == Locale.UNDEFINED:
-                if not self.distinct_identify_step:
-                    # At least do this much.
-                    self.confirm_locale(source_lse)
-                    source_locale = source_lse.locale_code
-            self.set_error(
-                target_lse, LangStringStatus.CANNOT_TRANSLATE,
-                "cannot translate")
-            target_lse.value = None
+                if constrain_to_discussion_locales and (
+                        self.strlen_nourl(source_lse.value) <
+                        constrain_to_discussion_locales):
+                    if (not lang) or not Locale.any_compatible(
+                            lang, self.discussion.discussion_locales):
+                        self.set_error(
+                            source_lse,
+                            LangStringStatus.IDENTIFIED_TO_UNKNOWN,
+                            "Identified to "+lang)
+                        return source_lse
+                source_lse.identify_locale(lang, dict(
+                    service=self.__class__.__name__))
+                # This should never actually happen, because
+                # it would mean that the language id. was forgotten.
+                # Still, to be sure that all cases are covered.
+                mt_target_name = self.get_mt_name(lang, target.code)
+                other_target_lse = source_lse.langstring.entries_as_dict.get(
+                    Locale.get_id_of(mt_target_name), None)
+                if other_target_lse:
+                    pending.target_lse = target_lse = other_target_lse
+                    pending.is_new_lse = False
+            pending.source_locale = source_locale = source_lse.locale_code
+            if Locale.compatible(source_locale, target.code):
+                return source_lse
+            target_lse.value = trans
+            target_lse.error_count = 0
+            target_lse.error_code = None
+            target_lse.locale_identification_data_json = dict(
+                service=self.__class__.__name__)
+            if trans.strip() == source_lse.value.strip():
+                # TODO: Check modulo spaces in the middle
+                target_lse.error_count = 1
+                target_lse.error_code = \
+                    LangStringStatus.IDENTICAL_TRANSLATION.value
+        except Exception as e:
+            print_exc()
+            return self.fail_translation(pending, e)
+        return self._store_translation(pending)
+
+    def fail_translation(self, pending, exception):
+        """Record the failure of the service for a
+        :py:class:`PendingTranslation`."""
+        self.set_error(pending.target_lse, *self.decode_exception(exception))
+        pending.target_lse.value = None
+        return self._store_translation(pending)
+
+    def _store_translation(self, pending):
+        source_lse = pending.source_lse
+        target_lse = pending.target_lse
         if (not target_lse.locale or
-                (source_locale != Locale.UNDEFINED
+                (pending.source_locale != Locale.UNDEFINED
                  and Locale.extract_base_locale(
                     target_lse.locale_code) == Locale.UNDEFINED)):
             mt_target_name = self.get_mt_name(
-                source_lse.locale_code, target.code)
+                source_lse.locale_code, pending.target.code)
             target_lse.locale = Locale.get_or_create(
                 mt_target_name, source_lse.db)
-        if is_new_lse:
+        if pending.is_new_lse:
             source_lse.db.add(target_lse)
         return target_lse
 
 
+class PendingTranslation(object):
+    """A translation of a LangStringEntry to a target Locale that was
+    prepared by :py:meth:`TranslationService.prepare_translation`,
+    and awaits the result of the translation service."""
+    def __init__(self, source_lse, target, target_lse, is_new_lse,
+                 source_locale):
+        self.source_lse = source_lse
+        self.target = target
+        self.target_lse = target_lse
+        self.is_new_lse = is_new_lse
+        self.source_locale = source_locale
+
+    @property
+    def source(self):
+        "The source locale to give to the service, if known"
+        if self.source_locale != Locale.UNDEFINED:
+            return self.source_locale
+
+
 class DummyTranslationServiceTwoSteps(TranslationService):
     def canTranslate(cls, source, target):
         return True
@@ -356,6 +499,28 @@ class DummyTranslationServiceOneStepWithErrors(DummyTranslationServiceOneStep):
             text, target, source=source, db=db)
 
 
+class FakeBatchTranslationService(DummyTranslationServiceTwoSteps):
+    """A local stand-in for a translation provider that accepts batches,
+    for tests and benchmarks. Records the size of each request."""
+    max_batch_strings = 16
+    max_batch_chars = 2000
+
+    def __init__(self, discussion, latency=0):
+        super(FakeBatchTranslationService, self).__init__(discussion)
+        self.latency = latency
+        self.requests = []
+
+    def translate(self, text, target, source=None, db=None):
+        return self.translate_batch([text], target, source, db)[0]
+
+    def translate_batch(self, texts, target, source=None, db=None):
+        self.requests.append(len(texts))
+        if self.latency:
+            sleep(self.latency)
+        return [super(FakeBatchTranslationService, self).translate(
+                text, target, source, db) for text in texts]
+
+
 class DummyGoogleTranslationService(TranslationService):
     # Uses public Google API. For testing purposes. Do NOT use in production.
     _known_locales = {
@@ -494,17 +659,20 @@ class GoogleTranslationService(DummyGoogleTranslationService):
     def translate(self, text, target, source=None, db=None):
         if not text:
             return text, Locale.NON_LINGUISTIC
+        return self.translate_batch([text], target, source, db)[0]
+
+    def translate_batch(self, texts, target, source=None, db=None):
         if not self.client:
             from googleapiclient.http import HttpError
             raise HttpError(401, '{"error":"Please define server_api_key"}')
         r = self.client.translations().list(
-            q=text,
+            q=texts,
             target=self.asKnownLocale(target),
             source=self.asKnownLocale(source) if source else None).execute()
-        if source is None:
-            source = self.asPosixLocale(
-                r[u"translations"][0][u'detectedSourceLanguage'])
-        return r[u"translations"][0][u'translatedText'], source
+        return [(
+            t[u'translatedText'],
+            source or self.asPosixLocale(t[u'detectedSourceLanguage']))
+            for t in r[u"translations"]]
 
     def decode_exception(self, exception, identify_phase=False):
         from googleapiclient.http import HttpError
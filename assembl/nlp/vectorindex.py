@@ -0,0 +1,206 @@
+"""A persistent index of normalized vectors for nearest-neighbour queries.
+
+Vectors, their ids and random-projection signatures are stored in raw
+binary files, which are memory-mapped and only appended to as new
+documents arrive. Small indexes are searched exhaustively; larger ones
+are first narrowed down to the candidates with the closest signatures
+(in Hamming distance), which approximates the cosine neighbourhood.
+"""
+from os import makedirs, unlink
+from os.path import join, exists, getsize
+from contextlib import contextmanager
+from threading import Lock
+from uuid import uuid4
+import errno
+import fcntl
+import pickle
+
+import numpy as np
+
+# Number of bits set in each byte
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+META_FNAME = 'meta.pickle'
+VECTORS_FNAME = 'vectors.f32'
+IDS_FNAME = 'ids.i64'
+SIGNATURES_FNAME = 'signatures.u8'
+LOCK_FNAME = 'update.lock'
+
+_open_indexes = {}
+_update_lock = Lock()
+
+
+def top_k(scores, k):
+    """The indices of the k highest scores, in decreasing order."""
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='mergesort')]
+
+
+class VectorIndex(object):
+    """A directory holding a vector index.
+
+    Use :py:meth:`open` to share memory maps between requests."""
+
+    def __init__(self, dirname, dim=None, num_bits=64, seed=0,
+                 build_id=None, exact_limit=5000, num_candidates=2000):
+        self.dirname = dirname
+        self.exact_limit = exact_limit
+        self.num_candidates = num_candidates
+        meta = self.read_meta(dirname)
+        if meta is None:
+            assert dim, "A new index needs a dimension"
+            # The token tells rebuilt indexes apart
+            meta = dict(dim=dim, num_bits=num_bits, seed=seed,
+                        build_id=build_id, token=uuid4().hex)
+            if not exists(dirname):
+                makedirs(dirname)
+            for fname in (VECTORS_FNAME, IDS_FNAME, SIGNATURES_FNAME):
+                open(join(dirname, fname), 'wb').close()
+            with open(join(dirname, META_FNAME), 'wb') as f:
+                pickle.dump(meta, f)
+        self.token = meta.get('token', None)
+        self.dim = meta['dim']
+        self.num_bits = meta['num_bits']
+        self.build_id = meta['build_id']
+        self.planes = np.random.RandomState(meta['seed']).randn(
+            self.num_bits, self.dim).astype(np.float32)
+        self._sizes = None
+        self._maps = None
+
+    @staticmethod
+    def read_meta(dirname):
+        fname = join(dirname, META_FNAME)
+        if exists(fname):
+            with open(fname, 'rb') as f:
+                return pickle.load(f)
+
+    @classmethod
+    def open(cls, dirname, **kwargs):
+        """An index for this directory, reusing the one opened
+        by a previous request in this process, unless the index
+        was rebuilt since."""
+        index = _open_indexes.get(dirname, None)
+        if index is not None:
+            meta = cls.read_meta(dirname)
+            if meta is None or meta.get('token', None) != index.token:
+                index = None
+        if index is None:
+            index = _open_indexes[dirname] = cls(dirname, **kwargs)
+        return index
+
+    @staticmethod
+    @contextmanager
+    def updating(dirname):
+        """Hold the update lock of the index directory, against other
+        threads and processes, while checking and updating the index."""
+        try:
+            makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        with _update_lock, open(join(dirname, LOCK_FNAME), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @classmethod
+    def clear(cls, dirname):
+        _open_indexes.pop(dirname, None)
+        for fname in (META_FNAME, VECTORS_FNAME, IDS_FNAME, SIGNATURES_FNAME):
+            fname = join(dirname, fname)
+            if exists(fname):
+                unlink(fname)
+
+    @property
+    def signature_bytes(self):
+        return (self.num_bits + 7) // 8
+
+    def _file_sizes(self):
+        return tuple(getsize(join(self.dirname, fname)) for fname in (
+            VECTORS_FNAME, IDS_FNAME, SIGNATURES_FNAME))
+
+    def _mapped(self, fname, dtype, width, count):
+        if not count:
+            return np.zeros((0, width) if width else (0,), dtype=dtype)
+        shape = (count, width) if width else (count,)
+        return np.memmap(join(self.dirname, fname), dtype=dtype,
+                         mode='r', shape=shape)
+
+    @property
+    def maps(self):
+        """The (vectors, ids, signatures) memory maps,
+        reopened when another process appended to the files."""
+        sizes = self._file_sizes()
+        if self._maps is None or sizes != self._sizes:
+            # Appends are not atomic across files; ignore incomplete rows.
+            count = min(sizes[0] // (4 * self.dim), sizes[1] // 8,
+                        sizes[2] // self.signature_bytes)
+            self._maps = (
+                self._mapped(VECTORS_FNAME, np.float32, self.dim, count),
+                self._mapped(IDS_FNAME, np.int64, None, count),
+                self._mapped(SIGNATURES_FNAME, np.uint8,
+                             self.signature_bytes, count))
+            self._sizes = sizes
+        return self._maps
+
+    def __len__(self):
+        return len(self.maps[1])
+
+    @property
+    def max_id(self):
+        ids = self.maps[1]
+        return ids[-1] if len(ids) else None
+
+    def normalize(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        norms = np.sqrt((vectors * vectors).sum(1))
+        norms[norms == 0] = 1
+        return vectors / norms[:, np.newaxis]
+
+    def signatures(self, vectors):
+        return np.packbits(vectors.dot(self.planes.T) > 0, axis=1)
+
+    def append(self, ids, vectors):
+        """Add vectors to the index. Ids must be increasing,
+        and greater than those already in the index."""
+        if not len(ids):
+            return
+        vectors = self.normalize(vectors)
+        ids = np.asarray(ids, dtype=np.int64)
+        for fname, data in (
+                (VECTORS_FNAME, vectors),
+                (SIGNATURES_FNAME, self.signatures(vectors)),
+                (IDS_FNAME, ids)):
+            with open(join(self.dirname, fname), 'ab') as f:
+                f.write(data.tobytes())
+
+    def candidates(self, query):
+        """Rows likely to contain the nearest neighbours of the query."""
+        signatures = self.maps[2]
+        if len(signatures) <= max(self.exact_limit, self.num_candidates):
+            return None
+        distances = POPCOUNT[
+            np.bitwise_xor(signatures, self.signatures(query))].sum(1)
+        return np.argpartition(
+            distances, self.num_candidates - 1)[:self.num_candidates]
+
+    def query(self, vector, k=10):
+        """The ids and cosine similarities of the k vectors closest
+        to this one, by decreasing similarity."""
+        vectors, ids, _ = self.maps
+        if not len(ids):
+            return ids[:0], np.zeros(0, dtype=np.float32)
+        query = self.normalize(vector)
+        rows = self.candidates(query)
+        if rows is not None:
+            rows.sort()
+            vectors = vectors[rows]
+            ids = ids[rows]
+        scores = vectors.dot(query[0])
+        best = top_k(scores, k)
+        return np.asarray(ids[best]), scores[best]
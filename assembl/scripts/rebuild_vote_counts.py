@@ -0,0 +1,48 @@
+"""Check the live vote counters against the votes, and rebuild them."""
+import argparse
+
+
+def check_vote_counts(db, spec_ids=None, check_only=False):
+    from assembl.models.votes import rebuild_vote_counts
+    discrepancies = rebuild_vote_counts(db, spec_ids, check_only)
+    for (tablename, key), (actual, expected) in sorted(
+            discrepancies.iteritems()):
+        print "%s %s: counted %d, expected %d" % (
+            tablename, key, actual, expected)
+    if not discrepancies:
+        print "Vote counters are consistent"
+    elif check_only:
+        print "%d inconsistent vote counters" % (len(discrepancies), )
+    else:
+        print "Rebuilt %d inconsistent vote counters" % (
+            len(discrepancies), )
+    return discrepancies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("--check", action="store_true",
+                        help="only report inconsistencies")
+    parser.add_argument("--spec", type=int, action="append",
+                        help="only this vote specification (repeatable)")
+    args = parser.parse_args()
+
+    from pyramid.paster import get_appsettings, bootstrap
+    import transaction
+
+    from assembl.lib.sqla import configure_engine
+    from assembl.lib.zmqlib import configure_zmq
+    from assembl.lib.model_watcher import configure_model_watcher
+    from assembl.lib.config import set_config
+
+    env = bootstrap(args.configuration)
+    settings = get_appsettings(args.configuration, 'assembl')
+    set_config(settings)
+    configure_zmq(settings['changes.socket'], False)
+    configure_model_watcher(env['registry'], 'assembl')
+    engine = configure_engine(settings, True)
+    from assembl import models as m
+    with transaction.manager:
+        db = m.get_session_maker()()
+        check_vote_counts(db, args.spec, args.check)
@@ -38,7 +38,9 @@ def configure(registry, task_name):
     if settings.get('%s_debug_signal' % (task_name,), False):
         from assembl.lib import signals
         signals.listen()
-    configure_zmq(settings['changes.socket'], False)
+    configure_zmq(settings['changes.socket'], False,
+                  settings.get('changes.batch_window', None),
+                  settings.get('changes.encoding', None))
     # temporary solution
     configure_model_watcher(registry, task_name)
     # configure them all...
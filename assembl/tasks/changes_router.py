@@ -9,17 +9,18 @@ from os.path import exists, dirname
 import ConfigParser
 import traceback
 from time import sleep
+from collections import defaultdict
 
-import simplejson as json
 import zmq
 from zmq.eventloop import ioloop
 from zmq.eventloop import zmqstream
-import requests
-from tornado import web
+from tornado import web, gen
+from tornado.httpclient import AsyncHTTPClient
 from sockjs.tornado import SockJSRouter, SockJSConnection
 from tornado.httpserver import HTTPServer
 
-from assembl.lib.zmqlib import INTERNAL_SOCKET
+from assembl.lib.zmqlib import (
+    INTERNAL_SOCKET, changes_as_json, changes_topic, parse_changes_topic)
 from assembl.lib.raven_client import setup_raven, capture_exception
 from assembl.lib.web_token import decode_token, TokenInvalid
 
@@ -32,7 +33,8 @@ if len(sys.argv) != 2:
 
 SECTION = 'app:assembl'
 
-settings = ConfigParser.ConfigParser({'changes.prefix': ''})
+settings = ConfigParser.ConfigParser({
+    'changes.prefix': '', 'changes.permission_ttl': '60'})
 settings.read(sys.argv[-1])
 CHANGES_SOCKET = settings.get(SECTION, 'changes.socket')
 CHANGES_PREFIX = settings.get(SECTION, 'changes.prefix')
@@ -41,6 +43,8 @@ WEBSERVER_PORT = settings.getint(SECTION, 'changes.websocket.port')
 # NOTE: Not sure those are always what we want.
 SERVER_HOST = settings.get(SECTION, 'public_hostname')
 SERVER_PORT = settings.getint(SECTION, 'public_port')
+# How long a permission check is valid, in seconds
+PERMISSION_TTL = settings.getint(SECTION, 'changes.permission_ttl')
 setup_raven(settings)
 
 context = zmq.Context.instance()
@@ -60,45 +64,144 @@ td.setsockopt_out(zmq.IDENTITY, 'XPUB')
 td.start()
 
 
+class PermissionCache(object):
+    """Non-blocking read permission checks against the web server,
+    cached by (user, discussion) for PERMISSION_TTL seconds.
+
+    Concurrent checks for the same key share a single request."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.results = {}
+        self.pending = {}
+
+    @gen.coroutine
+    def can_read(self, user_id, discussion):
+        key = (user_id, discussion)
+        cached = self.results.get(key, None)
+        if cached is not None and cached[0] > time.time():
+            raise gen.Return(cached[1])
+        future = self.pending.get(key, None)
+        if future is None:
+            future = self.pending[key] = self._fetch(user_id, discussion)
+            io_loop.add_future(
+                future, lambda f: self.pending.pop(key, None))
+        result = yield future
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def _fetch(self, user_id, discussion):
+        r = yield AsyncHTTPClient(io_loop=io_loop).fetch(
+            'http://%s:%d/api/v1/discussion/%s/permissions/read/u/%s' %
+            (SERVER_HOST, SERVER_PORT, discussion, user_id),
+            raise_error=False)
+        result = r.code == 200 and r.body == 'true'
+        if r.code == 200:
+            # Do not cache server errors
+            self.results[(user_id, discussion)] = (
+                time.time() + self.ttl, result)
+        raise gen.Return(result)
+
+    def expire(self):
+        now = time.time()
+        for key, (expiry, result) in self.results.items():
+            if expiry <= now:
+                del self.results[key]
+
+
+permission_cache = PermissionCache(PERMISSION_TTL)
+
+
+class DiscussionChannel(object):
+    """A single ZMQ subscription for a discussion, which fans out
+    the changes to all connected clients.
+
+    Each connected user is also subscribed to the topics of changes that
+    are private to them, which are sent to their clients only."""
+
+    channels = {}
+
+    def __init__(self, discussion):
+        self.discussion = discussion
+        self.clients = set()
+        self.clients_by_user = defaultdict(set)
+        self.socket = context.socket(zmq.SUB)
+        self.socket.connect(INTERNAL_SOCKET)
+        for topic in self.topics():
+            self.socket.setsockopt(zmq.SUBSCRIBE, topic)
+        self.loop = zmqstream.ZMQStream(self.socket, io_loop=io_loop)
+        self.loop.on_recv(self.on_recv)
+
+    def topics(self, user_id=None):
+        return (changes_topic('*', user_id),
+                changes_topic(self.discussion, user_id))
+
+    @classmethod
+    def join(cls, discussion, client):
+        channel = cls.channels.get(discussion, None)
+        if channel is None:
+            channel = cls.channels[discussion] = cls(discussion)
+        channel.clients.add(client)
+        user_clients = channel.clients_by_user[client.userId]
+        if not user_clients and client.userId is not None:
+            for topic in channel.topics(client.userId):
+                channel.socket.setsockopt(zmq.SUBSCRIBE, topic)
+        user_clients.add(client)
+        return channel
+
+    def leave(self, client):
+        self.clients.discard(client)
+        user_clients = self.clients_by_user.get(client.userId, None)
+        if user_clients is not None:
+            user_clients.discard(client)
+            if not user_clients:
+                del self.clients_by_user[client.userId]
+                if self.clients and client.userId is not None:
+                    for topic in self.topics(client.userId):
+                        self.socket.setsockopt(zmq.UNSUBSCRIBE, topic)
+        if not self.clients:
+            self.channels.pop(self.discussion, None)
+            self.loop.stop_on_recv()
+            self.loop.close()
+            self.loop = None
+            self.socket = None
+
+    def on_recv(self, data):
+        try:
+            discussion, user_id = parse_changes_topic(data[0])
+            if user_id is None:
+                clients = list(self.clients)
+            else:
+                clients = list(self.clients_by_user.get(user_id, ()))
+            if clients:
+                clients[0].broadcast(clients, changes_as_json(data))
+        except Exception:
+            capture_exception()
+
+
 class ZMQRouter(SockJSConnection):
 
     token = None
     discussion = None
     userId = None
+    channel = None
 
     def on_open(self, request):
         self.valid = True
         self.closing = False
 
-    def on_recv(self, data):
-        try:
-            data = data[-1]
-            if '@private' in data:
-                jsondata = json.loads(data)
-                jsondata = [x for x in jsondata
-                            if x.get('@private', self.userId) == self.userId]
-                if not jsondata:
-                    return
-                data = json.dumps(jsondata)
-            self.send(data)
-        except Exception:
-            capture_exception()
-            self.do_close()
-
     def do_close(self):
         self.closing = True
         self.close()
-        self.socket = None
-        if getattr(self, "loop", None):
-            self.loop.stop_on_recv()
-            self.loop.close()
-            self.loop = None
+        if self.channel is not None:
+            self.channel.leave(self)
+            self.channel = None
 
     def on_message(self, msg):
         try:
-            if getattr(self, 'socket', None):
+            if self.channel is not None:
                 print "closing old socket"
-                self.loop.add_callback(self.do_close)
+                io_loop.add_callback(self.do_close)
                 return
             if msg.startswith('discussion:') and self.valid:
                 self.discussion = msg.split(':', 1)[1]
@@ -111,22 +214,25 @@ class ZMQRouter(SockJSConnection):
                 except TokenInvalid:
                     pass
             if self.token and self.discussion:
-                # Check if token authorizes discussion
-                r = requests.get(
-                    'http://%s:%d/api/v1/discussion/%s/permissions/read/u/%s' %
-                    (SERVER_HOST, SERVER_PORT, self.discussion,
-                        self.token['userId']))
-                print r.text
-                if r.text != 'true':
-                    return
-                self.socket = context.socket(zmq.SUB)
-                self.socket.connect(INTERNAL_SOCKET)
-                self.socket.setsockopt(zmq.SUBSCRIBE, '*')
-                self.socket.setsockopt(zmq.SUBSCRIBE, str(self.discussion))
-                self.loop = zmqstream.ZMQStream(self.socket, io_loop=io_loop)
-                self.loop.on_recv(self.on_recv)
-                print "connected"
-                self.send('[{"@type":"Connection"}]')
+                io_loop.add_future(
+                    self.connect_if_allowed(), self.check_future)
+        except Exception:
+            capture_exception()
+            self.do_close()
+
+    @gen.coroutine
+    def connect_if_allowed(self):
+        # Check if token authorizes discussion
+        allowed = yield permission_cache.can_read(
+            self.token['userId'], self.discussion)
+        if not allowed or self.closing or self.channel is not None:
+            return
+        self.channel = DiscussionChannel.join(self.discussion, self)
+        self.send('[{"@type":"Connection"}]')
+
+    def check_future(self, future):
+        try:
+            future.result()
         except Exception:
             capture_exception()
             self.do_close()
@@ -155,6 +261,9 @@ def log_queue():
 
 log_queue()
 
+ioloop.PeriodicCallback(
+    permission_cache.expire, 1000 * PERMISSION_TTL, io_loop=io_loop).start()
+
 sockjs_router = SockJSRouter(
     ZMQRouter, prefix=CHANGES_PREFIX, io_loop=io_loop)
 routes = sockjs_router.urls
@@ -1,14 +1,18 @@
 """Celery task for sending :py:class:`assembl.models.notification.Notification` to users."""
 import sys
-from time import sleep
 from datetime import datetime, timedelta
 from traceback import print_exc
+from threading import Thread, Lock
 import logging
 
 import transaction
+from sqlalchemy import func, or_
 
 from ..lib.sqla import mark_changed
 from ..lib.raven_client import capture_exception
+from ..lib.smtp import get_smtp_pool
+from ..lib.ratelimit import DomainRateLimiter
+from ..lib.utils import get_shared_cache_region
 from . import (config_celery_app, CeleryWithConfig)
 
 
@@ -30,16 +34,32 @@ CELERYBEAT_SCHEDULE = {
 
 class NotifyCeleryApp(CeleryWithConfig):
     def on_configure_with_settings(self, settings):
-        # setup SETTINGS_SMTP_DELAY
+        # setup SETTINGS_SMTP_DELAY and SETTINGS_SMTP_BURST
+        delays = {}
+        bursts = {}
         for name, val in settings.iteritems():
-            if name.startswith(SETTINGS_SMTP_DELAY):
+            for prefix, values, cast in (
+                    (SETTINGS_SMTP_DELAY, delays, float),
+                    (SETTINGS_SMTP_BURST, bursts, int)):
+                if name.startswith(prefix):
+                    try:
+                        values[name[len(prefix):]] = cast(val)
+                    except ValueError:
+                        print "Not a valid value for %s: %s" % (name, val)
+        for domain, delay in delays.iteritems():
+            RATE_LIMITER.set_limit(
+                domain, 1.0 / delay if delay > 0 else 0,
+                bursts.get(domain, 1))
+        log.info("SMTP_DOMAIN_LIMITS: " + repr(RATE_LIMITER.limits))
+        for name in DELIVERY_SETTINGS:
+            val = settings.get(SETTINGS_DELIVERY + name, None)
+            if val is not None:
                 try:
-                    val = timedelta(seconds=float(val))
+                    DELIVERY_SETTINGS[name] = int(val)
                 except ValueError:
-                    print "Not a valid value for %s: %s" % (name, val)
-                    continue
-                SMTP_DOMAIN_DELAYS[name[len(SETTINGS_SMTP_DELAY):]] = val
-        log.info("SMTP_DOMAIN_DELAYS: " + repr(SMTP_DOMAIN_DELAYS))
+                    print "Not a valid value for %s: %s" % (
+                        SETTINGS_DELIVERY + name, val)
+        log.info("DELIVERY_SETTINGS: " + repr(DELIVERY_SETTINGS))
 
 
 notify_celery_app = NotifyCeleryApp('celery_tasks.notify')
@@ -48,56 +68,74 @@ notify_celery_app._preconf = {
 }
 
 
-# When was a mail last sent by notifications to a given domain?
-# Propagates to superdomains.
-DOMAIN_LAST_SENT = {}
+# Token buckets limiting the emails sent to each domain.
+# Mail that would exceed the limit is rescheduled, not waited for.
+# Buckets are per process: for the limits to hold, you need to have
+# a SINGLE celery process for notification.
+RATE_LIMITER = DomainRateLimiter()
 
-# Minimum delay between emails sent to a domain.
-# For this to work, you need to have a SINGLE celery process for notification.
-SMTP_DOMAIN_DELAYS = {
-    '': timedelta(0)
+# INI file values with this prefix set the average delay between emails
+# sent to a domain. Anything after the last dot is a domain name
+# (including empty). Use seconds (float) as values.
+SETTINGS_SMTP_DELAY = "celery_tasks.notify.smtp_delay."
+
+# INI file values with this prefix set how many emails can be sent
+# to a domain at once, before they get spaced by the delay above.
+SETTINGS_SMTP_BURST = "celery_tasks.notify.smtp_burst."
+
+# How pending notifications are delivered: by how many threads,
+# claiming how many notifications per transaction,
+# and how many messages are sent over a SMTP connection.
+DELIVERY_SETTINGS = {
+    'delivery_threads': 4,
+    'batch_size': 50,
+    'smtp_messages_per_connection': 100,
 }
 
-# INI file values with this prefix will be used to populate SMTP_DOMAIN_DELAYS.
-# Anything after the last dot is a domain name (including empty).
-# Use seconds (float) as values.
-SETTINGS_SMTP_DELAY = "celery_tasks.notify.smtp_delay."
+# INI file values with this prefix override DELIVERY_SETTINGS.
+SETTINGS_DELIVERY = "celery_tasks.notify."
 
+# First key of the advisory locks on notifications being delivered
+NOTIFICATION_LOCK_KEY = 4201
 
-def email_was_sent(email):
-    domain = email.split("@")[-1].lower().split('.')
-    now = datetime.utcnow()
-    for i in range(len(domain) + 1):
-        dom = '.'.join(domain[i:])
-        DOMAIN_LAST_SENT[dom] = now
 
+def publish_rate_limit_metrics():
+    """Share the rate limiter counters, for the delivery_metrics view."""
+    metrics = RATE_LIMITER.metrics()
+    log.info("SMTP domain limits: " + repr(metrics))
+    region = get_shared_cache_region('notify_metrics')
+    if region is not None:
+        region.set('rate_limits', dict(
+            domains=metrics, updated=datetime.utcnow().isoformat()))
 
-def wait_if_necessary(email):
-    domain = email.split("@")[-1].lower().split('.')
-    # Look for most specific delay rule
-    for i in range(len(domain) + 1):
-        dom = '.'.join(domain[i:])
-        if dom in SMTP_DOMAIN_DELAYS:
-            delay = SMTP_DOMAIN_DELAYS[dom]
-            break
-    else:
-        return
-    # Not looking at superdomains. make delays as generic as needed
-    last_sent = DOMAIN_LAST_SENT.get(dom, None)
-    if last_sent is None:
-        return
-    elapsed = datetime.utcnow() - last_sent
-    if elapsed < delay:
-        sleep((delay - elapsed).total_seconds())
+
+def lock_notification(db, notification_id):
+    """Lock the notification for the current transaction,
+    unless another worker did. Returns whether it was locked."""
+    return db.query(func.pg_try_advisory_xact_lock(
+        NOTIFICATION_LOCK_KEY, notification_id)).scalar()
+
+
+def get_mail_pool():
+    from assembl.lib import config
+    mail_host = config.get('mail.host')
+    assert mail_host
+    return get_smtp_pool(
+        mail_host, int(config.get('mail.port') or 25),
+        max_connections=DELIVERY_SETTINGS['delivery_threads'],
+        max_messages=DELIVERY_SETTINGS['smtp_messages_per_connection'])
 
 
-def process_notification(notification):
+def process_notification(notification, smtp_pool=None, rate_limiter=None):
+    """Send the notification, unless the rate limiter throttles its domain.
+
+    Returns the seconds to wait before sending a throttled notification,
+    which has been given a slot at that time."""
     from ..models.notification import (
         NotificationDeliveryStateType, UnverifiedEmailException,
         MissingEmailException)
     import smtplib
     import socket
-    from assembl.lib import config
 
     assert notification
     sys.stderr.write(
@@ -110,20 +148,22 @@ def process_notification(notification):
                 notification.id, notification.delivery_state))
         return
     try:
+        recipient = notification.get_to_email_address()
+        if rate_limiter:
+            wait = rate_limiter.reserve(recipient)
+            if wait:
+                sys.stderr.write(
+                    "Deferring notification %d for %.1fs" % (
+                        notification.id, wait))
+                notification.next_attempt_date = \
+                    datetime.utcnow() + timedelta(seconds=wait)
+                mark_changed()
+                return wait
         email_str = notification.render_to_email()
         # sys.stderr.write(email_str)
-        mail_host = config.get('mail.host')
-        mail_port = int(config.get('mail.port') or 25)
-        assert mail_host
-        recipient = notification.get_to_email_address()
-        wait_if_necessary(recipient)
 
-        smtp_connection = smtplib.SMTP(
-            mail_host,
-            mail_port,
-        )
-        smtp_connection.set_debuglevel(1)
-        smtp_retval = smtp_connection.sendmail(
+        smtp_pool = smtp_pool or get_mail_pool()
+        smtp_retval = smtp_pool.sendmail(
             notification.get_from_email_address(),
             recipient,
             email_str
@@ -135,8 +175,6 @@ def process_notification(notification):
 
         notification.delivery_state = \
             NotificationDeliveryStateType.DELIVERY_IN_PROGRESS
-        smtp_connection.quit()
-        email_was_sent(recipient)
     except UnverifiedEmailException as e:
         sys.stderr.write("Not sending to unverified email: "+repr(e))
         notification.delivery_state = \
@@ -145,7 +183,7 @@ def process_notification(notification):
         notification.delivery_state = \
             NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
         sys.stderr.write("Missing email! :"+repr(e))
-    except (smtplib.SMTPConnectError,
+    except (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected,
             socket.timeout, socket.error,
             smtplib.SMTPHeloError) as e:
         sys.stderr.write("Temporary failure: "+repr(e))
@@ -166,33 +204,146 @@ def process_notification(notification):
         % (notification.id, notification.delivery_state))
 
 
+def defer_notification(notification_id, wait):
+    """Send the notification later, in a slot already reserved."""
+    notify.apply_async((notification_id, True), countdown=wait)
+
+
 @notify_celery_app.task()
-def notify(id):
+def notify(id, reserved=False):
     """ Can be triggered by
     http://localhost:6543/data/Discussion/6/all_users/2/notifications/12/process_now """
     from ..models.notification import Notification, waiting_get
     sys.stderr.write("notify called with "+str(id))
+    wait = None
     with transaction.manager:
+        if not lock_notification(Notification.default_db, id):
+            sys.stderr.write("notification %d is being processed" % (id,))
+            return
         notification = waiting_get(Notification, id)
         assert notification
-        process_notification(notification)
+        wait = process_notification(
+            notification, rate_limiter=None if reserved else RATE_LIMITER)
+    if wait:
+        defer_notification(id, wait)
 
 
-@notify_celery_app.task()
-def process_pending_notifications():
-    """ Can be triggered by http://localhost:6543/data/Notification/process_now """
+def claim_notifications(db, batch_size, after_id=0):
+    """The ids of up to batch_size retryable notifications, in id order,
+    locked for the current transaction. Deferred notifications are left
+    to their rescheduled task until their next attempt date.
+
+    Notifications locked by other workers are skipped. (Advisory locks
+    are used, as ``SKIP LOCKED`` needs PostgreSQL 9.5.)"""
     from ..models.notification import (
         Notification, NotificationDeliveryStateType)
-    sys.stderr.write("process_pending_notifications called")
-    retryable_notifications = Notification.default_db.query(Notification.id).filter(
+    # OFFSET 0 keeps the lock condition out of the candidates scan,
+    # so only the returned rows get locked.
+    candidates = db.query(Notification.id).filter(
         Notification.delivery_state.in_(
-        NotificationDeliveryStateType.getRetryableDeliveryStates()))
-    for (notification_id,) in retryable_notifications:
+            NotificationDeliveryStateType.getRetryableDeliveryStates()),
+        or_(Notification.next_attempt_date == None,
+            Notification.next_attempt_date <= datetime.utcnow()),
+        Notification.id > after_id).order_by(
+            Notification.id).offset(0).subquery()
+    return [id for (id,) in db.query(candidates.c.id).filter(
+        func.pg_try_advisory_xact_lock(
+            NOTIFICATION_LOCK_KEY, candidates.c.id)).limit(batch_size)]
+
+
+class NotificationDelivery(object):
+    """Delivers the pending notifications with a few threads,
+    which claim notifications by batches and share SMTP connections.
+
+    Each notification is attempted at most once per delivery.
+    Notifications to throttled domains are sent last in each batch,
+    and rescheduled if they cannot be sent now."""
+
+    def __init__(self, smtp_pool=None, num_threads=None, batch_size=None,
+                 rate_limiter=RATE_LIMITER):
+        self.smtp_pool = smtp_pool or get_mail_pool()
+        self.rate_limiter = rate_limiter
+        self.num_threads = (
+            num_threads or DELIVERY_SETTINGS['delivery_threads'])
+        self.batch_size = batch_size or DELIVERY_SETTINGS['batch_size']
+        self.last_claimed_id = 0
+        self.processed = 0
+        self._lock = Lock()
+
+    def claim(self, db):
+        with self._lock:
+            after_id = self.last_claimed_id
+        ids = claim_notifications(db, self.batch_size, after_id)
+        with self._lock:
+            self.last_claimed_id = max([self.last_claimed_id] + ids)
+        return ids
+
+    def process_batch(self):
+        """Claim and deliver a batch of notifications in a transaction.
+        Returns whether there was anything to deliver."""
+        from ..models.notification import (
+            Notification, notification_rendering)
+        deferred = []
+        with transaction.manager, notification_rendering.batch():
+            db = Notification.default_db
+            ids = self.claim(db)
+            if not ids:
+                return False
+            notifications = db.query(Notification).filter(
+                Notification.id.in_(ids)).order_by(Notification.id).all()
+            if self.rate_limiter:
+                notifications = self.rate_limiter.order(
+                    notifications, recipient_of)
+            for notification in notifications:
+                try:
+                    wait = process_notification(
+                        notification, self.smtp_pool, self.rate_limiter)
+                    if wait:
+                        deferred.append((notification.id, wait))
+                except Exception:
+                    capture_exception()
+            with self._lock:
+                self.processed += len(ids)
+        # once our locks are released
+        for notification_id, wait in deferred:
+            defer_notification(notification_id, wait)
+        return True
+
+    def work(self):
+        from ..models.notification import Notification
         try:
-            with transaction.manager:
-                process_notification(Notification.get(notification_id))
-        except:
+            while self.process_batch():
+                pass
+        except Exception:
             capture_exception()
+        finally:
+            Notification.default_db.remove()
+
+    def run(self):
+        threads = [Thread(target=self.work)
+                   for _ in range(self.num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.rate_limiter is RATE_LIMITER:
+            publish_rate_limit_metrics()
+        return self.processed
+
+
+def recipient_of(notification):
+    try:
+        return notification.get_to_email_address()
+    except Exception:
+        # Will fail in process_notification
+        return ''
+
+
+@notify_celery_app.task()
+def process_pending_notifications():
+    """ Can be triggered by http://localhost:6543/data/Notification/process_now """
+    sys.stderr.write("process_pending_notifications called")
+    NotificationDelivery().run()
 
 
 def includeme(config):
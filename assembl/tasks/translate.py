@@ -1,9 +1,22 @@
-"""A celery process that translate messages as soon as they are created. Causes deadlocks, not used"""
+"""A celery process that translates messages in the background.
+
+Translations are requested by LangString id with
+:py:func:`enqueue_translations`, and only sent to the queue once the
+requesting transaction is committed, so the worker never waits on rows
+locked by that transaction."""
 from collections import defaultdict
 from abc import abstractmethod
+from time import time
+import logging
+
+from sqlalchemy import event, or_
+from sqlalchemy.orm.session import Session
+from dogpile.cache import make_region
+from dogpile.cache.api import NO_VALUE
+import transaction
 
 from . import config_celery_app, CeleryWithConfig
-from ..lib.utils import waiting_get
+from ..lib.utils import waiting_get, get_shared_cache_region
 from ..lib.raven_client import capture_exception
 
 # broker specified
@@ -11,6 +24,11 @@ translation_celery_app = CeleryWithConfig('celery_tasks.translate')
 
 _services = {}
 
+log = logging.getLogger('assembl')
+
+# Seconds before a queued translation is considered lost and re-queued
+PENDING_TIMEOUT = 600
+
 
 class TranslationTable(object):
     @abstractmethod
@@ -42,20 +60,167 @@ class DiscussionPreloadTranslationTable(TranslationTable):
         return self.base_languages - set(locale_code)
 
 
-def translate_content(
-        content, translation_table=None, service=None,
-        constrain_to_discussion_languages=True,
-        send_to_changes=False):
+class FixedTargetsTranslationTable(TranslationTable):
+    def __init__(self, service, targets):
+        self.targets = {
+            service.asKnownLocale(target) or target for target in targets}
+
+    def languages_for(self, locale_code, db=None):
+        return self.targets
+
+
+def missing_translations(content, translation_table, service):
+    """The target locales that the LangStrings of this content lack,
+    as a dictionary by LangString id.
+
+    Unlike :py:func:`translation_jobs`, this never calls the service,
+    and can be used in requests."""
     from ..models import Locale
-    discussion = content.discussion
-    service = service or discussion.translation_service()
-    if not service:
+    missing = {}
+    for prop in ("body", "subject"):
+        ls = getattr(content, prop)
+        if not ls:
+            continue
+        entries = {service.asKnownLocale(
+                    Locale.extract_base_locale(
+                        entry.locale_code)): entry
+                   for entry in ls.entries}
+        targets = set()
+        for original in ls.non_mt_entries():
+            if not original.value or (
+                    original.locale_code == Locale.NON_LINGUISTIC) or (
+                    original.error_code and
+                    service.has_fatal_error(original)):
+                continue
+            source_loc = (service.asKnownLocale(original.locale_code) or
+                          original.locale_code) or 'und'
+            for dest in translation_table.languages_for(
+                    source_loc, content.db):
+                if Locale.compatible(dest, source_loc):
+                    continue
+                entry = entries.get(dest, None)
+                if entry is None or (
+                        entry.error_code and
+                        not service.has_fatal_error(entry)):
+                    targets.add(dest)
+        if targets:
+            missing[ls.id] = targets
+    return missing
+
+
+_pending_region = None
+
+
+def pending_region():
+    """The cache region where queued translations are marked,
+    to avoid queuing them again."""
+    global _pending_region
+    if _pending_region is None:
+        _pending_region = get_shared_cache_region('translation_queue')
+        if _pending_region is None:
+            log.error("Could not setup the shared translation queue marks. "
+                      "Using process-local marks.")
+            _pending_region = make_region().configure(
+                'dogpile.cache.memory')
+    return _pending_region
+
+
+def _pending_key(langstring_id, target):
+    return "%d_%s" % (langstring_id, target)
+
+
+def pending_translation_requests(db):
+    """The translation requests of the session in the current transaction,
+    as target locales by LangString id."""
+    current = transaction.get()
+    pending = db.info.get('translation_requests', None)
+    if pending is None or pending[0] is not current:
+        # Requests of a previous transaction were abandoned
+        pending = db.info['translation_requests'] = (current, {})
+        current.addAfterCommitHook(
+            translation_after_commit_hook, (db, pending))
+    return pending[1]
+
+
+def enqueue_translations(db, missing):
+    """Ask for the background translation of LangStrings, given as
+    target locales by LangString id.
+
+    The request is sent to the translation queue when the transaction
+    is committed, even if the session was not changed."""
+    requests = pending_translation_requests(db)
+    for langstring_id, targets in missing.iteritems():
+        requests.setdefault(langstring_id, set()).update(targets)
+
+
+def dispatch_translations(requests):
+    """Send translation requests to the queue,
+    unless they were queued recently."""
+    region = pending_region()
+    keys = [(langstring_id, target)
+            for (langstring_id, targets) in requests.iteritems()
+            for target in targets]
+    now = time()
+    marks = region.get_multi([_pending_key(*key) for key in keys])
+    keys = [key for (key, mark) in zip(keys, marks)
+            if mark is NO_VALUE or now - mark > PENDING_TIMEOUT]
+    if not keys:
         return
-    if translation_table is None:
-        translation_table = DiscussionPreloadTranslationTable(
-            service, discussion)
+    region.set_multi({_pending_key(*key): now for key in keys})
+    by_langstring = defaultdict(list)
+    for langstring_id, target in keys:
+        by_langstring[langstring_id].append(target)
+    translate_langstrings_task.delay(by_langstring.items())
+
+
+def _send_pending(pending):
+    requests = dict(pending[1])
+    pending[1].clear()
+    if requests:
+        try:
+            dispatch_translations(requests)
+        except Exception:
+            capture_exception()
+
+
+def translation_after_commit_hook(success, db, pending):
+    # Read-only transactions do not commit the session,
+    # but still end here
+    if db.info.get('translation_requests', None) is pending:
+        del db.info['translation_requests']
+    if success:
+        _send_pending(pending)
+    else:
+        pending[1].clear()
+
+
+def translation_after_commit_listener(session):
+    # For sessions committed outside of a zope transaction
+    pending = session.info.pop('translation_requests', None)
+    if pending:
+        _send_pending(pending)
+
+
+def translation_rollback_listener(session):
+    pending = session.info.pop('translation_requests', None)
+    if pending:
+        pending[1].clear()
+
+
+event.listen(Session, 'after_commit', translation_after_commit_listener)
+event.listen(Session, 'after_rollback', translation_rollback_listener)
+
+
+def translation_jobs(
+        content, translation_table, service,
+        constrain_to_discussion_languages=True):
+    """The (original LangStringEntry, target Locale) pairs
+    that need translation in this content.
+
+    Also identifies the language of the content if needed.
+    Returns None if identification failed."""
+    from ..models import Locale
     undefined_id = Locale.UNDEFINED_LOCALEID
-    changed = False
     # Special case: Short strings.
     und_subject = content.subject.undefined_entry
     und_body = content.body.undefined_entry
@@ -74,7 +239,7 @@ def translate_content(
                 combined, constrain_to_discussion_languages)
         except:
             capture_exception()
-            return changed
+            return None
         if und_subject:
             und_subject.locale_code = language
             content.db.expire(und_subject, ("locale",))
@@ -84,6 +249,7 @@ def translate_content(
             content.db.expire(und_body, ("locale",))
             content.db.expire(content.body, ("entries",))
 
+    jobs = []
     for prop in ("body", "subject"):
         ls = getattr(content, prop)
         if ls:
@@ -97,7 +263,7 @@ def translate_content(
                             entry, constrain_to_discussion_languages)
                     except:
                         capture_exception()
-                        return changed
+                        return None
                     # reload entries
                     ls.db.expire(ls, ("entries",))
                     entries = ls.entries_as_dict
@@ -106,38 +272,77 @@ def translate_content(
                             entry.locale_code)): entry
                        for entry in entries.values()}
             originals = ls.non_mt_entries()
+            # Only one translation per target language
+            claimed = set()
             # pick randomly. TODO: Recency order?
             for original in originals:
                 source_loc = (service.asKnownLocale(original.locale_code) or
                               original.locale_code) or 'und'
                 for dest in translation_table.languages_for(source_loc, content.db):
-                    if Locale.compatible(dest, source_loc):
+                    if Locale.compatible(dest, source_loc) or dest in claimed:
                         continue
                     entry = entries.get(dest, None)
                     if entry is None or (
                             entry.error_code and
                             not service.has_fatal_error(entry)):
-                        try:
-                            result = service.translate_lse(
-                                original,
-                                Locale.get_or_create(dest, content.db))
-                        except:
-                            capture_exception()
-                            return changed
-                        # recalculate, may have changed
-                        source_loc = (
-                            service.asKnownLocale(original.locale_code) or
-                            original.locale_code)
-                        ls.db.expire(ls, ["entries"])
-                        entries[service.asKnownLocale(
-                            Locale.extract_base_locale(
-                                result.locale_code))] = result
-                        changed = True
-    if changed and send_to_changes:
-        content.send_to_changes()
+                        jobs.append((
+                            original, Locale.get_or_create(dest, content.db)))
+                        claimed.add(dest)
+    return jobs
+
+
+def translate_contents(
+        contents, translation_table=None, service=None,
+        constrain_to_discussion_languages=True,
+        send_to_changes=False):
+    """Translate many contents of a discussion together.
+
+    The entries that need translation are sent to the service in
+    batches, with identical texts translated only once.
+    Returns the list of changed contents."""
+    contents = list(contents)
+    if not contents:
+        return []
+    discussion = contents[0].discussion
+    service = service or discussion.translation_service()
+    if not service:
+        return []
+    if translation_table is None:
+        translation_table = DiscussionPreloadTranslationTable(
+            service, discussion)
+    jobs = []
+    changed = []
+    for content in contents:
+        content_jobs = translation_jobs(
+            content, translation_table, service,
+            constrain_to_discussion_languages)
+        if content_jobs:
+            jobs.extend(content_jobs)
+            changed.append(content)
+    if not jobs:
+        return []
+    try:
+        service.translate_lse_batch(jobs)
+    except:
+        capture_exception()
+        return []
+    for content in changed:
+        content.db.expire(content.body, ["entries"])
+        content.db.expire(content.subject, ["entries"])
+        if send_to_changes:
+            content.send_to_changes()
     return changed
 
 
+def translate_content(
+        content, translation_table=None, service=None,
+        constrain_to_discussion_languages=True,
+        send_to_changes=False):
+    return bool(translate_contents(
+        (content, ), translation_table, service,
+        constrain_to_discussion_languages, send_to_changes))
+
+
 @translation_celery_app.task(ignore_result=True)
 def translate_content_task(content_id):
     from ..models import Content
@@ -145,6 +350,49 @@ def translate_content_task(content_id):
     translate_content(content)
 
 
+@translation_celery_app.task(ignore_result=True)
+def translate_contents_task(content_ids, send_to_changes=True):
+    from ..models import Content
+    contents = Content.default_db.query(Content).filter(
+        Content.id.in_(content_ids)).all()
+    translate_contents(contents, send_to_changes=send_to_changes)
+
+
+@translation_celery_app.task(ignore_result=True)
+def translate_langstrings_task(requests):
+    """Translate the contents of LangStrings, given as a list of
+    (LangString id, target locales), and send the changed contents."""
+    from ..models import Content
+    targets_by_langstring = {
+        langstring_id: set(targets) for (langstring_id, targets) in requests}
+    langstring_ids = targets_by_langstring.keys()
+    with transaction.manager:
+        db = Content.default_db
+        contents = db.query(Content).filter(or_(
+            Content.body_id.in_(langstring_ids),
+            Content.subject_id.in_(langstring_ids)))
+        groups = defaultdict(list)
+        for content in contents:
+            targets = targets_by_langstring.get(content.body_id, set()) | \
+                targets_by_langstring.get(content.subject_id, set())
+            groups[(content.discussion_id, frozenset(targets))].append(
+                content)
+        for (_, targets), contents in groups.iteritems():
+            service = contents[0].discussion.translation_service()
+            if not service:
+                continue
+            translate_contents(
+                contents, FixedTargetsTranslationTable(service, targets),
+                service, send_to_changes=True)
+    pending_region().delete_multi([
+        _pending_key(langstring_id, target)
+        for (langstring_id, targets) in requests for target in targets])
+
+
+# Number of contents to collect before sending translations to the service
+TRANSLATION_CHUNK_SIZE = 500
+
+
 @translation_celery_app.task(ignore_result=True)
 def translate_discussion(
         discussion_id, translation_table=None,
@@ -159,10 +407,12 @@ def translate_discussion(
         translation_table = DiscussionPreloadTranslationTable(
             service, discussion)
     changed = False
-    for post in discussion.posts:
-        changed |= translate_content(
-            post, translation_table, service,
-            constrain_to_discussion_languages, send_to_changes)
+    posts = discussion.posts
+    for start in range(0, len(posts), TRANSLATION_CHUNK_SIZE):
+        changed |= bool(translate_contents(
+            posts[start:start + TRANSLATION_CHUNK_SIZE],
+            translation_table, service,
+            constrain_to_discussion_languages, send_to_changes))
     return changed
 
 
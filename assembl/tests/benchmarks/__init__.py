@@ -0,0 +1,3 @@
+"""Micro-benchmarks. Those are not collected by default;
+run them explicitly, e.g.
+``py.test -s assembl/tests/benchmarks/bench_generic_json.py``"""
@@ -0,0 +1,42 @@
+"""Benchmark the serialization of posts with generic_json"""
+from time import time
+
+import pytest
+
+NUM_POSTS = 3000
+
+
+@pytest.fixture(scope="function")
+def many_posts(request, discussion, participant1_user, test_session):
+    from assembl.models import Post, LangString
+    posts = [Post(
+        discussion=discussion, creator=participant1_user,
+        subject=LangString.create(u"post %d" % (i,)),
+        body=LangString.create(u"post body %d" % (i,)),
+        type="post", message_id="bench%d@example.com" % (i,))
+        for i in range(NUM_POSTS)]
+    test_session.add_all(posts)
+    test_session.flush()
+
+    def fin():
+        for p in posts:
+            test_session.delete(p)
+        test_session.flush()
+    request.addfinalizer(fin)
+    return posts
+
+
+@pytest.mark.parametrize("view_def_name", ["default", "id_only"])
+def test_generic_json_speed(
+        test_session, discussion, many_posts, participant1_user,
+        view_def_name):
+    user_id = participant1_user.id
+    # warm up the plans and load the relations
+    for post in many_posts:
+        post.generic_json(view_def_name, user_id)
+    start = time()
+    for post in many_posts:
+        post.generic_json(view_def_name, user_id)
+    elapsed = time() - start
+    print "%s: %d posts in %.3fs (%.1f us/post)" % (
+        view_def_name, NUM_POSTS, elapsed, 1000000 * elapsed / NUM_POSTS)
@@ -0,0 +1,57 @@
+"""Benchmark rendering many notifications about a few posts,
+as a notification batch would"""
+from time import time
+
+import pytest
+
+NUM_NOTIFICATIONS = 10000
+
+
+@pytest.fixture(scope="function")
+def many_notifications(request, test_session, discussion, participant1_user,
+                       root_post_1, reply_post_1, reply_post_2):
+    from assembl.models import (
+        Notification, NotificationSubscriptionFollowAllMessages,
+        NotificationCreationOrigin)
+    from assembl.models.notification import (
+        NotificationOnPostCreated, NotificationPushMethodType)
+    subscription = NotificationSubscriptionFollowAllMessages(
+        discussion=discussion, user=participant1_user,
+        creation_origin=NotificationCreationOrigin.USER_REQUESTED)
+    test_session.add(subscription)
+    test_session.flush()
+    posts = [root_post_1, reply_post_1, reply_post_2]
+    ids = NotificationOnPostCreated.bulk_create(test_session, [
+        dict(post_id=posts[i % len(posts)].id,
+             first_matching_subscription_id=subscription.id,
+             push_method=NotificationPushMethodType.EMAIL)
+        for i in range(NUM_NOTIFICATIONS)])
+    notifications = test_session.query(Notification).filter(
+        Notification.id.in_(ids)).all()
+
+    def fin():
+        print "finalizer many_notifications"
+        test_session.delete(subscription)
+        test_session.flush()
+    request.addfinalizer(fin)
+    return notifications
+
+
+@pytest.mark.parametrize("in_batch", [False, True])
+def test_render_notifications(
+        test_session, many_notifications, test_app, in_batch):
+    from assembl.models.notification import notification_rendering
+    # warm up the templates and load the relations
+    many_notifications[0].render_to_email_html_part()
+    start = time()
+    if in_batch:
+        with notification_rendering.batch():
+            for notification in many_notifications:
+                notification.render_to_email_html_part()
+    else:
+        for notification in many_notifications:
+            notification.render_to_email_html_part()
+    elapsed = time() - start
+    print "%s: %d notifications in %.3fs (%.1f ms/notification)" % (
+        "batch" if in_batch else "single", NUM_NOTIFICATIONS, elapsed,
+        1000 * elapsed / NUM_NOTIFICATIONS)
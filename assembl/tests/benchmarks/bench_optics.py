@@ -0,0 +1,35 @@
+"""Benchmark the OPTICS ordering with the full distance matrix and
+with neighbourhoods bounded to the nearest neighbours"""
+from time import time
+
+import numpy as N
+import pytest
+
+from assembl.nlp.optics import Optics
+
+NUM_TOPICS = 200
+MAX_NEIGHBOURS = 50
+# The dense distance matrix of 50k posts does not fit in memory
+DENSE_LIMIT = 10000
+
+
+def topic_vectors(num_posts, seed=0):
+    rng = N.random.RandomState(seed)
+    centers = rng.dirichlet(N.ones(NUM_TOPICS) * 0.1, 20)
+    labels = rng.randint(0, len(centers), num_posts)
+    return centers[labels] + rng.uniform(0, 0.01, (num_posts, NUM_TOPICS))
+
+
+@pytest.mark.parametrize("num_posts", [1000, 10000, 50000])
+@pytest.mark.parametrize("max_neighbours", [None, MAX_NEIGHBOURS])
+def test_optics_speed(num_posts, max_neighbours):
+    if max_neighbours is None and num_posts > DENSE_LIMIT:
+        pytest.skip("dense distance matrix too large")
+    x = topic_vectors(num_posts)
+    optics = Optics(4, 'cosine', max_neighbours)
+    start = time()
+    clusters = optics.extract_clusters(x, 0.02)
+    elapsed = time() - start
+    print "%s: %d posts in %.3fs, %d clusters" % (
+        "sparse" if max_neighbours else "dense", num_posts, elapsed,
+        len(clusters))
@@ -0,0 +1,51 @@
+"""Benchmark sending mail to a local SMTP sink with a connection
+per message, and with a pool of reused connections"""
+import smtplib
+from time import time
+from threading import Thread
+
+import pytest
+
+from assembl.lib.smtp import SMTPConnectionPool
+
+NUM_MESSAGES = 2000
+BODY = "Subject: notification\r\n\r\n" + "A notification body.\r\n" * 50
+
+
+def send_all(send, num_threads):
+    per_thread = NUM_MESSAGES // num_threads
+
+    def work(start):
+        for n in range(start, start + per_thread):
+            send('from@example.com', ['to%d@example.com' % n], BODY)
+    threads = [Thread(target=work, args=(n * per_thread,))
+               for n in range(num_threads)]
+    start = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time() - start
+
+
+@pytest.mark.parametrize("num_threads", [1, 4])
+def test_connection_per_message(smtp_sink, num_threads):
+    def send(from_addr, to_addrs, msg):
+        connection = smtplib.SMTP('127.0.0.1', smtp_sink.port)
+        connection.sendmail(from_addr, to_addrs, msg)
+        connection.quit()
+    elapsed = send_all(send, num_threads)
+    assert len(smtp_sink.messages) == NUM_MESSAGES
+    print "connection per message, %d threads: %.0f messages/s" % (
+        num_threads, NUM_MESSAGES / elapsed)
+
+
+@pytest.mark.parametrize("num_threads", [1, 4])
+def test_pooled_connections(smtp_sink, num_threads):
+    pool = SMTPConnectionPool(
+        '127.0.0.1', smtp_sink.port, max_connections=num_threads)
+    elapsed = send_all(pool.sendmail, num_threads)
+    pool.close()
+    assert len(smtp_sink.messages) == NUM_MESSAGES
+    print "pooled, %d threads: %.0f messages/s over %d connections" % (
+        num_threads, NUM_MESSAGES / elapsed, pool.connections_opened)
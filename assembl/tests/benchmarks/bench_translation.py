@@ -0,0 +1,58 @@
+"""Benchmark batched translation against one request per entry,
+with a fake provider that has a fixed latency per request"""
+from time import time
+
+import pytest
+
+NUM_POSTS = 1000
+# A tenth of the posts have distinct texts
+NUM_TEXTS = 100
+LATENCY = 0.01
+
+
+@pytest.fixture(scope="function")
+def posts_to_translate(request, discussion, participant1_user, test_session):
+    from assembl.models import Post, LangString
+    posts = [Post(
+        discussion=discussion, creator=participant1_user,
+        subject=LangString.create(u"", "en"),
+        body=LangString.create(u"post body %d" % (i % NUM_TEXTS,), "en"),
+        type="post", message_id="bench%d@example.com" % (i,))
+        for i in range(NUM_POSTS)]
+    test_session.add_all(posts)
+    test_session.flush()
+
+    def fin():
+        from assembl.models import TranslationMemory
+        for p in posts:
+            test_session.delete(p)
+        test_session.query(TranslationMemory).delete()
+        test_session.flush()
+    request.addfinalizer(fin)
+    return posts
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_translation_speed(
+        test_session, discussion, posts_to_translate, fr_locale, batched):
+    from assembl.nlp.translation_service import FakeBatchTranslationService
+    from assembl.tasks.translate import TranslationTable, translate_contents
+
+    class ToFrench(TranslationTable):
+        def languages_for(self, locale_code, db=None):
+            return ('fr', )
+
+    service = FakeBatchTranslationService(discussion, LATENCY)
+    table = ToFrench()
+    start = time()
+    if batched:
+        translate_contents(posts_to_translate, table, service)
+    else:
+        for post in posts_to_translate:
+            service.translate_lse(
+                post.body.first_original(), fr_locale)
+    test_session.flush()
+    elapsed = time() - start
+    print "%s: %d posts in %.3fs, %d requests" % (
+        "batched" if batched else "one by one", NUM_POSTS, elapsed,
+        len(service.requests))
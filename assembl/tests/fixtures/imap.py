@@ -0,0 +1,132 @@
+import re
+import SocketServer
+from threading import Thread
+
+import pytest
+
+
+class IMAPHandler(SocketServer.StreamRequestHandler):
+    """Speaks just enough IMAP to import the messages of a folder"""
+
+    def send(self, line):
+        self.wfile.write(line + '\r\n')
+
+    def handle(self):
+        server = self.server
+        self.send('* OK [CAPABILITY IMAP4rev1] IMAP stand-in ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            tag, command, args = (
+                line.rstrip('\r\n').split(' ', 2) + ['', ''])[:3]
+            command = command.upper()
+            if command == 'UID':
+                subcommand, args = (args.split(' ', 1) + [''])[:2]
+                command = 'UID ' + subcommand.upper()
+            server.commands.append((command, args))
+            if command == 'CAPABILITY':
+                self.send('* CAPABILITY IMAP4rev1')
+            elif command in ('SELECT', 'EXAMINE'):
+                self.send('* %d EXISTS' % len(server.messages))
+                self.send('* OK [UIDVALIDITY 1] UIDs valid')
+                self.send('* OK [UIDNEXT %d] Predicted next UID' % (
+                    server.next_uid,))
+            elif command == 'UID SEARCH':
+                # "ALL", or "(UID n:*)"
+                match = re.search(r'UID ([0-9:*,]+)', args)
+                uids = server.uids(match.group(1)) if match \
+                    else sorted(server.messages)
+                self.send('* SEARCH' + ''.join(' %d' % uid for uid in uids))
+            elif command == 'UID FETCH':
+                uid_set = args.split(' ', 1)[0]
+                sequence = {uid: n + 1 for (n, uid)
+                            in enumerate(sorted(server.messages))}
+                for uid in server.uids(uid_set):
+                    message = server.messages[uid]
+                    self.wfile.write(
+                        '* %d FETCH (UID %d RFC822.SIZE %d BODY[] {%d}\r\n'
+                        '%s)\r\n' % (sequence[uid], uid, len(message),
+                                     len(message), message))
+            elif command == 'LOGOUT':
+                self.send('* BYE IMAP stand-in logging out')
+                self.send('%s OK LOGOUT completed' % (tag,))
+                break
+            elif command not in ('LOGIN', 'NOOP', 'CLOSE'):
+                self.send('%s BAD unknown command' % (tag,))
+                continue
+            self.send('%s OK %s completed' % (tag, command))
+
+
+class IMAPStandIn(SocketServer.ThreadingTCPServer):
+    """A local IMAP server with a single folder of messages,
+    which records the commands it receives"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), IMAPHandler)
+        self.port = self.server_address[1]
+        self.messages = {}
+        self.next_uid = 1
+        self.commands = []
+
+    def add_message(self, message_string):
+        uid = self.next_uid
+        self.next_uid += 1
+        self.messages[uid] = message_string
+        return uid
+
+    def uids(self, uid_set):
+        """The UIDs of the messages in a UID set such as 3:7,9 or 5:*"""
+        uids = sorted(self.messages)
+        result = set()
+        for part in uid_set.split(','):
+            if ':' in part:
+                first, last = [
+                    (uids[-1] if uids else 0) if bound == '*' else int(bound)
+                    for bound in part.split(':')]
+                # n:* includes the last message, even if its uid is below n
+                first, last = min(first, last), max(first, last)
+                result.update(uid for uid in uids if first <= uid <= last)
+            elif int(part) in self.messages:
+                result.add(int(part))
+        return sorted(result)
+
+    def fetch_commands(self):
+        return [args for (command, args) in self.commands
+                if command == 'UID FETCH']
+
+
+@pytest.fixture(scope="function")
+def imap_stand_in(request):
+    """An IMAPStandIn fixture, served in a background thread"""
+    server = IMAPStandIn()
+    thread = Thread(target=server.serve_forever, args=(0.01,))
+    thread.daemon = True
+    thread.start()
+
+    def fin():
+        print "finalizer imap_stand_in"
+        server.shutdown()
+        server.server_close()
+    request.addfinalizer(fin)
+    return server
+
+
+def sample_message(n, **headers):
+    """An email, with headers to add or override"""
+    message_headers = [
+        ('From', 'Participant %d <participant%d@example.com>' % (n % 3, n % 3)),
+        ('To', 'discussion@example.com'),
+        ('Subject', 'Message %d' % (n,)),
+        ('Date', 'Mon, 6 Jun 2011 11:%02d:00 +0000' % (n % 60,)),
+        ('Message-ID', '<message%d@example.com>' % (n,)),
+        ('Content-Type', 'text/plain; charset=utf-8')]
+    message_headers = [(name, headers.pop(name, value))
+                       for (name, value) in message_headers]
+    message_headers.extend(headers.items())
+    return '\r\n'.join(
+        ['%s: %s' % header for header in message_headers] +
+        ['', 'Body of message %d' % (n,), ''])
@@ -65,3 +65,31 @@ def abstract_mailbox(request, discussion, test_session):
         test_session.flush()
     request.addfinalizer(fin)
     return ps
+
+
+@pytest.fixture(scope="function")
+def imap_mailbox(request, discussion, imap_stand_in, test_session):
+    """An IMAPMailbox fixture, reading from the IMAP stand-in"""
+
+    from assembl.models import IMAPMailbox
+    m = IMAPMailbox(
+        discussion=discussion, name='IMAP stand-in', host=u'127.0.0.1',
+        port=imap_stand_in.port, username=u'user', password=u'password',
+        use_ssl=False)
+    test_session.add(m)
+    test_session.flush()
+
+    def fin():
+        print "finalizer imap_mailbox"
+        m = IMAPMailbox.get(mailbox_id)
+        agents = set()
+        for post in m.contents:
+            agents.add(post.creator)
+            test_session.delete(post)
+        for agent in agents:
+            test_session.delete(agent)
+        test_session.delete(m)
+        test_session.flush()
+    mailbox_id = m.id
+    request.addfinalizer(fin)
+    return m
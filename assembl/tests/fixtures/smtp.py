@@ -0,0 +1,44 @@
+import asyncore
+import smtpd
+from threading import Thread
+
+import pytest
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """A local SMTP server that keeps the messages it receives"""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.connections = 0
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+
+@pytest.fixture(scope="function")
+def smtp_sink(request):
+    """A SMTPSink fixture, served in a background thread"""
+    sink = SMTPSink()
+    running = [True]
+
+    def serve():
+        while running[0]:
+            asyncore.loop(timeout=0.01, count=1)
+    thread = Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+
+    def fin():
+        print "finalizer smtp_sink"
+        running[0] = False
+        thread.join()
+        asyncore.close_all()
+    request.addfinalizer(fin)
+    return sink
@@ -0,0 +1,39 @@
+import numpy as np
+
+from assembl.nlp.clusters import SemanticAnalysisData
+
+
+def analysis_with_topics(post_ids, topic_matrix):
+    analysis = SemanticAnalysisData.__new__(SemanticAnalysisData)
+    analysis._post_ids = np.array(post_ids)
+    analysis._topic_matrix = topic_matrix
+    return analysis
+
+
+def test_gensimvecs_to_csr():
+    analysis = SemanticAnalysisData.__new__(SemanticAnalysisData)
+    vecs = [[(0, 1.0), (2, 2.0)], [], [(1, -1.0)]]
+    matrix = analysis.gensimvecs_to_csr(vecs, 3, np.array([1.0, 0.5, 0.25]))
+    assert matrix.shape == (3, 3)
+    assert np.allclose(matrix.toarray(), [
+        [1.0, 0.0, 0.5],
+        [0.0, 0.0, 0.0],
+        [0.0, -0.5, 0.0]])
+
+
+def test_cluster_centroids_use_complement_sums():
+    analysis = SemanticAnalysisData.__new__(SemanticAnalysisData)
+    dense = np.array([
+        [1.0, 0.0, 2.0],
+        [0.0, 1.0, 0.0],
+        [3.0, 0.0, 1.0],
+        [0.0, 2.0, 2.0]])
+    vecs = [[(j, v) for (j, v) in enumerate(row) if v] for row in dense]
+    analysis = analysis_with_topics(
+        [10, 11, 12, 13],
+        analysis.gensimvecs_to_csr(vecs, 3, np.ones(3)))
+    (centroid, complement), = analysis.cluster_centroids([[13, 10]])
+    assert np.allclose(centroid, dense[[0, 3]].mean(0))
+    assert np.allclose(complement, dense[[1, 2]].mean(0))
+    assert np.array_equal(analysis.post_rows([11, 13]), [1, 3])
+    assert analysis.post_rows([11, 14]) is None
@@ -0,0 +1,30 @@
+import simplejson as json
+from datetime import datetime
+
+from assembl.lib.export import csv_chunks, json_list_chunks
+
+
+def test_csv_chunks_match_single_write():
+    rows = [{'a': i, 'b': 'x' * (i % 7)} for i in range(1000)]
+    chunks = list(csv_chunks(iter(rows), ['a', 'b'], chunk_size=256))
+    assert len(chunks) > 1
+    lines = ''.join(chunks).split('\r\n')
+    assert lines[0] == 'a;b'
+    assert lines[1] == '0;'
+    assert lines[1000] == '999;xxxxx'
+    assert len(lines) == 1002
+
+
+def test_csv_chunks_empty():
+    assert list(csv_chunks(iter(()))) == []
+    assert ''.join(csv_chunks(iter(()), ['a'])) == 'a\r\n'
+
+
+def test_json_list_chunks():
+    items = [dict(n=i, date=datetime(2016, 1, 1, i % 24)) for i in range(500)]
+    chunks = list(json_list_chunks(iter(items), chunk_size=512))
+    assert len(chunks) > 1
+    decoded = json.loads(''.join(chunks))
+    assert [d['n'] for d in decoded] == range(500)
+    assert decoded[1]['date'].startswith('2016-01-01T01:00:00')
+    assert json.loads(''.join(json_list_chunks(iter(())))) == []
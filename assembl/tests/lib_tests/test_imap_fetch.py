@@ -0,0 +1,48 @@
+from imaplib2 import IMAP4
+
+from assembl.lib.imap_fetch import uid_ranges, fetch_range, FetchPipeline
+from assembl.tests.fixtures.imap import sample_message
+
+
+def connect(imap_stand_in):
+    mailbox = IMAP4(host='127.0.0.1', port=imap_stand_in.port)
+    mailbox.login('user', 'password')
+    mailbox.select('INBOX')
+    return mailbox
+
+
+def test_uid_ranges():
+    assert uid_ranges([], 3) == []
+    assert uid_ranges(['7', '2', '3', '10', '11'], 2) == [
+        (2, 3), (7, 10), (11, 11)]
+
+
+def test_fetch_range(imap_stand_in):
+    for n in range(5):
+        imap_stand_in.add_message(sample_message(n))
+    del imap_stand_in.messages[2]
+    mailbox = connect(imap_stand_in)
+    messages = fetch_range(mailbox, 1, 4)
+    mailbox.logout()
+    assert [uid for (uid, size, message) in messages] == [1, 3, 4]
+    assert messages[1][1] == len(messages[1][2])
+    assert messages[1][2] == sample_message(2)
+    assert imap_stand_in.fetch_commands() == ['1:4 (RFC822.SIZE BODY.PEEK[])']
+
+
+def test_fetch_pipeline(imap_stand_in):
+    for n in range(10):
+        imap_stand_in.add_message(sample_message(n))
+    mailbox = connect(imap_stand_in)
+    pipeline = FetchPipeline(mailbox, uid_ranges(range(1, 11), 4))
+    chunks = list(pipeline)
+    assert [uid_range for (uid_range, messages) in chunks] == [
+        (1, 4), (5, 8), (9, 10)]
+    assert sum(len(messages) for (uid_range, messages) in chunks) == 10
+    assert pipeline.bytes_fetched == sum(
+        len(m) for m in imap_stand_in.messages.itervalues())
+    # Stopping early leaves the connection usable
+    for chunk in FetchPipeline(mailbox, uid_ranges(range(1, 11), 2)):
+        break
+    assert fetch_range(mailbox, 10, 10)[0][0] == 10
+    mailbox.logout()
@@ -0,0 +1,26 @@
+from os.path import join
+
+from assembl.nlp.indexedcorpus import IdMmCorpus
+
+
+def test_append_to_corpus(tmpdir):
+    fname = join(str(tmpdir), 'posts.mm')
+    IdMmCorpus.serialize(fname, [
+        (10, [(0, 1), (2, 3)]),
+        (12, []),
+        (15, [(1, 2)])])
+    IdMmCorpus.append(fname, [
+        (20, [(3, 1), (0, 2)]),
+        (22, [])], 4)
+    IdMmCorpus.append(fname, [(25, [(1, 1)])])
+    corpus = IdMmCorpus(fname)
+    assert corpus.num_docs == 6
+    assert corpus.num_terms == 4
+    assert corpus.num_nnz == 6
+    assert list(corpus.dockeys) == [10, 12, 15, 20, 22, 25]
+    assert corpus[10] == [(0, 1.0), (2, 3.0)]
+    assert corpus[12] == []
+    assert corpus[20] == [(0, 2.0), (3, 1.0)]
+    assert corpus[22] == []
+    assert corpus[25] == [(1, 1.0)]
+    assert [len(doc) for doc in corpus] == [2, 0, 1, 2, 0, 1]
@@ -0,0 +1,58 @@
+import numpy as N
+from sklearn.metrics.pairwise import pairwise_distances
+
+from assembl.nlp.optics import Optics
+
+
+def reference_optics(D, min_points):
+    """The original seed loop, kept to check the ordering."""
+    m = D.shape[0]
+    CD = N.array([N.sort(D[i])[min_points] for i in xrange(m)])
+    RD = N.ones(m) * 1E10
+    order = []
+    seeds = N.arange(m, dtype=N.int)
+    ind = 0
+    while len(seeds) != 1:
+        ob = seeds[ind]
+        seeds = seeds[N.where(seeds != ob)]
+        order.append(ob)
+        mm = N.maximum(CD[ob], D[ob][seeds])
+        ii = N.where(RD[seeds] > mm)[0]
+        RD[seeds[ii]] = mm[ii]
+        ind = N.argmin(RD[seeds])
+    order.append(seeds[0])
+    RD[0] = 0
+    return N.maximum(RD, 0), order
+
+
+def blobs(seed=0):
+    rng = N.random.RandomState(seed)
+    centers = rng.uniform(-10, 10, (4, 5))
+    return N.vstack([rng.normal(c, 0.5, (40, 5)) for c in centers])
+
+
+def test_optics_matches_reference():
+    x = blobs()
+    D = pairwise_distances(x, metric='euclidean')
+    RD, order = reference_optics(D, 4)
+    optics = Optics(4, 'euclidean')
+    clusters = optics.extract_clusters(x, 0.05)
+    assert list(optics.order) == order
+    assert N.allclose(optics.RD, RD)
+    reference = Optics(4, 'euclidean')
+    reference.RD = RD
+    reference.RDO = RD[order]
+    reference.order = order
+    assert clusters == reference.extract_clusters(eps=0.05)
+    assert len(clusters)
+
+
+def test_sparse_optics_with_all_neighbours_matches_dense():
+    x = blobs(1)
+    dense = Optics(4, 'euclidean')
+    dense.calculate_distances(x)
+    sparse = Optics(4, 'euclidean', max_neighbours=len(x) - 1)
+    sparse.calculate_distances(x)
+    assert list(sparse.order) == list(dense.order)
+    assert N.allclose(sparse.RD, dense.RD)
+
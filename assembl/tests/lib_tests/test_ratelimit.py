@@ -0,0 +1,56 @@
+from assembl.lib.ratelimit import TokenBucket, DomainRateLimiter
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    bucket = TokenBucket(2, 3, now=0)
+    assert [bucket.reserve(0) for _ in range(3)] == [0, 0, 0]
+    # Reservations beyond the burst are spaced out
+    assert bucket.reserve(0) == 0.5
+    assert bucket.reserve(0) == 1
+    assert bucket.wait_time(1) == 0.5
+    # Refills up to the capacity
+    assert bucket.wait_time(100) == 0
+    assert bucket.tokens == 3
+
+
+def test_domain_limits():
+    clock = Clock()
+    limiter = DomainRateLimiter(clock)
+    limiter.set_limit('', 10, 10)
+    limiter.set_limit('example.com', 1)
+    assert limiter.limited_domain('a@mail.example.com') == 'example.com'
+    assert limiter.limited_domain('a@example.org') == ''
+    assert limiter.reserve('a@example.com') == 0
+    assert limiter.reserve('b@mail.example.com') == 1
+    # Other domains are not throttled
+    assert limiter.reserve('a@example.org') == 0
+    clock.now += 2
+    assert limiter.reserve('c@example.com') == 0
+    metrics = limiter.metrics()
+    assert metrics['example.com']['sent'] == 2
+    assert metrics['example.com']['deferred'] == 1
+    assert metrics['']['sent'] == 1
+    limiter.set_limit('', 0)
+    assert limiter.limited_domain('a@example.org') is None
+    assert limiter.reserve('a@example.org') == 0
+
+
+def test_throttled_domains_last():
+    clock = Clock()
+    limiter = DomainRateLimiter(clock)
+    limiter.set_limit('slow.com', 1)
+    limiter.set_limit('fast.com', 100, 5)
+    limiter.reserve('x@slow.com')
+    emails = ['a@slow.com', 'b@slow.com', 'a@fast.com', 'b@fast.com',
+              'a@other.com']
+    assert limiter.order(emails, lambda e: e) == [
+        'a@fast.com', 'a@other.com', 'a@slow.com',
+        'b@fast.com', 'b@slow.com']
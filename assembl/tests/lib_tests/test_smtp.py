@@ -0,0 +1,49 @@
+from threading import Thread
+
+from assembl.lib.smtp import SMTPConnectionPool
+
+
+def message(n):
+    return "Subject: test %d\r\n\r\nMessage %d\r\n" % (n, n)
+
+
+def test_pool_reuses_connections(smtp_sink):
+    pool = SMTPConnectionPool('127.0.0.1', smtp_sink.port, max_messages=3)
+    for n in range(10):
+        assert pool.sendmail(
+            'from@example.com', ['to%d@example.com' % n], message(n)) == {}
+    pool.close()
+    assert len(smtp_sink.messages) == 10
+    assert smtp_sink.messages[9][1] == ['to9@example.com']
+    assert 'Message 9' in smtp_sink.messages[9][2]
+    # 3 messages per connection
+    assert pool.connections_opened == 4
+    assert smtp_sink.connections == 4
+
+
+def test_pool_bounds_connections(smtp_sink):
+    pool = SMTPConnectionPool('127.0.0.1', smtp_sink.port, max_connections=2)
+
+    def send(start):
+        for n in range(start, start + 20):
+            pool.sendmail(
+                'from@example.com', ['to%d@example.com' % n], message(n))
+    threads = [Thread(target=send, args=(n * 20,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool.close()
+    assert len(smtp_sink.messages) == 80
+    assert pool.connections_opened <= 2
+
+
+def test_pool_replaces_dropped_connections(smtp_sink):
+    pool = SMTPConnectionPool('127.0.0.1', smtp_sink.port)
+    pool.sendmail('from@example.com', ['to@example.com'], message(0))
+    # The relay drops the idle connection
+    pool._idle[0][0].sock.close()
+    pool.sendmail('from@example.com', ['to@example.com'], message(1))
+    pool.close()
+    assert len(smtp_sink.messages) == 2
+    assert pool.connections_opened == 2
@@ -0,0 +1,63 @@
+import numpy as np
+
+from assembl.nlp.vectorindex import VectorIndex, top_k
+
+
+def exact_neighbours(vectors, query, k):
+    vectors = vectors / np.sqrt((vectors ** 2).sum(1))[:, np.newaxis]
+    return np.argsort(-vectors.dot(query / np.sqrt(query.dot(query))))[:k]
+
+
+def test_top_k():
+    scores = np.array([0.1, 0.5, 0.3, 0.9, 0.2])
+    assert list(top_k(scores, 3)) == [3, 1, 2]
+    assert list(top_k(scores, 10)) == [3, 1, 2, 4, 0]
+
+
+def test_vector_index_incremental(tmpdir):
+    rng = np.random.RandomState(0)
+    vectors = rng.randn(300, 20)
+    ids = np.arange(300) * 2 + 1
+    dirname = str(tmpdir.join('index'))
+    index = VectorIndex.open(dirname, dim=20)
+    index.append(ids[:200], vectors[:200])
+    assert len(index) == 200
+    # A later request sees appended vectors
+    index.append(ids[200:], vectors[200:])
+    index = VectorIndex.open(dirname)
+    assert len(index) == 300
+    assert index.max_id == ids[-1]
+    found, scores = index.query(vectors[250], 5)
+    assert list(found) == list(ids[exact_neighbours(vectors, vectors[250], 5)])
+    assert abs(scores[0] - 1) < 1e-5
+    assert all(scores[:-1] >= scores[1:])
+    VectorIndex.clear(dirname)
+
+
+def test_vector_index_rebuilt_elsewhere(tmpdir):
+    dirname = str(tmpdir.join('index'))
+    with VectorIndex.updating(dirname):
+        index = VectorIndex.open(dirname, dim=20, build_id='first')
+        index.append([1, 2], np.ones((2, 20)))
+    # Another process rebuilds the index
+    with VectorIndex.updating(dirname):
+        for path in tmpdir.join('index').listdir():
+            if path.basename != 'update.lock':
+                path.remove()
+        VectorIndex(dirname, dim=20, build_id='second')
+    index = VectorIndex.open(dirname, dim=20, build_id='first')
+    assert index.build_id == 'second'
+    assert len(index) == 0
+    VectorIndex.clear(dirname)
+
+
+def test_vector_index_candidates(tmpdir):
+    rng = np.random.RandomState(1)
+    centers = rng.randn(10, 20)
+    vectors = np.repeat(centers, 100, 0) + rng.randn(1000, 20) * 0.05
+    index = VectorIndex(str(tmpdir), dim=20, num_bits=32,
+                        exact_limit=100, num_candidates=200)
+    index.append(np.arange(1000), vectors)
+    found, _ = index.query(centers[3], 50)
+    # approximate search still finds the right neighbourhood
+    assert all(300 <= i < 400 for i in found)
@@ -0,0 +1,47 @@
+import mock
+
+from assembl.lib import zmqlib
+
+
+def test_changes_publisher_coalesces():
+    sent = []
+
+    def fake_send(socket, discussion, changes, encoding=None):
+        sent.append((discussion, changes))
+
+    with mock.patch.object(zmqlib, 'get_pub_socket'), \
+            mock.patch.object(zmqlib, 'send_changes', fake_send):
+        publisher = zmqlib.ChangesPublisher(window=0.2)
+        publisher.publish('1', [
+            {'@id': 'local:Idea/1', '@view': 'changes', 'v': 1},
+            {'@id': 'local:Idea/2', '@view': 'changes', 'v': 1}])
+        publisher.publish('1', [
+            {'@id': 'local:Idea/1', '@view': 'changes', 'v': 2}])
+        publisher.publish('2', [
+            {'@id': 'local:Post/3', '@view': 'changes', 'v': 1}])
+        publisher.close()
+    assert sent == [
+        ('1', [{'@id': 'local:Idea/2', '@view': 'changes', 'v': 1},
+               {'@id': 'local:Idea/1', '@view': 'changes', 'v': 2}]),
+        ('2', [{'@id': 'local:Post/3', '@view': 'changes', 'v': 1}])]
+    stats = publisher.get_stats()
+    assert stats['changes_received'] == 4
+    assert stats['changes_sent'] == 3
+    assert stats['batches_sent'] == 1
+
+
+def test_changes_encoding():
+    frames = ('1',) + zmqlib.encode_changes([{'@id': 'a'}], 'json')
+    assert zmqlib.decode_changes(frames) == [{'@id': 'a'}]
+    assert zmqlib.changes_as_json(frames) == '[{"@id":"a"}]'
+
+
+def test_changes_topics():
+    public = zmqlib.changes_topic(1)
+    private = zmqlib.changes_topic(1, 'local:AgentProfile/2')
+    assert zmqlib.parse_changes_topic(public) == ('1', None)
+    assert zmqlib.parse_changes_topic(private) == (
+        '1', 'local:AgentProfile/2')
+    # ZMQ subscriptions are by prefix
+    assert not zmqlib.changes_topic(12).startswith(public)
+    assert not private.startswith(public)
@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta
+
+
+def test_time_series_from_rollups(
+        test_session, discussion, participant1_user, participant2_user):
+    from assembl.models import Post, LangString, ViewPost
+    from assembl.models.analytics import time_series
+    base = datetime(2001, 1, 1)
+    posts = [Post(
+        discussion=discussion, creator=creator,
+        subject=LangString.create(u"", "en"),
+        body=LangString.create(u"analytics", "en"),
+        creation_date=base + timedelta(hours=hours),
+        type="post", message_id="analytics%d@example.com" % (i,))
+        for (i, (creator, hours)) in enumerate((
+            (participant1_user, 1), (participant1_user, 2),
+            (participant2_user, 30)))]
+    test_session.add_all(posts)
+    test_session.flush()
+    view = ViewPost(
+        actor=participant2_user, post=posts[0],
+        creation_date=base + timedelta(hours=3))
+    test_session.add(view)
+    status = participant2_user.create_agent_status_in_discussion(discussion)
+    first_visit, last_visit = status.first_visit, status.last_visit
+    status.first_visit = base + timedelta(hours=3)
+    status.last_visit = base + timedelta(hours=4)
+    test_session.flush()
+    # Moving a date moves it to another bucket
+    status.last_visit = base + timedelta(hours=26)
+    test_session.flush()
+    intervals = [(base, base + timedelta(days=1)),
+                 (base + timedelta(days=1), base + timedelta(days=2))]
+    day1, day2 = time_series(test_session, discussion.id, intervals)
+    assert day1['count_posts'] == 2
+    assert day1['count_post_authors'] == 1
+    assert day1['count_cumulative_post_authors'] == 1
+    assert day1['UNRELIABLE_count_post_viewers'] == 1
+    assert day1['count_first_time_logged_in_visitors'] == 1
+    assert day1['retention_count_last_visit_in_period'] == 0
+    assert day2['count_posts'] == 1
+    assert day2['count_cumulative_posts'] == 3
+    assert day2['count_cumulative_post_authors'] == 2
+    assert day2['fraction_cumulative_authors_who_posted_in_period'] == 0.5
+    assert day2['retention_count_last_visit_in_period'] == 1
+    status.first_visit, status.last_visit = first_visit, last_visit
+    test_session.delete(view)
+    for post in posts:
+        test_session.delete(post)
+    test_session.flush()
+
+
+def test_contributions_per_interval(
+        test_session, discussion, participant1_user, participant2_user):
+    from assembl.models import Post, LangString
+    base = datetime(2002, 1, 1)
+    posts = [Post(
+        discussion=discussion, creator=creator,
+        subject=LangString.create(u"", "en"),
+        body=LangString.create(u"contributions", "en"),
+        creation_date=base + timedelta(hours=hours),
+        type="post", message_id="contributions%d@example.com" % (i,))
+        for (i, (creator, hours)) in enumerate((
+            (participant1_user, 1), (participant1_user, 2),
+            (participant2_user, 3), (participant2_user, 30)))]
+    test_session.add_all(posts)
+    test_session.flush()
+    intervals = [(base, base + timedelta(days=1)),
+                 (base + timedelta(days=1), base + timedelta(days=2)),
+                 (base + timedelta(days=2), base + timedelta(days=3))]
+    counts = discussion.count_contributions_per_interval(intervals)
+    assert sorted(counts) == sorted([
+        (0, participant1_user.id, 2),
+        (0, participant2_user.id, 1),
+        (1, participant2_user.id, 1)])
+    for (n, (start, end)) in enumerate(intervals):
+        assert sorted(discussion.count_contributions_per_agent(
+            start, end, False)) == sorted(
+            (creator_id, count) for (i, creator_id, count) in counts
+            if i == n)
+    assert discussion.count_new_visitors_per_interval(intervals) == [0, 0, 0]
+    for post in posts:
+        test_session.delete(post)
+    test_session.flush()
+
+
+def test_moved_posts_update_rollups(
+        test_session, discussion, discussion2, participant1_user,
+        participant2_user):
+    from assembl.models import Post, LangString, ViewPost
+    from assembl.models.analytics import time_series
+    base = datetime(2003, 1, 1)
+    post = Post(
+        discussion=discussion, creator=participant1_user,
+        subject=LangString.create(u"", "en"),
+        body=LangString.create(u"moved", "en"),
+        creation_date=base + timedelta(hours=1),
+        type="post", message_id="moved@example.com")
+    test_session.add(post)
+    test_session.flush()
+    view = ViewPost(
+        actor=participant2_user, post=post,
+        creation_date=base + timedelta(hours=2))
+    test_session.add(view)
+    test_session.flush()
+    intervals = [(base, base + timedelta(days=1)),
+                 (base + timedelta(days=1), base + timedelta(days=2))]
+    post.creation_date = base + timedelta(hours=30)
+    test_session.flush()
+    day1, day2 = time_series(test_session, discussion.id, intervals)
+    assert day1['count_posts'] == 0
+    assert day2['count_posts'] == 1
+    post.discussion_id = discussion2.id
+    test_session.flush()
+    day1, day2 = time_series(test_session, discussion.id, intervals)
+    assert day2['count_posts'] == 0
+    assert day1['UNRELIABLE_count_post_viewers'] == 0
+    day1, day2 = time_series(test_session, discussion2.id, intervals)
+    assert day2['count_posts'] == 1
+    assert day1['UNRELIABLE_count_post_viewers'] == 1
+    test_session.delete(view)
+    test_session.delete(post)
+    test_session.flush()
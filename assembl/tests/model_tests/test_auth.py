@@ -17,3 +17,82 @@ def test_subscribe_to_discussion(
     participant2_user.unsubscribe(discussion)
     test_session.flush()
     assert discussion in participant2_user.participant_in_discussion, "The user should no longer be subscribed to the discussion"
+
+
+def test_effective_permissions(
+        test_session, discussion, participant1_user):
+    from dogpile.cache import make_region
+    from assembl.auth import R_MODERATOR, P_ADD_POST, P_MODERATE, P_READ
+    from assembl.auth.util import (
+        get_permissions, get_roles, user_has_permission,
+        EffectivePermissionsCache)
+    from assembl.models.auth import Role, LocalUserRole
+    assert user_has_permission(discussion.id, participant1_user.id, P_ADD_POST)
+    assert not user_has_permission(
+        discussion.id, participant1_user.id, P_MODERATE)
+    assert P_READ in get_permissions(None, discussion.id)
+    role = Role.get_role(R_MODERATOR, test_session)
+    lur = LocalUserRole(
+        user=participant1_user, discussion=discussion, role=role)
+    test_session.add(lur)
+    test_session.flush()
+    # uncommitted changes are seen in the session
+    assert 'permission_changes' in test_session.info
+    assert R_MODERATOR in get_roles(participant1_user.id, discussion.id)
+    assert user_has_permission(discussion.id, participant1_user.id, P_MODERATE)
+    # Simulate the commit with a local cache
+    cache = EffectivePermissionsCache()
+    cache._mode = 'local'
+    cache._region = make_region().configure('dogpile.cache.memory')
+    changes = test_session.info.pop('permission_changes')
+    permissions = cache.get(test_session, participant1_user.id, discussion.id)
+    assert P_MODERATE in permissions.permissions
+    test_session.delete(lur)
+    test_session.flush()
+    # memoized in the session, but bypassed while there are changes
+    assert 'effective_permissions' not in test_session.info
+    assert P_MODERATE not in cache.get(
+        test_session, participant1_user.id, discussion.id).permissions
+    changes = test_session.info.pop('permission_changes')
+    assert changes == {cache.user_key(participant1_user.id)}
+    # Stale until invalidated
+    assert P_MODERATE in cache.get(
+        test_session, participant1_user.id, discussion.id).permissions
+    test_session.info.pop('effective_permissions')
+    cache.invalidate(changes)
+    assert P_MODERATE not in cache.get(
+        test_session, participant1_user.id, discussion.id).permissions
+
+
+def test_effective_permissions_not_kept_across_requests(
+        test_session, discussion, participant1_user):
+    import transaction
+    from dogpile.cache import make_region
+    from assembl.auth import R_MODERATOR, P_MODERATE
+    from assembl.auth.util import EffectivePermissionsCache
+    from assembl.models.auth import Role, LocalUserRole
+    role = Role.get_role(R_MODERATOR, test_session)
+    lur = LocalUserRole(
+        user=participant1_user, discussion=discussion, role=role)
+    test_session.add(lur)
+    test_session.flush()
+    lur_id = lur.id
+    user_id = participant1_user.id
+    discussion_id = discussion.id
+    transaction.commit()
+    cache = EffectivePermissionsCache()
+    cache._mode = 'local'
+    cache._region = make_region().configure('dogpile.cache.memory')
+    # A read-only request
+    with transaction.manager:
+        assert P_MODERATE in cache.get(
+            test_session, user_id, discussion_id).permissions
+    # The role is revoked by another worker
+    lur_table = LocalUserRole.__table__
+    test_session.get_bind().execute(
+        lur_table.delete().where(lur_table.c.id == lur_id))
+    cache.invalidate([cache.user_key(user_id)])
+    # The next read-only request on this thread
+    with transaction.manager:
+        assert P_MODERATE not in cache.get(
+            test_session, user_id, discussion_id).permissions
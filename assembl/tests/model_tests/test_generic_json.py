@@ -0,0 +1,50 @@
+from assembl.lib.sqla import _JsonPlan
+from assembl.view_def import get_view_def
+
+
+def test_generic_json_plan_cached(test_session, root_post_1):
+    from assembl.models import Post
+    json = root_post_1.generic_json('default')
+    assert json['@id'] == root_post_1.uri()
+    plan = _JsonPlan.get(Post, 'default')
+    assert plan.source is get_view_def('default')
+    assert _JsonPlan.get(Post, 'default') is plan
+    assert root_post_1.generic_json('default') == json
+
+
+def test_generic_json_plan_recompiled_on_reload(test_session, root_post_1):
+    from assembl.models import Post
+    from assembl import view_def
+    json = root_post_1.generic_json('id_only')
+    plan = _JsonPlan.get(Post, 'id_only')
+    # Simulate a reload of the view_def file
+    old_def = view_def._def_cache.pop('id_only', None)
+    try:
+        assert _JsonPlan.get(Post, 'id_only') is not plan
+        assert root_post_1.generic_json('id_only') == json
+    finally:
+        if old_def is not None:
+            view_def._def_cache['id_only'] = old_def
+
+
+def test_filter_user_can_matches_user_can(
+        test_session, root_post_1, reply_post_1, participant1_user,
+        participant2_user):
+    from pyramid.security import Everyone
+    from assembl.auth import P_READ, P_ADMIN_DISC, CrudPermissions
+    from assembl.lib.sqla import BaseOps
+    instances = [root_post_1, participant1_user, reply_post_1,
+                 participant2_user] + list(participant1_user.accounts)
+    for user_id in (Everyone, participant1_user.id):
+        for permissions in ((), (P_READ, ), (P_READ, P_ADMIN_DISC)):
+            for operation in (CrudPermissions.READ, CrudPermissions.UPDATE):
+                expected = [
+                    ob for ob in instances
+                    if ob.user_can(user_id, operation, permissions)]
+                assert BaseOps.filter_user_can(
+                    instances, user_id, operation, permissions) == expected
+    pairs = BaseOps.generic_json_list(
+        instances, 'default', participant1_user.id, (P_READ, ))
+    assert [json for (ob, json) in pairs] == [
+        ob.generic_json('default', participant1_user.id, (P_READ, ))
+        for (ob, json) in pairs]
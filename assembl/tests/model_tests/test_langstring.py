@@ -573,3 +573,113 @@ def test_user_language_preference_en_from_fr_fr_from_en_fr_entry(
     best = langstring_body.best_lang(user_prefs=lang_prefs, allow_errors=True)
 
     assert best.locale.id == en_from_fr_locale.id
+
+
+def test_batch_translation_with_memory(
+        test_session, discussion, participant1_user, en_locale, fr_locale):
+    """
+    Bodies: en, two of them identical
+    Expect: fr-x-mtfrom-en translations, identical texts translated once,
+    then taken from the translation memory
+    """
+    from assembl.models import Post, LangString, Locale, TranslationMemory
+    from assembl.nlp.translation_service import FakeBatchTranslationService
+    from assembl.tasks.translate import TranslationTable, translate_contents
+
+    class ToFrench(TranslationTable):
+        def languages_for(self, locale_code, db=None):
+            return ('fr', )
+
+    def make_posts(texts, offset):
+        posts = [Post(
+            discussion=discussion, creator=participant1_user,
+            subject=LangString.create(u"", "en"),
+            body=LangString.create(text, "en"),
+            type="post", message_id="batch%d@example.com" % (offset + i,))
+            for (i, text) in enumerate(texts)]
+        test_session.add_all(posts)
+        test_session.flush()
+        return posts
+
+    posts = make_posts([u"the same text"] * 3 + [u"another text"], 0)
+    service = FakeBatchTranslationService(discussion)
+    changed = translate_contents(posts, ToFrench(), service)
+    test_session.flush()
+    mt_locale_id = Locale.get_id_of('fr-x-mtfrom-en')
+    assert len(changed) == 4
+    # one request, with each distinct text once
+    assert service.requests == [2]
+    for post in posts:
+        entry = post.body.entries_as_dict[mt_locale_id]
+        assert entry.value.endswith(post.body.first_original().value)
+    # New posts with the same texts use the memory
+    more_posts = make_posts([u"another text", u"the same text"], 4)
+    translate_contents(more_posts, ToFrench(), service)
+    assert service.requests == [2]
+    assert test_session.query(TranslationMemory).filter_by(
+        service=FakeBatchTranslationService.__name__).count() == 2
+    for post in posts + more_posts:
+        test_session.delete(post)
+    test_session.query(TranslationMemory).delete()
+    test_session.flush()
+
+
+def test_translation_memory_keeps_new_texts_on_conflict(test_session):
+    from assembl.models import TranslationMemory
+    TranslationMemory.remember(
+        test_session, "TestService", "en", "fr",
+        {u"known": (u"connu", None)})
+    # Another worker remembered "known" in the meantime
+    TranslationMemory.remember(
+        test_session, "TestService", "en", "fr",
+        {u"known": (u"connu", None), u"new": (u"nouveau", None)})
+    assert TranslationMemory.lookup(
+        test_session, "TestService", "en", "fr", [u"known", u"new"]) == {
+        u"known": (u"connu", None), u"new": (u"nouveau", None)}
+    test_session.query(TranslationMemory).filter_by(
+        service="TestService").delete()
+    test_session.flush()
+
+
+def test_missing_translations_are_queued(
+        test_session, discussion, participant1_user, en_locale, fr_locale):
+    """
+    Bodies: en, one with an existing fr-x-mtfrom-en translation
+    Expect: only the untranslated body is queued, the queue is
+    emptied on rollback, and requests of another transaction are dropped
+    """
+    from assembl.models import Post, LangString, LangStringEntry, Locale
+    from assembl.nlp.translation_service import FakeBatchTranslationService
+    from assembl.tasks.translate import (
+        FixedTargetsTranslationTable, missing_translations,
+        enqueue_translations, translation_rollback_listener,
+        pending_translation_requests)
+
+    service = FakeBatchTranslationService(discussion)
+    table = FixedTargetsTranslationTable(service, ('fr', ))
+    translated_body = LangString.create(u"translated", "en")
+    LangStringEntry(
+        langstring=translated_body, value=u"traduit",
+        locale_id=Locale.get_id_of("fr-x-mtfrom-en"))
+    posts = [Post(
+        discussion=discussion, creator=participant1_user,
+        subject=LangString.create(u"", "en"), body=body,
+        type="post", message_id="queued%d@example.com" % (i,))
+        for (i, body) in enumerate(
+            (LangString.create(u"untranslated", "en"), translated_body))]
+    test_session.add_all(posts)
+    test_session.flush()
+    missing = missing_translations(posts[0], table, service)
+    assert missing == {posts[0].body_id: {'fr'}}
+    assert missing_translations(posts[1], table, service) == {}
+    test_session.info.pop('translation_requests', None)
+    enqueue_translations(test_session, missing)
+    assert pending_translation_requests(test_session) == missing
+    translation_rollback_listener(test_session)
+    assert 'translation_requests' not in test_session.info
+    # Left over by a transaction that never committed the session
+    test_session.info['translation_requests'] = (object(), missing)
+    assert pending_translation_requests(test_session) == {}
+    test_session.info.pop('translation_requests', None)
+    for post in posts:
+        test_session.delete(post)
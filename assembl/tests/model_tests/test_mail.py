@@ -448,4 +448,41 @@ Yes!
 
     check_striping_plaintext(original, expected, "Gmail plaintext, circa 2012")
 
-    
\ No newline at end of file
+    
+
+def test_imap_import_by_uid_ranges(
+        test_session, imap_stand_in, imap_mailbox):
+    from assembl.models import mail, IMAPMailbox
+    from assembl.tests.fixtures.imap import sample_message
+    for n in range(7):
+        imap_stand_in.add_message(sample_message(n))
+    imap_stand_in.add_message(sample_message(7, **{'Return-Path': '<>'}))
+    # The same message, twice
+    imap_stand_in.add_message(sample_message(6))
+    chunk_size = mail.IMAP_FETCH_CHUNK_SIZE
+    mail.IMAP_FETCH_CHUNK_SIZE = 4
+    try:
+        imap_mailbox.do_import_content(imap_mailbox, True)
+        mailbox = IMAPMailbox.get(imap_mailbox.id)
+        emails = test_session.query(Email).filter_by(source_id=mailbox.id)
+        assert emails.count() == 7, "The bounce should have been skipped"
+        assert mailbox.last_imported_email_uid == '9'
+        assert imap_stand_in.fetch_commands() == [
+            '1:4 (RFC822.SIZE BODY.PEEK[])',
+            '5:8 (RFC822.SIZE BODY.PEEK[])',
+            '9:9 (RFC822.SIZE BODY.PEEK[])']
+
+        # Resumes after the last imported message
+        for n in range(10, 12):
+            imap_stand_in.add_message(sample_message(n))
+        imap_stand_in.commands = []
+        mailbox.do_import_content(mailbox, True)
+        mailbox = IMAPMailbox.get(imap_mailbox.id)
+        assert emails.count() == 9
+        assert mailbox.last_imported_email_uid == '11'
+        assert imap_stand_in.fetch_commands() == [
+            '10:11 (RFC822.SIZE BODY.PEEK[])']
+        last_email = emails.filter_by(source_post_id='message10@example.com').one()
+        assert last_email.body.first_original().value == u'Body of message 10'
+    finally:
+        mail.IMAP_FETCH_CHUNK_SIZE = chunk_size
@@ -213,3 +213,105 @@ def test_notification_multiple_subscriptions_create_single_notification(
 
 # def test_subscribe_notification_access_control
 # TODO: Check that other subscriptions are passed to process method
+
+
+def test_notification_routing():
+    from assembl.models.notification import CrudVerbs
+    dispatcher = ModelEventWatcherNotificationSubscriptionDispatcher
+    post_classes = dispatcher.subscription_classes_for(CrudVerbs.CREATE, Post)
+    assert NotificationSubscriptionFollowAllMessages in post_classes
+    assert NotificationSubscriptionFollowSyntheses not in post_classes
+    synthesis_classes = dispatcher.subscription_classes_for(
+        CrudVerbs.CREATE, SynthesisPost)
+    assert set(post_classes) < set(synthesis_classes)
+    assert NotificationSubscriptionFollowSyntheses in synthesis_classes
+    assert not dispatcher.subscription_classes_for(CrudVerbs.DELETE, Post)
+
+
+def test_notification_fan_out(test_session, discussion, participant1_user,
+                              participant2_user, reply_post_1, test_app,
+                              root_post_1):
+    # participant2_user is not a participant of the discussion
+    test_session.flush()
+    subscriptions = [NotificationSubscriptionFollowAllMessages(
+        discussion=discussion,
+        user=user,
+        creation_origin=NotificationCreationOrigin.USER_REQUESTED,
+    ) for user in (participant1_user, participant2_user)]
+    subscriptions.append(NotificationSubscriptionFollowOwnMessageDirectReplies(
+        discussion=discussion,
+        user=participant1_user,
+        creation_origin=NotificationCreationOrigin.USER_REQUESTED,
+    ))
+    test_session.add_all(subscriptions)
+    test_session.flush()
+
+    initial_notification_count = test_session.query(Notification).count()
+    dispatcher = ModelEventWatcherNotificationSubscriptionDispatcher()
+    dispatcher.processPostCreated(reply_post_1.id)
+    notifications = test_session.query(Notification).filter(
+        Notification.first_matching_subscription_id.in_(
+            [s.id for s in subscriptions])).all()
+    assert test_session.query(Notification).count() == \
+        initial_notification_count + 1
+    assert len(notifications) == 1
+    assert notifications[0].post_id == reply_post_1.id
+    assert notifications[0].first_matching_subscription.user == \
+        participant1_user
+
+
+def test_notification_rendering_cache():
+    from assembl.models.notification import NotificationRenderingCache
+    cache = NotificationRenderingCache()
+    assert cache.get_jinja_env('fr') is cache.get_jinja_env('fr')
+    assert cache.get_jinja_env('en') is not cache.get_jinja_env('fr')
+    template_name = 'notifications/html_mail_post.jinja2'
+    template = cache.get_template('en', template_name)
+    assert cache.get_template('en', template_name) is template
+    num_compiled = len(cache.bytecode_cache.codes)
+    assert num_compiled
+    # Other locales reuse the compiled template
+    cache.get_template('fr', template_name)
+    assert len(cache.bytecode_cache.codes) == num_compiled
+
+    renders = []
+
+    def render():
+        renders.append(True)
+        return u"<p>fragment</p>"
+    cache.fragment('post', render)
+    cache.fragment('post', render)
+    assert len(renders) == 2, "Fragments are only kept in a batch"
+    with cache.batch():
+        cache.fragment('post', render)
+        cache.fragment('post', render)
+    assert len(renders) == 3
+
+
+def test_deferred_notification_is_not_claimed(
+        test_session, discussion, participant1_user, reply_post_1,
+        test_app, root_post_1):
+    from assembl.lib.ratelimit import DomainRateLimiter
+    from assembl.tasks.notify import process_notification, claim_notifications
+    subscription = NotificationSubscriptionFollowAllMessages(
+        discussion=discussion,
+        user=participant1_user,
+        creation_origin=NotificationCreationOrigin.USER_REQUESTED,
+    )
+    test_session.add(subscription)
+    test_session.flush()
+    dispatcher = ModelEventWatcherNotificationSubscriptionDispatcher()
+    dispatcher.processPostCreated(reply_post_1.id)
+    notification = test_session.query(Notification).filter_by(
+        first_matching_subscription_id=subscription.id).one()
+    assert notification.id in claim_notifications(test_session, 1000)
+
+    rate_limiter = DomainRateLimiter(clock=lambda: 1000.0)
+    rate_limiter.set_limit('', 0.01)
+    rate_limiter.reserve(participant1_user.get_preferred_email())
+    wait = process_notification(notification, None, rate_limiter)
+    assert wait
+    test_session.flush()
+    # Until its slot, only the rescheduled task sends it
+    assert notification.next_attempt_date
+    assert notification.id not in claim_notifications(test_session, 1000)
@@ -156,5 +156,51 @@ def test_delete_posts(
     assert reply_post_1.is_tombstone
 
 
+def test_bulk_counts_match_queries(
+        test_session, test_webrequest, jack_layton_linked_discussion,
+        subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_1_1_1,
+        subidea_1_1_1_1_1, subidea_1_1_1_1_2, subidea_1_1_1_1_2_1,
+        subidea_1_1_1_1_2_2, subidea_1_2, subidea_1_2_1):
+    from assembl.models.path_utils import PostPathCounter
+    ideas = (
+        subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_1_1_1,
+        subidea_1_1_1_1_1, subidea_1_1_1_1_2, subidea_1_1_1_1_2_1,
+        subidea_1_1_1_1_2_2, subidea_1_2, subidea_1_2_1)
+    counters = subidea_1.prepare_counters(subidea_1.discussion_id)
+    bulk = PostPathCounter(None)
+    bulk.init_from(counters)
+    bulk.discussion = counters.discussion
+    bulk.get_all_counts()
+    single = PostPathCounter(None)
+    single.init_from(counters)
+    single.discussion = counters.discussion
+    for idea in ideas:
+        assert bulk.get_counts(idea.id) == single.get_counts(idea.id)
+    assert bulk.discussion_counts[0] == test_session.query(Post).filter(
+        Post.discussion_id == subidea_1.discussion_id,
+        Post.hidden == False, Post.tombstone_condition()).count()
+
+
+def test_discussion_structure_cache(
+        test_session, discussion, root_idea, subidea_1):
+    from assembl.models.path_utils import discussion_structure_cache
+    test_session.info.pop('structure_changes', None)
+    discussion_structure_cache.invalidate(discussion.id, True)
+    structure = discussion_structure_cache.get(test_session, discussion)
+    assert structure.parent_dict[subidea_1.id] == root_idea.id
+    assert discussion_structure_cache.get(
+        test_session, discussion) is structure
+    # Uncommitted changes bypass the cache
+    discussion_structure_cache.mark_changed(test_session, discussion.id)
+    assert discussion_structure_cache.get(
+        test_session, discussion) is not structure
+    test_session.info.pop('structure_changes', None)
+    # Content changes keep the idea hierarchy
+    discussion_structure_cache.invalidate(discussion.id)
+    structure2 = discussion_structure_cache.get(test_session, discussion)
+    assert structure2 is not structure
+    assert structure2.parent_dict is structure.parent_dict
+
+
 if Post.using_virtuoso:
     test_jack_layton_linked_discussion = pytest.mark.xfail(test_jack_layton_linked_discussion)
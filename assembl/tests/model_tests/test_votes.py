@@ -0,0 +1,119 @@
+import json
+
+import pytest
+
+
+@pytest.fixture(scope="function")
+def lickert_question(
+        request, test_session, discussion, subidea_1, subidea_1_1,
+        participant1_user, participant2_user):
+    """A voting widget with two Lickert vote specifications
+    in the same question, and votes on them"""
+    from assembl.models import (
+        VotingWidget, LickertVoteSpecification, LickertIdeaVote)
+    widget = VotingWidget(discussion=discussion, settings=json.dumps(
+        {'idea': subidea_1.uri()}))
+    specs = [LickertVoteSpecification(
+        widget=widget, minimum=0, maximum=10, question_id=1)
+        for _ in range(2)]
+    test_session.add(widget)
+    test_session.add_all(specs)
+    test_session.flush()
+    for (spec, idea, voter, value) in (
+            (specs[0], subidea_1_1, participant1_user, 2),
+            (specs[1], subidea_1_1, participant1_user, 4),
+            (specs[0], subidea_1_1, participant2_user, 6),
+            (specs[1], subidea_1_1, participant2_user, 8),
+            (specs[0], subidea_1, participant2_user, 10)):
+        test_session.add(LickertIdeaVote(
+            widget_id=widget.id, vote_spec_id=spec.id, idea_id=idea.id,
+            voter_id=voter.id, vote_value=value))
+    test_session.flush()
+
+    def fin():
+        print "finalizer lickert_question"
+        test_session.delete(widget)
+        test_session.flush()
+    request.addfinalizer(fin)
+    return specs
+
+
+def test_lickert_results(
+        test_session, lickert_question, subidea_1, subidea_1_1):
+    specs = lickert_question
+    results = specs[0].voting_results(2)
+    first = results[specs[0].uri()]
+    assert first['n_voters'] == 2
+    assert first[subidea_1_1.uri()] == dict(
+        n=2, avg=4.0, std_dev=2.0, histogram=[1, 1])
+    assert first[subidea_1.uri()]['histogram'] == [0, 1]
+    assert subidea_1.uri() not in results[specs[1].uri()]
+    joint = results[",".join(spec.uri() for spec in specs)]
+    assert joint[subidea_1_1.uri()] == dict(
+        n=2, histogram=[[1, 0], [0, 1]], b0=2.0, b1=1.0)
+    assert joint[subidea_1.uri()] == dict(n=0, histogram=[[0, 0], [0, 0]])
+
+
+def test_lickert_results_follow_votes(
+        test_session, lickert_question, subidea_1_1):
+    from assembl.models import LickertIdeaVote
+    spec = lickert_question[0]
+    assert spec.voting_results()[spec.uri()][subidea_1_1.uri()]['avg'] == 4
+    vote = test_session.query(LickertIdeaVote).filter_by(
+        vote_spec_id=spec.id, idea_id=subidea_1_1.id, vote_value=6).one()
+    vote.vote_value = 0
+    test_session.flush()
+    assert spec.voting_results()[spec.uri()][subidea_1_1.uri()]['avg'] == 1
+
+
+def test_lickert_csv_rows(
+        test_session, lickert_question, subidea_1, subidea_1_1):
+    rows = list(lickert_question[0].csv_rows(2))
+    # Depth first in the idea graph
+    assert [row['idea'] for row in rows] == [
+        subidea_1.short_title.encode('utf-8'),
+        subidea_1_1.short_title.encode('utf-8')]
+    assert rows[0][1] == 1 and rows[0]['avg'] == 10
+    assert [rows[1][0], rows[1][1]] == [1, 1] and rows[1]['avg'] == 4
+
+
+def test_vote_counters(
+        test_session, lickert_question, subidea_1_1, participant1_user):
+    from assembl.models import LickertIdeaVote, VoteValueCount
+    from assembl.models.votes import rebuild_vote_counts
+    spec = lickert_question[0]
+    assert rebuild_vote_counts(test_session, [spec.id], True) == {}
+    results = spec.voting_results()[spec.uri()]
+    assert results['n_voters'] == 2
+    vote = test_session.query(LickertIdeaVote).filter_by(
+        vote_spec_id=spec.id, idea_id=subidea_1_1.id,
+        voter_id=participant1_user.id).one()
+    vote.is_tombstone = True
+    test_session.flush()
+    results = spec.voting_results()[spec.uri()]
+    assert results['n_voters'] == 1
+    assert results[subidea_1_1.uri()]['n'] == 1
+    assert rebuild_vote_counts(test_session, [spec.id], True) == {}
+    # Break a counter, and rebuild it
+    test_session.query(VoteValueCount).filter_by(
+        vote_spec_id=spec.id, idea_id=subidea_1_1.id, vote_value=6
+    ).update({'num_votes': 3}, synchronize_session=False)
+    assert len(rebuild_vote_counts(test_session, [spec.id])) == 1
+    assert rebuild_vote_counts(test_session, [spec.id], True) == {}
+    assert spec.voting_results()[spec.uri()][subidea_1_1.uri()]['n'] == 1
+
+
+def test_rebuilt_vote_counts_are_committed(
+        test_session, lickert_question, subidea_1_1):
+    import transaction
+    from assembl.models import VoteValueCount
+    from assembl.models.votes import rebuild_vote_counts
+    spec_id = lickert_question[0].id
+    test_session.query(VoteValueCount).filter_by(
+        vote_spec_id=spec_id, idea_id=subidea_1_1.id
+    ).update({'num_votes': 3}, synchronize_session=False)
+    transaction.commit()
+    # As in the migration and the repair script
+    with transaction.manager:
+        assert rebuild_vote_counts(test_session, [spec_id])
+    assert rebuild_vote_counts(test_session, [spec_id], True) == {}
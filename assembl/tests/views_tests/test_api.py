@@ -6,6 +6,7 @@ import json
 import re
 import quopri
 import mock
+from datetime import datetime
 from urlparse import urlparse
 from urllib import unquote
 from urllib import urlencode, quote_plus
@@ -356,6 +357,60 @@ def test_api_get_posts_queries(
     # TODO: Other query types, and sorting
 
 
+def test_api_get_posts_paginated(
+        discussion, test_app, test_session, participant1_user,
+        root_post_1, discussion2_root_post_1, reply_post_1, reply_post_2):
+    base_post_url = get_url(discussion, 'posts')
+
+    url = base_post_url + "?view=id_only&page_size=2"
+    res = test_app.get(url)
+    assert res.status_code == 200
+    res_data = json.loads(res.body)
+    assert res_data['total'] == 3
+    assert res_data['maxPage'] == 2
+    assert [p['@id'] for p in res_data['posts']] == [
+        root_post_1.uri(), reply_post_1.uri()]
+    assert res_data['next']
+
+    res = test_app.get(url + "&" + urlencode({"after": res_data['next']}))
+    assert res.status_code == 200
+    res_data = json.loads(res.body)
+    assert res_data['total'] == 3
+    assert [p['@id'] for p in res_data['posts']] == [reply_post_2.uri()]
+    assert res_data['next'] is None
+
+    # Threaded mode gives whole threads
+    url = base_post_url + "?view=id_only&page_size=1&threaded=true"
+    res = test_app.get(url)
+    assert res.status_code == 200
+    res_data = json.loads(res.body)
+    assert len(res_data['posts']) == 3
+    assert res_data['next'] is None
+
+    # Only threads with filtered posts are paginated
+    from assembl.models import LangString
+    old_root = Post(
+        discussion=discussion, creator=participant1_user,
+        subject=LangString.create(u"an old root post"),
+        body=LangString.create(u"old post body"), moderator=None,
+        creation_date=datetime(year=1999, month=1, day=1),
+        type="post", message_id="old_root@example.com")
+    test_session.add(old_root)
+    test_session.flush()
+    try:
+        res = test_app.get(
+            url + "&posted_after_date=2000-01-02T00%3A00%3A00.000Z")
+        assert res.status_code == 200
+        res_data = json.loads(res.body)
+        assert res_data['maxPage'] == 1
+        assert set(p['@id'] for p in res_data['posts']) == {
+            reply_post_1.uri(), reply_post_2.uri()}
+        assert res_data['next'] is None
+    finally:
+        test_session.delete(old_root)
+        test_session.flush()
+
+
 def test_api_weird_failure_on_joinedload(
         discussion, test_app, test_session, participant1_user,
         root_post_1, reply_post_1, reply_post_2):
@@ -873,3 +873,12 @@ def test_add_timeline_event(test_app, discussion):
     # check that the link was made in both directions
     assert phase1_data['next_event'] == phase2_data['@id']
     assert phase1_data['@type'] == 'DiscussionPhase'
+
+
+def test_similar_posts_limit_is_validated(test_app, discussion):
+    url = "/data/Discussion/%d/similar_posts" % (discussion.id,)
+    for limit in ("0", "-3", "many"):
+        r = test_app.get(url, {'text': 'growth', 'limit': limit},
+                         headers={'Accept': 'application/json'},
+                         expect_errors=True)
+        assert r.status_code == 400
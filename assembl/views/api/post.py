@@ -10,12 +10,13 @@ from pyramid.i18n import TranslationStringFactory
 from pyramid.settings import asbool
 from pyramid.security import authenticated_userid, Everyone
 
-from sqlalchemy import String, text
+from sqlalchemy import String, Integer, text, or_, func
 
 from sqlalchemy.orm import (
     joinedload_all, aliased, subqueryload_all, undefer)
 from sqlalchemy.sql.expression import bindparam, and_
 from sqlalchemy.sql import cast, column
+from sqlalchemy.sql.functions import count
 
 from jwzthreading import restrip_pat
 
@@ -26,7 +27,7 @@ from assembl.views.api import API_DISCUSSION_PREFIX
 from assembl.auth import P_READ, P_ADD_POST
 from assembl.auth.util import get_permissions
 from assembl.tasks.translate import (
-    translate_content,
+    missing_translations, enqueue_translations,
     PrefCollectionTranslationTable)
 from assembl.models import (
     get_database_id, Post, AssemblPost, SynthesisPost,
@@ -51,6 +52,47 @@ post_read = Service(name='post_read', path=API_DISCUSSION_PREFIX + '/post_read/{
 
 _ = TranslationStringFactory('assembl')
 
+MAX_PAGE_SIZE = 500
+
+
+def _post_cursor(post_id, creation_date, order):
+    """The keyset pagination cursor that designates a post in a given order"""
+    if order in ('chronological', 'reverse_chronological'):
+        return "%s|%d" % (creation_date.isoformat(), post_id)
+    return str(post_id)
+
+
+def _parse_post_cursor(cursor, order):
+    """Parse a cursor given by _post_cursor into a (creation_date, id) pair"""
+    try:
+        if order in ('chronological', 'reverse_chronological'):
+            date, post_id = cursor.rsplit('|', 1)
+            date = parse_datetime(date, True)
+            return date, int(post_id)
+        return None, int(cursor)
+    except (ValueError, TypeError):
+        raise HTTPBadRequest("Invalid cursor: " + cursor)
+
+
+def _keyset_condition(cls, cursor, order):
+    """The condition for posts strictly after the cursor in the given order"""
+    date, post_id = cursor
+    if order == 'chronological':
+        return or_(cls.creation_date > date, and_(
+            cls.creation_date == date, cls.id > post_id))
+    elif order == 'reverse_chronological':
+        return or_(cls.creation_date < date, and_(
+            cls.creation_date == date, cls.id < post_id))
+    return cls.id > post_id
+
+
+def _keyset_order(cls, order):
+    if order == 'chronological':
+        return (cls.creation_date, cls.id)
+    elif order == 'reverse_chronological':
+        return (cls.creation_date.desc(), cls.id.desc())
+    return (cls.id, )
+
 
 @posts.get(permission=P_READ)
 def get_posts(request):
@@ -75,7 +117,21 @@ def get_posts(request):
     permissions = get_permissions(user_id, discussion_id)
 
     DEFAULT_PAGE_SIZE = 25
-    page_size = DEFAULT_PAGE_SIZE
+    # Real pagination happens if page_size is given (or with a cursor.)
+    # Otherwise, all posts are returned, for backwards compatibility.
+    page_size = request.GET.get('page_size', None)
+    cursor = request.GET.get('after', None)
+    paginated = page_size is not None or cursor is not None
+    if page_size is not None:
+        try:
+            page_size = min(max(int(page_size), 1), MAX_PAGE_SIZE)
+        except ValueError:
+            raise HTTPBadRequest(localizer.translate(
+                _("Invalid page size")))
+    else:
+        page_size = DEFAULT_PAGE_SIZE
+    # In threaded mode, we paginate on thread roots, and return whole threads
+    threaded = asbool(request.GET.get('threaded', False))
 
     filter_names = [
         filter_name for filter_name
@@ -96,6 +152,11 @@ def get_posts(request):
     assert order in ('chronological', 'reverse_chronological', 'score')
     if order == 'score':
         assert text_search is not None
+        if cursor is not None or (paginated and threaded):
+            raise HTTPBadRequest(localizer.translate(
+                _("Score ordering only supports page-based pagination")))
+    if cursor is not None:
+        cursor = _parse_post_cursor(cursor, order)
 
     if page < 1:
         page = 1
@@ -361,6 +422,58 @@ def get_posts(request):
             Post.body_text_index.contains(
                 text_search.encode('utf-8'), offband=offband))
 
+    next_cursor = None
+    if paginated:
+        # Counts come from aggregate queries on the filtered posts
+        total_count = posts.with_entities(
+            count(PostClass.id.distinct())).order_by(None).scalar()
+        if user_id != Everyone:
+            read_alias = aliased(ViewPost)
+            unread_count = posts.with_entities(
+                count(PostClass.id.distinct())).order_by(None).outerjoin(
+                read_alias, and_(
+                    read_alias.actor_id == user_id,
+                    read_alias.post_id == PostClass.id,
+                    read_alias.tombstone_date == None)).filter(
+                read_alias.id == None).scalar()
+        else:
+            unread_count = total_count
+        if threaded:
+            # Paginate on the roots of the threads with filtered posts,
+            # then get their subtrees.
+            # The root is the first ancestor, or the post itself.
+            thread_root_id = func.coalesce(cast(func.nullif(func.split_part(
+                PostClass.ancestry, ',', 1), ''), Integer), PostClass.id)
+            filtered_root_ids = posts.with_entities(
+                thread_root_id).order_by(None).distinct().subquery()
+            roots = discussion.db.query(
+                Post.id, Post.creation_date).filter(
+                Post.id.in_(filtered_root_ids))
+            page_count_base = roots.count()
+            if cursor is not None:
+                roots = roots.filter(_keyset_condition(Post, cursor, order))
+            roots = roots.order_by(*_keyset_order(Post, order)).limit(
+                page_size + 1).all()
+            if len(roots) > page_size:
+                roots = roots[:page_size]
+                next_cursor = _post_cursor(
+                    roots[-1][0], roots[-1][1], order)
+            root_ids = [root[0] for root in roots]
+            if root_ids:
+                thread_condition = or_(PostClass.id.in_(root_ids), *[
+                    PostClass.ancestry.like("%d,%%" % (root_id,))
+                    for root_id in root_ids])
+            else:
+                thread_condition = PostClass.id == None
+            posts = posts.filter(thread_condition)
+            ideaContentLinkQuery = ideaContentLinkQuery.filter(
+                thread_condition)
+        else:
+            page_count_base = total_count
+            if cursor is not None:
+                posts = posts.filter(
+                    _keyset_condition(PostClass, cursor, order))
+
     # posts = posts.options(contains_eager(Post.source))
     # Horrible hack... But useful for structure load
     if view_def == 'id_only':
@@ -379,16 +492,31 @@ def get_posts(request):
             posts = posts.options(*Content.joinedload_options())
         ideaContentLinkCache = dict(ideaContentLinkQuery.all())
 
-    if order == 'chronological':
+    if order == 'score':
+        posts = posts.order_by(Content.body_text_index.score_name.desc())
+    elif paginated:
+        # keyset pagination needs a total order
+        posts = posts.order_by(*_keyset_order(PostClass, order))
+    elif order == 'chronological':
         posts = posts.order_by(Content.creation_date)
     elif order == 'reverse_chronological':
         posts = posts.order_by(Content.creation_date.desc())
-    elif order == 'score':
-        posts = posts.order_by(Content.body_text_index.score_name.desc())
     else:
         posts = posts.order_by(Content.id)
     # print str(posts)
 
+    if paginated and not threaded:
+        if order == 'score':
+            posts = posts.offset(page_size * (page - 1)).limit(page_size)
+            posts = posts.all()
+        else:
+            posts = posts.limit(page_size + 1).all()
+            if len(posts) > page_size:
+                posts = posts[:page_size]
+                last_post = posts[-1]
+                next_cursor = _post_cursor(
+                    last_post.id, last_post.creation_date, order)
+
     no_of_posts = 0
     no_of_posts_viewed_by_user = 0
 
@@ -434,15 +562,21 @@ def get_posts(request):
         if deleted is True:
             add_ancestors(post)
 
+        missing = None
         if user_id != Everyone:
             viewpost = post.id in read_posts
             likedpost = liked_posts.get(post.id, None)
-            if view_def != "id_only":
-                translate_content(
-                    post, translation_table=translations, service=service)
+            if translations and view_def != "id_only":
+                # Translations are done in the background, and sent
+                # through the changes socket when ready.
+                missing = missing_translations(post, translations, service)
+                if missing:
+                    enqueue_translations(post.db, missing)
         no_of_posts += 1
         serializable_post = post.generic_json(
             view_def, user_id, permissions) or {}
+        if missing:
+            serializable_post['translation_pending'] = True
         if order == 'score':
             score = query_result[1]
             serializable_post['score'] = score
@@ -470,20 +604,17 @@ def get_posts(request):
 
         post_data.append(serializable_post)
 
-    # Benoitg:  For now, this completely garbles threading without intelligent
-    #handling of pagination.  Disabling
-    #posts = posts.limit(page_size).offset(data['startIndex']-1)
-    # This code isn't up to date.  If limiting the query by page, we need to 
-    # calculate the counts with a separate query to have the right number of 
-    # results
-    #no_of_messages_viewed_by_user = discussion.db.query(ViewPost).join(
-    #    Post
-    #).filter(
-    #    Post.discussion_id == discussion_id,
-    #    ViewPost.actor_id == user_id,
-    #).count() if user_id else 0
-
     data = {}
+    if paginated:
+        data["page"] = page
+        data["page_size"] = page_size
+        data["total"] = total_count
+        data["unread"] = unread_count
+        data["maxPage"] = max(1, ceil(float(page_count_base) / page_size))
+        data["next"] = next_cursor
+        data["posts"] = post_data
+        return data
+
     data["page"] = page
     data["unread"] = no_of_posts - no_of_posts_viewed_by_user
     data["total"] = no_of_posts
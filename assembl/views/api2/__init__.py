@@ -49,7 +49,7 @@ from pyramid.response import Response
 from pyramid.settings import asbool
 from simplejson import dumps
 
-from assembl.lib.sqla import ObjectNotUniqueError
+from assembl.lib.sqla import ObjectNotUniqueError, BaseOps
 from ..traversal import (
     InstanceContext, CollectionContext, ClassContext, Api2Context)
 from assembl.auth import (
@@ -184,8 +184,8 @@ def collection_view(request, default_view='default'):
     if view == 'id_only':
         return [ctx.collection_class.uri_generic(x) for (x,) in q.all()]
     else:
-        res = [i.generic_json(view, user_id, permissions) for i in q.all()]
-        return [x for x in res if x is not None]
+        res = BaseOps.generic_json_list(q.all(), view, user_id, permissions)
+        return [x for (i, x) in res if x is not None]
 
 
 def collection_add(request, args):
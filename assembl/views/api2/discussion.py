@@ -7,19 +7,7 @@ from collections import defaultdict
 import random
 from datetime import timedelta
 
-from sqlalchemy import (
-    Column,
-    Integer,
-    UnicodeText,
-    DateTime,
-    Text,
-    String,
-    Boolean,
-    event,
-    ForeignKey,
-    func,
-    distinct
-)
+from sqlalchemy import func
 
 
 import simplejson as json
@@ -37,14 +25,15 @@ import requests
 
 from assembl.lib.config import get_config
 from assembl.lib.parsedatetime import parse_datetime
+from assembl.lib.export import (
+    csv_streaming_response, json_streaming_response)
 from assembl.auth import (
     P_READ, P_READ_PUBLIC_CIF, P_ADMIN_DISC, P_DISC_STATS, P_SYSADMIN)
 from assembl.auth.password import verify_data_token, data_token, Validity
 from assembl.auth.util import get_permissions
-from assembl.models import (Discussion, Permission)
+from assembl.models import (Discussion, Permission, Post)
 from ..traversal import InstanceContext
 from . import (JSON_HEADER, FORM_HEADER)
-from sqlalchemy.orm.util import aliased
 
 
 @view_config(context=InstanceContext, request_method='GET',
@@ -55,6 +44,33 @@ def discussion_settings_get(request):
     return request.context._instance.settings_json
 
 
+# At most this many posts are returned by similar_posts_to_text
+MAX_SIMILAR_POSTS = 50
+
+
+@view_config(context=InstanceContext, request_method='GET',
+             ctx_instance_class=Discussion, permission=P_READ,
+             accept="application/json", name="similar_posts",
+             renderer='json')
+def similar_posts_to_text(request):
+    """Posts similar to a text, e.g. while a message is being composed."""
+    text = request.GET.get('text', None)
+    if not text:
+        raise HTTPBadRequest("Please give a text")
+    try:
+        limit = int(request.GET.get('limit', 10))
+    except ValueError:
+        raise HTTPBadRequest("Invalid limit")
+    if limit <= 0:
+        raise HTTPBadRequest("The limit must be positive")
+    limit = min(limit, MAX_SIMILAR_POSTS)
+    from assembl.nlp.clusters import SemanticAnalysisData
+    analysis = SemanticAnalysisData(request.context._instance)
+    return [dict(id=Post.uri_generic(post_id), score=score)
+            for (post_id, score)
+            in analysis.get_similar_posts(text=text, limit=limit)]
+
+
 @view_config(context=InstanceContext, request_method='PATCH',
              ctx_instance_class=Discussion, permission=P_ADMIN_DISC,
              header=JSON_HEADER, name="settings")
@@ -256,7 +272,6 @@ def get_time_series_analytics(request):
     end = request.GET.get("end", None)
     interval = request.GET.get("interval", None)
     discussion = request.context._instance
-    user_id = authenticated_userid(request) or Everyone
     try:
         if start:
             start = parse_datetime(start)
@@ -270,176 +285,17 @@ def get_time_series_analytics(request):
         raise HTTPBadRequest("You cannot define an interval and no start")
     if interval and not end:
         end = datetime.now()
-    results = []
+    if not interval:
+        raise HTTPBadRequest("Please specify an interval")
+    intervals = make_intervals(start, end, interval)
+
+    from assembl.models.analytics import time_series
+    results = time_series(discussion.db, discussion.id, intervals)
 
-    from sqlalchemy import Table, MetaData, and_, case, cast, Float
-    from sqlalchemy.exc import ProgrammingError
-    import pprint
-    import transaction
-    with transaction.manager:
-        metadata = MetaData(discussion.db.get_bind())  # make sure we are using the same connexion
-
-        intervals_table = Table('temp_table_intervals_' + str(user_id), metadata,
-            Column('interval_id', Integer, primary_key=True),
-            Column('interval_start', DateTime, nullable=False),
-            Column('interval_end', DateTime, nullable=False),
-            prefixes=None if discussion.using_virtuoso else ['TEMPORARY']
-        )
-        try:
-            intervals_table.drop()  # In case there is a leftover from a previous crash
-        except ProgrammingError:
-            pass
-        intervals_table.create()
-        interval_start = start
-        intervals = []
-        if interval:
-            while interval_start < end:
-                interval_end = min(interval_start + interval, end)
-                intervals.append({'interval_start': interval_start, 'interval_end': interval_end})
-                interval_start = interval_start + interval
-            #pprint.pprint(intervals)
-            discussion.db.execute(intervals_table.insert(), intervals)
-        else:
-            raise HTTPBadRequest("Please specify an interval")
-
-        from assembl.models import Post, AgentProfile, AgentStatusInDiscussion, ViewPost
-
-        # The posters
-        post_subquery = discussion.db.query(intervals_table.c.interval_id,
-            func.count(distinct(Post.id)).label('count_posts'),
-            func.count(distinct(Post.creator_id)).label('count_post_authors'),
-            # func.DB.DBA.BAG_AGG(Post.creator_id).label('post_authors'),
-            # func.DB.DBA.BAG_AGG(Post.id).label('post_ids'),
-            )
-        post_subquery = post_subquery.outerjoin(Post, and_(Post.creation_date >= intervals_table.c.interval_start, Post.creation_date < intervals_table.c.interval_end, Post.discussion_id == discussion.id))
-        post_subquery = post_subquery.group_by(intervals_table.c.interval_id)
-        post_subquery = post_subquery.subquery()
-
-        # The cumulative posters
-        cumulative_posts_aliased = aliased(Post)
-        cumulative_posts_subquery = discussion.db.query(intervals_table.c.interval_id,
-            func.count(distinct(cumulative_posts_aliased.id)).label('count_cumulative_posts'),
-            func.count(distinct(cumulative_posts_aliased.creator_id)).label('count_cumulative_post_authors')
-            # func.DB.DBA.BAG_AGG(cumulative_posts_aliased.id).label('cumulative_post_ids')
-            )
-        cumulative_posts_subquery = cumulative_posts_subquery.outerjoin(cumulative_posts_aliased, and_(cumulative_posts_aliased.creation_date < intervals_table.c.interval_end, cumulative_posts_aliased.discussion_id == discussion.id))
-        cumulative_posts_subquery = cumulative_posts_subquery.group_by(intervals_table.c.interval_id)
-        cumulative_posts_subquery = cumulative_posts_subquery.subquery()
-
-        # The post viewers
-        postViewers = aliased(ViewPost)
-        viewedPosts = aliased(Post)
-        post_viewers_subquery = discussion.db.query(intervals_table.c.interval_id,
-            func.count(distinct(postViewers.actor_id)).label('UNRELIABLE_count_post_viewers')
-            )
-        post_viewers_subquery = post_viewers_subquery.outerjoin(postViewers, and_(postViewers.creation_date >= intervals_table.c.interval_start, postViewers.creation_date < intervals_table.c.interval_end)).\
-                        join(viewedPosts, and_(postViewers.post_id == viewedPosts.id, viewedPosts.discussion_id == discussion.id))
-        post_viewers_subquery = post_viewers_subquery.group_by(intervals_table.c.interval_id)
-        post_viewers_subquery = post_viewers_subquery.subquery()
-
-        # The visitors
-        firstTimeVisitorAgent = aliased(AgentStatusInDiscussion)
-        visitors_subquery = discussion.db.query(intervals_table.c.interval_id,
-            func.count(firstTimeVisitorAgent.id).label('count_first_time_logged_in_visitors'),
-            # func.DB.DBA.BAG_AGG(firstTimeVisitorAgent.id).label('first_time_visitors')
-            )
-        visitors_subquery = visitors_subquery.outerjoin(firstTimeVisitorAgent, and_(firstTimeVisitorAgent.first_visit >= intervals_table.c.interval_start, firstTimeVisitorAgent.first_visit < intervals_table.c.interval_end, firstTimeVisitorAgent.discussion_id == discussion.id))
-        visitors_subquery = visitors_subquery.group_by(intervals_table.c.interval_id)
-        visitors_subquery = visitors_subquery.subquery()
-
-        # The cumulative visitors
-        cumulativeVisitorAgent = aliased(AgentStatusInDiscussion)
-        cumulative_visitors_query = discussion.db.query(intervals_table.c.interval_id,
-            func.count(distinct(cumulativeVisitorAgent.id)).label('count_cumulative_logged_in_visitors'),
-            # func.DB.DBA.BAG_AGG(cumulativeVisitorAgent.id).label('first_time_visitors')
-            )
-        cumulative_visitors_query = cumulative_visitors_query.outerjoin(cumulativeVisitorAgent, and_(cumulativeVisitorAgent.first_visit < intervals_table.c.interval_end, cumulativeVisitorAgent.discussion_id == discussion.id))
-        cumulative_visitors_query = cumulative_visitors_query.group_by(intervals_table.c.interval_id)
-        cumulative_visitors_subquery = cumulative_visitors_query.subquery()
-        # query = cumulative_visitors_query
-
-        # The members (can go up and down...)  Assumes that first_subscribed is available
-        commented_out = """ first_subscribed isn't yet filled in by assembl
-        memberAgentStatus = aliased(AgentStatusInDiscussion)
-        members_subquery = discussion.db.query(intervals_table.c.interval_id,
-            func.count(memberAgentStatus.id).label('count_approximate_members')
-            )
-        members_subquery = members_subquery.outerjoin(memberAgentStatus, ((memberAgentStatus.last_unsubscribed >= intervals_table.c.interval_end) | (memberAgentStatus.last_unsubscribed.is_(None))) & ((memberAgentStatus.first_subscribed < intervals_table.c.interval_end) | (memberAgentStatus.first_subscribed.is_(None))) & (memberAgentStatus.discussion_id==discussion.id))
-        members_subquery = members_subquery.group_by(intervals_table.c.interval_id)
-        query = members_subquery
-        members_subquery = members_subquery.subquery()
-        """
-
-        subscribersAgentStatus = aliased(AgentStatusInDiscussion)
-        subscribers_query = discussion.db.query(intervals_table.c.interval_id,
-                                                func.sum(
-                                                    case([
-                                                          (subscribersAgentStatus.last_visit == None, 0),
-                                                          (and_(subscribersAgentStatus.last_visit < intervals_table.c.interval_end, subscribersAgentStatus.last_visit >= intervals_table.c.interval_start), 1)
-                                                          ], else_=0)
-                                                         ).label('retention_count_last_visit_in_period'),
-                                                func.sum(
-                                                    case([
-                                                          (subscribersAgentStatus.first_visit == None, 0),
-                                                          (and_(subscribersAgentStatus.first_visit < intervals_table.c.interval_end, subscribersAgentStatus.first_visit >= intervals_table.c.interval_start), 1)
-                                                          ], else_=0)
-                                                         ).label('recruitment_count_first_visit_in_period'),
-                                                func.sum(
-                                                    case([
-                                                          (subscribersAgentStatus.first_subscribed == None, 0),
-                                                          (and_(subscribersAgentStatus.first_subscribed < intervals_table.c.interval_end, subscribersAgentStatus.first_subscribed >= intervals_table.c.interval_start), 1)
-                                                          ], else_=0)
-                                                         ).label('UNRELIABLE_recruitment_count_first_subscribed_in_period'),
-                                                func.sum(
-                                                    case([
-                                                          (subscribersAgentStatus.last_unsubscribed == None, 0),
-                                                          (and_(subscribersAgentStatus.last_unsubscribed < intervals_table.c.interval_end, subscribersAgentStatus.last_unsubscribed >= intervals_table.c.interval_start), 1)
-                                                          ], else_=0)
-                                                         ).label('UNRELIABLE_retention_count_first_subscribed_in_period'),
-                                            )
-        subscribers_query = subscribers_query.outerjoin(subscribersAgentStatus, subscribersAgentStatus.discussion_id==discussion.id)
-        subscribers_query = subscribers_query.group_by(intervals_table.c.interval_id)
-        subscribers_subquery = subscribers_query.subquery()
-        #query = subscribers_query
-
-        combined_query = discussion.db.query(intervals_table,
-                                             post_subquery,
-                                             cumulative_posts_subquery,
-                                             post_viewers_subquery,
-                                             visitors_subquery,
-                                             cumulative_visitors_subquery,
-                                             case([
-                                                   (cumulative_posts_subquery.c.count_cumulative_post_authors == 0, None),
-                                                   (cumulative_posts_subquery.c.count_cumulative_post_authors != 0, (cast(post_subquery.c.count_post_authors, Float) / cast(cumulative_posts_subquery.c.count_cumulative_post_authors, Float)))
-                                                   ]).label('fraction_cumulative_authors_who_posted_in_period'),
-                                             case([
-                                                   (cumulative_visitors_subquery.c.count_cumulative_logged_in_visitors == 0, None),
-                                                   (cumulative_visitors_subquery.c.count_cumulative_logged_in_visitors != 0, (cast(post_subquery.c.count_post_authors, Float) / cast(cumulative_visitors_subquery.c.count_cumulative_logged_in_visitors, Float)))
-                                                   ]).label('fraction_cumulative_logged_in_visitors_who_posted_in_period'),
-                                             subscribers_subquery,
-                                             )
-        combined_query = combined_query.join(post_subquery, post_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(post_viewers_subquery, post_viewers_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(visitors_subquery, visitors_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(cumulative_visitors_subquery, cumulative_visitors_subquery.c.interval_id == intervals_table.c.interval_id)
-        # combined_query = combined_query.join(members_subquery, members_subquery.c.interval_id==intervals_table.c.interval_id)
-        combined_query = combined_query.join(subscribers_subquery, subscribers_subquery.c.interval_id==intervals_table.c.interval_id)
-        combined_query = combined_query.join(cumulative_posts_subquery, cumulative_posts_subquery.c.interval_id == intervals_table.c.interval_id)
-
-        query = combined_query
-        query = query.order_by(intervals_table.c.interval_id)
-        results = query.all()
-
-        # pprint.pprint(results)
-        # end of transaction
-
-    intervals_table.drop()
     if not (request.GET.get('format', None) == 'csv' or
             request.accept == 'text/csv'):
             # json default
-        from assembl.lib.json import DateJSONEncoder
-        return Response(json.dumps(results, cls=DateJSONEncoder),
-                        content_type='application/json')
+        return json_streaming_response(results)
 
     fieldnames = [
         "interval_id",
@@ -460,18 +316,22 @@ def get_time_series_analytics(request):
         "UNRELIABLE_count_post_viewers",
     ]
     # otherwise assume csv
-    return csv_response(fieldnames, [r._asdict() for r in results])
+    return csv_response(fieldnames, results)
+
+
+def make_intervals(start, end, interval):
+    """Consecutive (start, end) intervals of the given duration,
+    the last one ending at end."""
+    intervals = []
+    while start < end:
+        this_end = min(start + interval, end)
+        intervals.append((start, this_end))
+        start = this_end
+    return intervals
 
 
 def csv_response(fieldnames, results):
-    from csv import DictWriter
-    output = StringIO()
-    csv = DictWriter(output, fieldnames=fieldnames, dialect='excel', delimiter=';')
-    csv.writeheader()
-    for r in results:
-        csv.writerow(r)
-    output.seek(0)
-    return Response(body_file=output, content_type='text/csv')
+    return csv_streaming_response(results, fieldnames)
 
 
 @view_config(context=InstanceContext, name="contribution_count",
@@ -499,18 +359,27 @@ def get_contribution_count(request):
         end = datetime.now()
     results = []
     if interval:
-        while start < end:
-            this_end = min(start+interval, end)
-            results.append(dict(
-                start=start.isoformat(), end=this_end.isoformat(),
-                count=discussion.count_contributions_per_agent(
-                    start, this_end)))
-            start = this_end
+        from assembl.models import AgentProfile
+        from sqlalchemy.orm import subqueryload
+        intervals = make_intervals(start, end, interval)
+        counts = discussion.count_contributions_per_interval(
+            intervals) if intervals else []
+        agents = discussion.db.query(AgentProfile).filter(
+            AgentProfile.id.in_({creator_id for (_, creator_id, _) in counts})
+        ).options(subqueryload(AgentProfile.accounts)) if counts else ()
+        agents = {agent.id: agent for agent in agents}
+        results = [dict(start=this_start.isoformat(),
+                        end=this_end.isoformat(), count=[])
+                   for (this_start, this_end) in intervals]
+        # from highest to lowest
+        counts.sort(key=lambda (n, creator_id, count): (count, creator_id),
+                    reverse=True)
+        for (n, creator_id, count) in counts:
+            results[n]['count'].append((agents[creator_id], count))
     else:
         r = dict(count=discussion.count_contributions_per_agent(start, end))
         if not start:
             from assembl.models import Post
-            from sqlalchemy import func
             (start,) = discussion.db.query(
                 func.min(Post.creation_date)).filter_by(
                 discussion_id=discussion.id).first()
@@ -527,7 +396,6 @@ def get_contribution_count(request):
                           for (agent, count) in v['count']}
         return Response(json.dumps(results), content_type='application/json')
     # otherwise assume csv
-    from csv import writer
     total_count = defaultdict(int)
     agents = {}
     for v in results:
@@ -539,21 +407,19 @@ def get_contribution_count(request):
         v['count'] = as_dict
     count_list = total_count.items()
     count_list.sort(key=lambda (a, c): c, reverse=True)
-    output = StringIO()
-    csv = writer(output, dialect='excel', delimiter=';')
-    csv.writerow(['Start']+[
-        x['start'] for x in results] + ['Total'])
-    csv.writerow(['End']+[
-        x['end'] for x in results] + [''])
-    for agent_id, total_count in count_list:
-        agent = agents[agent_id]
-        agent_name = (
-            agent.display_name() or agent.real_name() or
-            agent.get_preferred_email())
-        csv.writerow([agent_name.encode('utf-8')] + [
-            x['count'].get(agent_id, '') for x in results] + [total_count])
-    output.seek(0)
-    return Response(body_file=output, content_type='text/csv')
+    # Names are computed before the transaction ends
+    agent_names = {
+        agent_id: (agent.display_name() or agent.real_name() or
+                   agent.get_preferred_email())
+        for (agent_id, agent) in agents.iteritems()}
+
+    def rows():
+        yield ['Start'] + [x['start'] for x in results] + ['Total']
+        yield ['End'] + [x['end'] for x in results] + ['']
+        for agent_id, total_count in count_list:
+            yield [agent_names[agent_id].encode('utf-8')] + [
+                x['count'].get(agent_id, '') for x in results] + [total_count]
+    return csv_streaming_response(rows())
 
 
 @view_config(context=InstanceContext, name="visit_count",
@@ -581,22 +447,21 @@ def get_visit_count(request):
         end = datetime.now()
     results = []
     if interval:
-        while start < end:
-            this_end = min(start+interval, end)
+        intervals = make_intervals(start, end, interval)
+        if intervals:
+            readers = discussion.count_post_viewers_per_interval(intervals)
+            first_visitors = discussion.count_new_visitors_per_interval(
+                intervals)
+        for n, (this_start, this_end) in enumerate(intervals):
             results.append(dict(
-                start=start.isoformat(), end=this_end.isoformat(),
-                readers=discussion.count_post_viewers(
-                    start, this_end),
-                first_visitors=discussion.count_new_visitors(
-                    start, this_end)))
-            start = this_end
+                start=this_start.isoformat(), end=this_end.isoformat(),
+                readers=readers[n], first_visitors=first_visitors[n]))
     else:
         r = dict(
             readers=discussion.count_post_viewers(start, end),
             first_visitors=discussion.count_new_visitors(start, end))
         if not start:
             from assembl.models import AgentStatusInDiscussion
-            from sqlalchemy import func
             (start,) = discussion.db.query(
                 func.min(AgentStatusInDiscussion.first_visit)).filter_by(
                 discussion_id=discussion.id).first()
@@ -622,15 +487,14 @@ def get_visitors(request):
     use_first = asbool(request.GET.get("first", False))
     attribute = "first_visit" if use_first else "last_visit"
     visitors = [
-        (getattr(st, attribute), st.agent_profile.name,
-            st.agent_profile.get_preferred_email())
-        for st in discussion.agent_status_in_discussion
-        if getattr(st, attribute, None)]
-    visitors.sort()
-    visitors.reverse()
-    body = "\n".join(("%s: %s <%s>" % (x[0].isoformat(), x[1], x[2])
-                      for x in visitors))
-    return Response(body=body, content_type='text/text')
+        (date, agent.name, agent.get_preferred_email())
+        for (date, agent) in discussion.get_visitors(attribute)]
+
+    def lines():
+        for (date, name, email) in visitors:
+            yield (u"%s: %s <%s>\n" % (
+                date.isoformat(), name, email)).encode('utf-8')
+    return Response(app_iter=lines(), content_type='text/text')
 
 
 pygraphviz_formats = {
@@ -110,6 +110,19 @@ def process_all_now(request):
                     content_type='text/plain')
 
 
+@view_config(context=ClassContext, request_method='GET',
+             ctx_class=Notification, permission=P_SYSADMIN,
+             renderer='json', name="delivery_metrics")
+def delivery_metrics(request):
+    """The outgoing mail limits and counters of each domain,
+    as last published by the notification worker."""
+    from dogpile.cache.api import NO_VALUE
+    from assembl.lib.utils import get_shared_cache_region
+    region = get_shared_cache_region('notify_metrics')
+    metrics = region.get('rate_limits') if region else NO_VALUE
+    return {} if metrics is NO_VALUE else metrics
+
+
 @view_config(context=InstanceContext, request_method='PUT',
     ctx_instance_class=NotificationSubscription,
     header=JSON_HEADER, renderer='json')
@@ -1,5 +1,4 @@
 from datetime import datetime
-from cStringIO import StringIO
 
 from pyramid.view import view_config
 from pyramid.httpexceptions import (
@@ -16,6 +15,7 @@ from assembl.auth.util import get_permissions
 from assembl.models import (
     AbstractIdeaVote, User, AbstractVoteSpecification, VotingWidget)
 from assembl.lib.sqla import get_named_class
+from assembl.lib.export import csv_streaming_response, in_transaction
 from . import (FORM_HEADER, JSON_HEADER, check_permissions)
 
 
@@ -193,7 +193,11 @@ def vote_results_csv(request):
         permissions = get_permissions(user_id, ctx.get_discussion_id())
         if P_ADMIN_DISC not in permissions:
             raise HTTPUnauthorized()
-    output = StringIO()
-    ctx._instance.csv_results(output, histogram)
-    output.seek(0)
-    return Response(body_file=output, content_type='text/csv')
+    spec = ctx._instance
+    spec_id = spec.id
+    fieldnames = spec.csv_fieldnames(histogram)
+
+    def rows():
+        spec = AbstractVoteSpecification.get(spec_id)
+        return spec.csv_rows(histogram)
+    return csv_streaming_response(in_transaction(rows), fieldnames)